@@ -0,0 +1,67 @@
+"""
+<Program Name>
+  bench_getruntime.py
+
+<Purpose>
+  Compares the throughput of the two getruntime backends in nonportable
+  when several threads call them concurrently: the uptime based clock
+  (which takes runtimelock and reads /proc/uptime on Linux) and the
+  lock-free monotonic clock.
+
+  Run this from a built RUNNABLE directory, e.g.
+    python bench_getruntime.py [threads] [calls per thread]
+"""
+
+import sys
+import time
+import threading
+
+import nonportable
+
+
+def _run_threads(clockfunc, threadcount, callsperthread):
+  def worker():
+    for junk in xrange(callsperthread):
+      clockfunc()
+
+  threadlist = []
+  for junk in range(threadcount):
+    threadlist.append(threading.Thread(target=worker))
+
+  start = time.time()
+  for thread in threadlist:
+    thread.start()
+  for thread in threadlist:
+    thread.join()
+
+  return time.time() - start
+
+
+
+def main():
+  threadcount = 8
+  callsperthread = 20000
+
+  if len(sys.argv) > 1:
+    threadcount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    callsperthread = int(sys.argv[2])
+
+  totalcalls = threadcount * callsperthread
+
+  backends = [("uptime", nonportable._getruntime_uptime)]
+  if nonportable.monotonic_clock_available:
+    backends.append(("monotonic", nonportable._getruntime_monotonic))
+  else:
+    print "No monotonic clock on this platform, only timing the uptime clock."
+
+  print "%d threads, %d calls each" % (threadcount, callsperthread)
+  for (name, clockfunc) in backends:
+    elapsed = _run_threads(clockfunc, threadcount, callsperthread)
+    print "%-10s %8.3f s  %10.0f calls/s  %6.2f us/call" % (name, elapsed,
+        totalcalls / elapsed, elapsed * 1000000.0 / totalcalls)
+
+
+
+if __name__ == '__main__':
+  main()
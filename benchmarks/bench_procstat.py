@@ -0,0 +1,129 @@
+"""
+<Program Name>
+  bench_procstat.py
+
+<Purpose>
+  Compares the cost of sampling a process's CPU time and RSS on Linux the
+  way the resource monitor used to (open, read and close /proc/PID/stat,
+  split every field, once for the CPU time and reuse it for the RSS) with
+  linux_api.get_process_cpu_time_and_rss, which keeps the file open,
+  re-reads it with pread and parses only the fields it needs.
+
+  For each, it prints the microseconds per sample and the read system
+  calls per sample (from /proc/self/io).   If strace is installed, it also
+  counts every system call per sample by running each one again under
+  strace.
+
+  Run this from a built RUNNABLE directory, e.g.
+    python bench_procstat.py [samples]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+import linux_api
+
+
+
+def _old_sample(pid):
+  # What linux_api did before the stat files were kept open
+  fileo = open("/proc/"+str(pid)+"/stat", "r")
+  data = fileo.read()
+  fileo.close()
+
+  data = data.strip("\n")
+  start_index = data.find("(")
+  if start_index != -1:
+    end_index = data.find(")", start_index)
+    data = data[:start_index-1] + data[end_index+1:]
+  fields = data.split(" ")
+
+  if "Z" in fields[linux_api.FIELDS["state"]]:
+    raise Exception, "Queried Process is a zombie (dead)!"
+
+  cputime = (int(fields[linux_api.FIELDS["utime"]]) +
+      int(fields[linux_api.FIELDS["stime"]])) / linux_api.JIFFIES_PER_SECOND
+  rss = int(fields[linux_api.FIELDS["rss"]]) * linux_api.PAGE_SIZE
+  return (cputime, rss)
+
+
+METHODS = {"old":_old_sample, "new":linux_api.get_process_cpu_time_and_rss}
+
+
+
+def _read_syscalls():
+  for line in open("/proc/self/io"):
+    if line.startswith("syscr:"):
+      return int(line.split()[1])
+  return 0
+
+
+def _run(samplefunc, samples):
+  pid = os.getpid()
+  # Open anything that is kept open before counting
+  samplefunc(pid)
+
+  startreads = _read_syscalls()
+  start = time.time()
+  for junk in xrange(samples):
+    samplefunc(pid)
+  elapsed = time.time() - start
+
+  # Reading /proc/self/io is a read too
+  reads = _read_syscalls() - startreads - 1
+  return (elapsed, reads)
+
+
+def _strace_syscalls(name, samples):
+  # Count every system call made while sampling, less those made while
+  # starting up and exiting
+  counts = []
+  for count in [0, samples]:
+    outputname = "bench_procstat.strace"
+    subprocess.call(["strace", "-c", "-o", outputname, sys.executable,
+        sys.argv[0], "--only", name, str(count)])
+    total = 0
+    for line in open(outputname):
+      if line.strip().endswith("total"):
+        total = int(line.split()[2])
+    os.remove(outputname)
+    counts.append(total)
+
+  return (counts[1] - counts[0]) / float(samples)
+
+
+
+def main():
+  samples = 100000
+
+  # Sample without printing, to be counted by strace
+  if len(sys.argv) > 2 and sys.argv[1] == "--only":
+    _run(METHODS[sys.argv[2]], int(sys.argv[3]))
+    return
+
+  if len(sys.argv) > 1:
+    samples = int(sys.argv[1])
+
+  havestrace = False
+  for directory in os.environ.get("PATH", "").split(os.pathsep):
+    if os.path.exists(os.path.join(directory, "strace")):
+      havestrace = True
+
+  print "%d samples of this process's CPU time and RSS" % samples
+  for name in ["old", "new"]:
+    (elapsed, reads) = _run(METHODS[name], samples)
+    line = "%-4s %8.3f s  %6.2f us/sample  %5.2f reads/sample" % (name, elapsed,
+        elapsed * 1000000.0 / samples, reads / float(samples))
+    if havestrace:
+      line += "  %5.2f syscalls/sample" % _strace_syscalls(name, samples / 10)
+    print line
+
+  if not havestrace:
+    print "Install strace to count all system calls (the old way also opens and closes the file)."
+
+
+
+if __name__ == '__main__':
+  main()
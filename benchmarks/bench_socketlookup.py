@@ -0,0 +1,83 @@
+"""
+<Program Name>
+  bench_socketlookup.py
+
+<Purpose>
+  Compares the cost of the checks emulcomm makes when a socket can't be
+  bound on Linux: nix_common_api runs netstat and greps its output, and
+  linux_api reads /proc/net/tcp and /proc/net/udp and keeps what it read
+  for linux_api.SOCKET_TABLE_MAX_AGE.
+
+  It listens on a TCP socket and connects to it, then prints the
+  microseconds per check for the listening socket, the connection, and a
+  port nothing uses, for which linux_api always reads a new table.
+
+  Run this from a built RUNNABLE directory, e.g.
+    python bench_socketlookup.py [checks]
+"""
+
+import sys
+import time
+import socket
+
+import nix_common_api
+import linux_api
+
+
+
+def _run(checkfunc, args, checks):
+  start = time.time()
+  for junk in xrange(checks):
+    checkfunc(*args)
+  return time.time() - start
+
+
+
+def main():
+  checks = 1000
+  if len(sys.argv) > 1:
+    checks = int(sys.argv[1])
+
+  listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listensock.bind(("127.0.0.1", 0))
+  listensock.listen(1)
+  listenport = listensock.getsockname()[1]
+
+  connsock = socket.create_connection(("127.0.0.1", listenport))
+  connport = connsock.getsockname()[1]
+
+  # A port that nothing should be bound to
+  unusedsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  unusedsock.bind(("127.0.0.1", 0))
+  unusedport = unusedsock.getsockname()[1]
+  unusedsock.close()
+
+  cases = [
+      ("listening", "exists_listening_network_socket",
+          ("127.0.0.1", listenport, True)),
+      ("connected", "exists_outgoing_network_socket",
+          ("127.0.0.1", connport, "127.0.0.1", listenport)),
+      ("unused", "exists_listening_network_socket",
+          ("127.0.0.1", unusedport, True))]
+
+  print "microseconds per check"
+  for (name, funcname, args) in cases:
+    line = "%-10s" % name
+    for module in [nix_common_api, linux_api]:
+      checkfunc = getattr(module, funcname)
+      # netstat is much slower, so run it less
+      if module is nix_common_api:
+        count = max(checks / 100, 1)
+      else:
+        count = checks
+      elapsed = _run(checkfunc, args, count)
+      line += "  %s %10.1f" % (module.__name__, elapsed * 1000000.0 / count)
+    print line
+
+  connsock.close()
+  listensock.close()
+
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,107 @@
+"""
+<Program Name>
+  bench_tattle.py
+
+<Purpose>
+  Measures how many nanny tattle calls per second the resource accounting
+  can handle.   The limits are set high enough that no call ever sleeps, so 
+  this only measures the accounting overhead (locks, clock reads, table 
+  lookups).
+
+  Run this from a built RUNNABLE directory, e.g.
+    python bench_tattle.py [threads] [calls per thread]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+
+# nonportable has to be imported before nanny, which imports it
+import nonportable
+import nanny
+
+
+# Renewable resources get limits nobody will reach during the benchmark
+BENCHMARK_RESOURCES = """
+resource cpu 1.0
+resource memory 100000000
+resource diskused 100000000
+resource events 1000
+resource filewrite 1e15
+resource fileread 1e15
+resource filesopened 1000
+resource insockets 1000
+resource outsockets 1000
+resource netsend 1e15
+resource netrecv 1e15
+resource loopsend 1e15
+resource looprecv 1e15
+resource lograte 1e15
+resource random 1e15
+"""
+
+
+def _tattle_quantity_loop(callcount):
+  for junk in xrange(callcount):
+    nanny.tattle_quantity('netrecv', 1024)
+
+
+def _tattle_quantities_loop(callcount):
+  for junk in xrange(callcount):
+    nanny.tattle_quantities({'netrecv': 1024, 'netsend': 64})
+
+
+def _item_loop(callcount):
+  for count in xrange(callcount):
+    nanny.tattle_add_item('filesopened', count)
+    nanny.tattle_remove_item('filesopened', count)
+
+
+def _run_threads(function, threadcount, callsperthread):
+  threadlist = []
+  for junk in range(threadcount):
+    threadlist.append(threading.Thread(target=function, args=(callsperthread,)))
+
+  start = time.time()
+  for thread in threadlist:
+    thread.start()
+  for thread in threadlist:
+    thread.join()
+
+  return time.time() - start
+
+
+
+def main():
+  threadcount = 1
+  callsperthread = 100000
+
+  if len(sys.argv) > 1:
+    threadcount = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    callsperthread = int(sys.argv[2])
+
+  (fd, resourcefilename) = tempfile.mkstemp()
+  os.write(fd, BENCHMARK_RESOURCES)
+  os.close(fd)
+  try:
+    nanny.start_resource_nanny(resourcefilename)
+  finally:
+    os.remove(resourcefilename)
+
+  totalcalls = threadcount * callsperthread
+
+  print "%d threads, %d calls each" % (threadcount, callsperthread)
+  for (name, function) in [("tattle_quantity", _tattle_quantity_loop),
+      ("tattle_quantities", _tattle_quantities_loop),
+      ("add/remove_item", _item_loop)]:
+    elapsed = _run_threads(function, threadcount, callsperthread)
+    print "%-18s %10.0f calls/s  %6.2f us/call" % (name,
+        totalcalls / elapsed, elapsed * 1000000.0 / totalcalls)
+
+
+
+if __name__ == '__main__':
+  main()
@@ -221,6 +221,25 @@ def get_process_rss(force_update=False,pid=None):
   return rss
 
 
+def get_process_cpu_time_and_rss(pid):
+  """
+  <Purpose>
+    Returns the total CPU time and the Resident Set Size of a process, from
+    a single query.
+    
+  <Arguments>
+    pid: The process identifier for the process to query.
+  
+  <Exceptions>
+    See _get_proc_info_by_pid.
+  
+  <Returns>
+    A tuple (total cpu time, RSS in bytes).
+  """
+  # get_process_cpu_time updates the info that get_process_rss uses
+  return (get_process_cpu_time(pid), get_process_rss())
+
+
 # Get the CPU time of the current thread
 def get_current_thread_cpu_time():
   """
@@ -84,6 +84,17 @@ user_specified_ip_interface_list = []
 allowediplist = []
 cachelock = threading.Lock()  # This allows only a single simultaneous cache update
 
+# When (in getruntime() seconds) allowediplist was last updated, or None if
+# it never was.   It is updated again after repy_constants.IP_CACHE_MAX_AGE.
+allowediplist_updatetime = None
+
+# getmyip() keeps the IP it found (or None if it found none) as the tuple 
+# (IP, getruntime() it was found), or None before it first looks.   It is
+# looked up again in the background after repy_constants.MYIP_REFRESH_AGE,
+# and while the caller waits after repy_constants.MYIP_MAX_AGE.
+myip_cache = None
+myiplock = threading.Lock()  # Held while the IP is looked up
+
 # Trying to send a UDP datagram of more than MAX_ALLOWABLE_DGRAM_SIZE
 # bytes will generate uncatchable exceptions on Mac OS X, see
 # SeattleTestbed/repy_v2#113.
@@ -137,10 +148,20 @@ def _unique_append(lst, elem):
   if elem not in lst:
     lst.append(elem)
       
+# Is the allowed IP cache younger than IP_CACHE_MAX_AGE?
+def _ip_cache_is_current():
+  updatetime = allowediplist_updatetime
+  return updatetime is not None and \
+      nonportable.getruntime() - updatetime < repy_constants.IP_CACHE_MAX_AGE
+
+
 # This function updates the allowed IP cache
 # It iterates through all possible IP's and stores ones which are bindable as part of the allowediplist
+# It does nothing if the cache was updated less than IP_CACHE_MAX_AGE 
+# seconds ago
 def update_ip_cache():
   global allowediplist
+  global allowediplist_updatetime
   global user_ip_interface_preferences
   global user_specified_ip_interface_list
   global allow_nonspecified_ips
@@ -148,12 +169,20 @@ def update_ip_cache():
   # If there is no preference, this is a no-op
   if not user_ip_interface_preferences:
     return
+
+  # Don't wait for the lock if there is nothing to do
+  if _ip_cache_is_current():
+    return
     
   # Acquire the lock to update the cache
   cachelock.acquire()
   
   # If there is any exception release the cachelock
   try:  
+    # Another thread may have updated it while we waited
+    if _ip_cache_is_current():
+      return
+
     # Stores the IP's
     allowed_list = []
   
@@ -194,6 +223,7 @@ def update_ip_cache():
   
     # Update the global cache
     allowediplist = bindable_list
+    allowediplist_updatetime = nonportable.getruntime()
   
   finally:      
     # Release the lock
@@ -663,8 +693,7 @@ def gethostbyname(name):
 
   # charge 4K for a look up...   I don't know the right number, but we should
   # charge something.   We'll always charge to the netsend interface...
-  nanny.tattle_quantity('netsend', 1024) 
-  nanny.tattle_quantity('netrecv', 4096)
+  nanny.tattle_quantities({'netsend': 1024, 'netrecv': 4096})
 
   try:
     return socket.gethostbyname(name)
@@ -678,7 +707,8 @@ def getmyip():
   """
    <Purpose>
       Provides the IP of this computer on its public facing interface.  
-      Does some clever trickery. 
+      Does some clever trickery.   The IP is cached, and looked up again
+      in the background once it is MYIP_REFRESH_AGE seconds old.
 
    <Arguments>
       None
@@ -687,7 +717,7 @@ def getmyip():
       InternetConnectivityError is the host is not connected to the internet.
 
    <Side Effects>
-      None.
+      May start a thread that looks up the IP again.
 
    <Resource Consumption>
       This operations consumes 256 netsend and 128 netrecv.
@@ -696,11 +726,8 @@ def getmyip():
       The localhost's IP address
   """
   # Charge for the resources
-  nanny.tattle_quantity("netsend", 256)
-  nanny.tattle_quantity("netrecv", 128)
+  nanny.tattle_quantities({'netsend': 256, 'netrecv': 128})
 
-  # I got some of this from: http://groups.google.com/group/comp.lang.python/browse_thread/thread/d931cdc326d7032b?hl=en
-  
   # Update the cache and return the first allowed IP
   # Only if a preference is set
   if user_ip_interface_preferences:
@@ -708,6 +735,56 @@ def getmyip():
     # Return the first allowed ip, there is always at least 1 element (loopback)
     return allowediplist[0]
 
+  cached = myip_cache
+  if cached is None or nonportable.getruntime() - cached[1] >= repy_constants.MYIP_MAX_AGE:
+    # Too old to use, look it up now
+    myiplock.acquire()
+    try:
+      # Another thread may have looked it up while we waited
+      cached = myip_cache
+      if cached is None or nonportable.getruntime() - cached[1] >= repy_constants.MYIP_MAX_AGE:
+        cached = _update_myip_cache()
+    finally:
+      myiplock.release()
+
+  elif nonportable.getruntime() - cached[1] >= repy_constants.MYIP_REFRESH_AGE:
+    # Use it, but look it up again for the next call, unless that is
+    # already happening
+    if myiplock.acquire(False):
+      try:
+        refreshthread = threading.Thread(target=_refresh_myip_cache, name="MyIPRefresher")
+        refreshthread.setDaemon(True)
+        refreshthread.start()
+      except:
+        myiplock.release()
+        raise
+
+  if cached[0] is None:
+    # We must not be connected to the internet
+    raise InternetConnectivityError("Cannot detect a connection to the Internet.")
+
+  return cached[0]
+
+
+
+def _lookup_myip():
+  """
+  <Purpose>
+    Finds the IP this computer uses to reach the internet.   This is the
+    slow part of getmyip(), which takes up to a second for each of the 
+    STABLE_PUBLIC_IPS when the host is offline.
+
+  <Arguments>
+    None
+
+  <Exceptions>
+    None.
+
+  <Returns>
+    The IP address, or None if there is no connection to the internet.
+  """
+  # I got some of this from: http://groups.google.com/group/comp.lang.python/browse_thread/thread/d931cdc326d7032b?hl=en
+  
   # Initialize these to None, so we can detect a failure
   myip = None
   
@@ -735,8 +812,26 @@ def getmyip():
 
 
   # Since we haven't returned yet, we must have failed.
-  # Raise an exception, we must not be connected to the internet
-  raise InternetConnectivityError("Cannot detect a connection to the Internet.")
+  return None
+
+
+
+def _update_myip_cache():
+  # Looks up the IP, and caches and returns the (IP, time) tuple.   The
+  # caller must hold myiplock.
+  global myip_cache
+
+  myip_cache = (_lookup_myip(), nonportable.getruntime())
+  return myip_cache
+
+
+
+def _refresh_myip_cache():
+  # Runs in a thread started by getmyip(), which acquired myiplock for it
+  try:
+    _update_myip_cache()
+  finally:
+    myiplock.release()
 
 
 
@@ -1370,11 +1465,9 @@ def openconnection(destip, destport,localip, localport, timeout):
   
   # Wait for netsend / netrecv
   if _is_loopback_ipaddr(destip):
-    nanny.tattle_quantity('loopsend', 0)
-    nanny.tattle_quantity('looprecv', 0)
+    nanny.tattle_quantities({'loopsend': 0, 'looprecv': 0})
   else:
-    nanny.tattle_quantity('netsend', 0)
-    nanny.tattle_quantity('netrecv', 0)
+    nanny.tattle_quantities({'netsend': 0, 'netrecv': 0})
 
   try:
     # To Know if remote IP is on loopback or not
@@ -1410,11 +1503,9 @@ def openconnection(destip, destport,localip, localport, timeout):
 
   # Tattle the resources used
   if _is_loopback_ipaddr(destip):
-    nanny.tattle_quantity('loopsend', 128)
-    nanny.tattle_quantity('looprecv', 64)
+    nanny.tattle_quantities({'loopsend': 128, 'looprecv': 64})
   else:
-    nanny.tattle_quantity('netsend', 128)
-    nanny.tattle_quantity('netrecv', 64)
+    nanny.tattle_quantities({'netsend': 128, 'netrecv': 64})
 
   # Return the EmulatedSocket
   return emul_sock
@@ -1641,7 +1732,10 @@ class EmulatedSocket:
   #              this is used for resource accounting.
   # sock_lock: Threading Lock on socket object used for 
   #            synchronization.
-  __slots__ = ["socketobj", "send_buffer_size", "on_loopback", "sock_lock"]
+  # tattler: charges the network resources for recv / send, using leases
+  #          if the socket is used in a tight loop.
+  __slots__ = ["socketobj", "send_buffer_size", "on_loopback", "sock_lock",
+      "tattler"]
 
   
   def __init__(self, sock, on_loopback):
@@ -1663,6 +1757,7 @@ class EmulatedSocket:
       A EmulatedSocket object.
     """
     # Store the parameters tuple
+    self.tattler = nanny.LeasedTattler()
     self.socketobj = sock
     self.on_loopback = on_loopback
     self.sock_lock = threading.Lock()
@@ -1696,6 +1791,9 @@ class EmulatedSocket:
     # Replace the socket
     self.socketobj = None
 
+    # Give back any network resources we leased but didn't use
+    self.tattler.release()
+
 
   def close(self):
     """
@@ -1727,11 +1825,9 @@ class EmulatedSocket:
       return False
     # Wait for resources
     if self.on_loopback:
-      nanny.tattle_quantity('looprecv', 0)
-      nanny.tattle_quantity('loopsend', 0)
+      nanny.tattle_quantities({'looprecv': 0, 'loopsend': 0})
     else:
-      nanny.tattle_quantity('netrecv', 0)
-      nanny.tattle_quantity('netsend', 0)
+      nanny.tattle_quantities({'netrecv': 0, 'netsend': 0})
 
     # Acquire the lock
     socket_lock.acquire()
@@ -1741,11 +1837,9 @@ class EmulatedSocket:
 
       # Tattle the resources
       if self.on_loopback:
-        nanny.tattle_quantity('looprecv',64)
-        nanny.tattle_quantity('loopsend',128)
+        nanny.tattle_quantities({'looprecv': 64, 'loopsend': 128})
       else:
-        nanny.tattle_quantity('netrecv',64)
-        nanny.tattle_quantity('netsend',128)
+        nanny.tattle_quantities({'netrecv': 64, 'netsend': 128})
 
       # Done
       return True
@@ -1785,11 +1879,9 @@ class EmulatedSocket:
     socket_lock = self.sock_lock
     # Wait if already oversubscribed
     if self.on_loopback:
-      nanny.tattle_quantity('looprecv',0)
-      nanny.tattle_quantity('loopsend',0)
+      self.tattler.tattle_quantities({'looprecv': 0, 'loopsend': 0})
     else:
-      nanny.tattle_quantity('netrecv',0)
-      nanny.tattle_quantity('netsend',0)
+      self.tattler.tattle_quantities({'netrecv': 0, 'netsend': 0})
 
 
     # Acquire the socket lock
@@ -1811,11 +1903,9 @@ class EmulatedSocket:
         raise SocketClosedRemote("The socket has been closed remotely!")
 
       if self.on_loopback:
-        nanny.tattle_quantity('looprecv',data_length+64)
-        nanny.tattle_quantity('loopsend',64)
+        self.tattler.tattle_quantities({'looprecv': data_length+64, 'loopsend': 64})
       else:
-        nanny.tattle_quantity('netrecv',data_length+64)
-        nanny.tattle_quantity('netsend',64)
+        self.tattler.tattle_quantities({'netrecv': data_length+64, 'netsend': 64})
 
       return data_recieved
 
@@ -1875,11 +1965,9 @@ class EmulatedSocket:
     socket_lock = self.sock_lock
     # Wait if already oversubscribed
     if self.on_loopback:
-      nanny.tattle_quantity('loopsend',0)
-      nanny.tattle_quantity('looprecv',0)
+      self.tattler.tattle_quantities({'loopsend': 0, 'looprecv': 0})
     else:
-      nanny.tattle_quantity('netsend',0)
-      nanny.tattle_quantity('netrecv',0)
+      self.tattler.tattle_quantities({'netsend': 0, 'netrecv': 0})
 
     # Trim the message size to be less than the send buffer size.
     # This is a fix for http://support.microsoft.com/kb/823764
@@ -1910,11 +1998,9 @@ class EmulatedSocket:
       bytes_sent = sock.send(message)
       
       if self.on_loopback:
-        nanny.tattle_quantity('looprecv', 64)
-        nanny.tattle_quantity('loopsend', 64 + bytes_sent)
+        self.tattler.tattle_quantities({'looprecv': 64, 'loopsend': 64 + bytes_sent})
       else:
-        nanny.tattle_quantity('netrecv', 64)
-        nanny.tattle_quantity('netsend', 64 + bytes_sent)
+        self.tattler.tattle_quantities({'netrecv': 64, 'netsend': 64 + bytes_sent})
 
       # Return the number of bytes sent
       return bytes_sent
@@ -2214,11 +2300,9 @@ class TCPServerSocket (object):
 
     # Wait for netsend and netrecv resources
     if self.on_loopback:
-      nanny.tattle_quantity('looprecv',0)
-      nanny.tattle_quantity('loopsend',0)
+      nanny.tattle_quantities({'looprecv': 0, 'loopsend': 0})
     else:
-      nanny.tattle_quantity('netrecv',0)
-      nanny.tattle_quantity('netsend',0)
+      nanny.tattle_quantities({'netrecv': 0, 'netsend': 0})
 
     # Acquire the lock
     socket_lock.acquire()
@@ -2241,11 +2325,9 @@ class TCPServerSocket (object):
       is_on_loopback = _is_loopback_ipaddr(remote_ip)
       # Do some resource accounting
       if self.on_loopback:
-        nanny.tattle_quantity('looprecv', 128)
-        nanny.tattle_quantity('loopsend', 64)
+        nanny.tattle_quantities({'looprecv': 128, 'loopsend': 64})
       else:
-        nanny.tattle_quantity('netrecv', 128)
-        nanny.tattle_quantity('netsend', 64)
+        nanny.tattle_quantities({'netrecv': 128, 'netsend': 64})
 
       try:
         nanny.tattle_add_item('outsockets', new_sockid)
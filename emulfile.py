@@ -241,7 +241,10 @@ class emulated_file (object):
   # fobj is the actual underlying file-object from python.
   # seek_lock is a Lock object to serialize seeking
   # size is the byte size of the file, to detect seeking past the end.
-  __slots__ = ["filename", "abs_filename", "fobj", "seek_lock", "filesize"]
+  # tattler charges fileread / filewrite, using leases if the file is 
+  # read or written in a tight loop.
+  __slots__ = ["filename", "abs_filename", "fobj", "seek_lock", "filesize",
+      "tattler"]
 
   def __init__(self, filename, create):
     """
@@ -256,6 +259,7 @@ class emulated_file (object):
     self.fobj = None
     self.seek_lock = threading.Lock()
     self.filesize = 0
+    self.tattler = nanny.LeasedTattler()
 
     # raise an RepyArgumentError if the filename isn't valid
     _assert_is_allowed_filename(filename)
@@ -353,6 +357,9 @@ class emulated_file (object):
       # Remove this file from the list of open files
       OPEN_FILES.remove(self.filename)
 
+      # Give back any fileread / filewrite we leased but didn't use
+      self.tattler.release()
+
     finally:
       # Release the two locks we hold
       self.seek_lock.release()
@@ -408,7 +415,7 @@ class emulated_file (object):
       fobj.seek(offset)
 
       # Wait for available file read resources
-      nanny.tattle_quantity('fileread',0)
+      self.tattler.tattle_quantity('fileread',0)
 
       if sizelimit != None:
         # Read the data
@@ -428,7 +435,7 @@ class emulated_file (object):
       disk_blocks_read += 1
 
     # Charge 4K per block
-    nanny.tattle_quantity('fileread', disk_blocks_read*4096)
+    self.tattler.tattle_quantity('fileread', disk_blocks_read*4096)
 
     # Return the data
     return data
@@ -482,7 +489,7 @@ class emulated_file (object):
       fobj.seek(offset)
 
       # Wait for available file write resources
-      nanny.tattle_quantity('filewrite',0)
+      self.tattler.tattle_quantity('filewrite',0)
 
       # Write the data and flush to disk
       fobj.write(data)
@@ -503,7 +510,7 @@ class emulated_file (object):
       disk_blocks_written += 1
 
     # Charge 4K per block
-    nanny.tattle_quantity('filewrite', disk_blocks_written*4096)
+    self.tattler.tattle_quantity('filewrite', disk_blocks_written*4096)
 
 
   def __del__(self):
@@ -23,7 +23,7 @@
 import nanny
 import os               # for os.urandom(7)
 import tracebackrepy    # for os.urandom so exception can be logged internally
-import nonportable      # for getruntime
+import nonportable      # for getruntime and get_resource_version
 import harshexit        # for harshexit()
 import threading        # for Lock()
 import thread           # to catch thread.error
@@ -94,6 +94,82 @@ def getruntime():
   return nonportable.getruntime()
 
 
+def getresourcewait(resource, quantity):
+  """
+   <Purpose>
+      Tells the program how long a charge of a renewable resource (like 
+      'netsend' or 'filewrite') would block right now.   Nothing is consumed,
+      so the program can defer work or pick a smaller size instead of 
+      sleeping.
+
+   <Arguments>
+      resource:
+         The name of the renewable resource.
+      quantity:
+         The amount of the resource that would be used.
+
+   <Exceptions>
+      RepyArgumentError if the resource isn't renewable.
+      ResourceForbiddenError if the resource's limit is 0 and the charge 
+      would need to wait.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      The estimated wait in seconds as a float.   This is 0.0 if the charge 
+      would not block.   Other threads may use the resource before this 
+      program does, so this is only an estimate.
+  """
+  return nanny.get_resource_wait(resource, quantity)
+
+
+def getresourcehistory():
+  """
+   <Purpose>
+      Tells the program how fast it has been using its renewable resources
+      (other than CPU) recently, so it can pace itself.
+
+   <Arguments>
+      None.
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A dict mapping each renewable resource name to a dict of rates.   The
+      rates dict maps 1, 10 and 60 (seconds) to the average amount of the 
+      resource used per second over that many of the most recent seconds.
+  """
+  return nanny.get_resource_history()
+
+
+def getresourceversion():
+  """
+   <Purpose>
+      Tells the program whether what getresources() returns has changed, 
+      without building it.   A program that checks its resource use in a 
+      loop can skip calling getresources() while this stays the same.
+
+   <Arguments>
+      None.
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      An int that changes whenever what getresources() returns does (other
+      than 'threadcpu').
+  """
+  return nonportable.get_resource_version()
+
+
 def exitall():
   """
    <Purpose>
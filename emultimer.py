@@ -109,8 +109,12 @@ def createthread(function):
   eventhandle = EVENT_PREFIX + idhelper.getuniqueid()
   nanny.tattle_add_item('events', eventhandle)
 
+  # The new thread is charged to the same sub-quotas as this one
+  quotas = nanny.get_thread_quotas()
+
   # Wrap the provided function
   def wrapped_func():
+    nanny.set_thread_quotas(quotas)
     try:
       function()
     except:
@@ -118,6 +122,8 @@ def createthread(function):
       tracebackrepy.handle_exception()
       harshexit.harshexit(30)
     finally: 
+      # Let the ledger (if any) fold my entry in with other finished threads
+      nanny.retire_ledger_thread()
       # Remove the event before I exit
       nanny.tattle_remove_item('events',eventhandle)
 
@@ -37,6 +37,10 @@ osrealtype = None
 # global   (the purpose of this is described below)
 statusexiting = [False]
 
+# functions (taking no arguments) to call the first time harshexit is called,
+# before we die.   Exceptions they raise are ignored.
+exitfunctions = []
+
 
 
 class UnsupportedSystemException(Exception):
@@ -111,6 +115,13 @@ def harshexit(val):
 
     # We intentionally do not release the lock.   We don't want anyone else 
     # writing over our status information (we're killing them).
+
+    # Let anyone who wants to record something on the way out do so
+    for exitfunction in exitfunctions:
+      try:
+        exitfunction()
+      except:
+        pass
     
 
   if ostype == 'Linux':
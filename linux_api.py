@@ -9,7 +9,14 @@ Description:
 
 """
 
+import ctypes       # Allows us to make C calls
+import ctypes.util  # Helps to find the real-time library
+
 import os           # Provides some convenience functions
+import threading    # Each thread keeps its own stat file open
+import socket       # For socket.SOL_SOCKET
+import struct       # Unpacks the peer credentials of a socket
+import errno        # Tells an existing cgroup from other failures
 
 import nix_common_api as nix_api # Import the Common API
 
@@ -25,8 +32,6 @@ if "64" in architecture[0]:
   running_32bit = False
 
 # Manually import the common functions we want
-exists_outgoing_network_socket = nix_api.exists_outgoing_network_socket
-exists_listening_network_socket = nix_api.exists_listening_network_socket
 get_available_interfaces = nix_api.get_available_interfaces
 
 # Libc
@@ -36,13 +41,22 @@ libc = nix_api.libc
 myopen = open # This is an annoying restriction of repy
 syscall = libc.syscall # syscall function
 
+# clock_gettime lives in librt for glibc versions before 2.17
+try:
+  _clock_gettime = libc.clock_gettime
+except AttributeError:
+  _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt")).clock_gettime
+
 # Globals
-last_stat_data = None   # Store the last array of data from _get_proc_info_by_pid
+last_stat_data = None   # Store the last (state, utime, stime, rss) from _get_proc_info_by_pid
 
 # Constants
 JIFFIES_PER_SECOND = 100.0
 PAGE_SIZE = os.sysconf('SC_PAGESIZE')
 
+# Clock id for clock_gettime, see <linux/time.h>
+CLOCK_MONOTONIC = 1
+
 # Get the thread id of the currently executing thread
 if running_32bit:
   GETTID = 224 
@@ -94,28 +108,123 @@ FIELDS = {
 "delayacct_blkio_ticks":40
 }
 
-# Process a /proc/PID/stat or /proc/PID/task/TID/stat file and returns it as an array
-def _process_stat_file(file):
-  # Get the file in proc
-  fileo = myopen(file,"r")
+# Structures
+class timespec(ctypes.Structure):
+  _fields_ = [("tv_sec", ctypes.c_long),
+              ("tv_nsec", ctypes.c_long)]
+
+
+# The list of interface addresses from getifaddrs, see <ifaddrs.h> and 
+# <netinet/in.h>
+class sockaddr(ctypes.Structure):
+  _fields_ = [("sa_family", ctypes.c_ushort),
+              ("sa_data", ctypes.c_char * 14)]
+
+class sockaddr_in(ctypes.Structure):
+  _fields_ = [("sin_family", ctypes.c_ushort),
+              ("sin_port", ctypes.c_ushort),
+              ("sin_addr", ctypes.c_ubyte * 4),
+              ("sin_zero", ctypes.c_char * 8)]
+
+class ifaddrs(ctypes.Structure):
+  pass
+
+ifaddrs._fields_ = [("ifa_next", ctypes.POINTER(ifaddrs)),
+                    ("ifa_name", ctypes.c_char_p),
+                    ("ifa_flags", ctypes.c_uint),
+                    ("ifa_addr", ctypes.POINTER(sockaddr)),
+                    ("ifa_netmask", ctypes.POINTER(sockaddr)),
+                    ("ifa_ifu", ctypes.POINTER(sockaddr)),
+                    ("ifa_data", ctypes.c_void_p)]
+
+_getifaddrs = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).getifaddrs
+_getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(ifaddrs))]
+_getifaddrs.restype = ctypes.c_int
+
+_freeifaddrs = libc.freeifaddrs
+_freeifaddrs.argtypes = [ctypes.POINTER(ifaddrs)]
+_freeifaddrs.restype = None
+
+
+# The stat files are read with pread, so that a file can be kept open and
+# re-read from the start with a single system call
+_pread = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).pread
+_pread.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_long]
+_pread.restype = ctypes.c_long
+
+
+# A stat file is well under this many bytes
+STAT_BUFFER_SIZE = 1024
+
+# (ctypes.create_string_buffer can't be used while user code runs, since it
+# uses the unicode builtin)
+_stat_buffer_type = ctypes.c_char * STAT_BUFFER_SIZE
 
-  # Read in all the data
-  data = fileo.read()
+# The fields we use, counted from the state (the first field after the 
+# command name)
+_STAT_STATE = 0
+_STAT_UTIME = FIELDS["utime"] - FIELDS["state"]
+_STAT_STIME = FIELDS["stime"] - FIELDS["state"]
+_STAT_RSS = FIELDS["rss"] - FIELDS["state"]
 
-  # Close the file object
-  fileo.close()
 
-  # Strip the newline
-  data = data.strip("\n")
+class _StatFile(object):
+  """
+  A /proc/PID/stat or /proc/PID/task/TID/stat file, kept open.   Reading 
+  it again gives the current values.   The file is closed when the object 
+  goes away.
+  """
+
+  __slots__ = ['path', 'fd', 'buffer']
+
+  def __init__(self, path):
+    self.path = path
+    self.fd = None
+    self.fd = os.open(path, os.O_RDONLY)
+    self.buffer = _stat_buffer_type()
+
+  def read(self):
+    """
+    Returns (state, utime, stime, rss) from the file, as a string and 
+    integers.   Raises OSError if the file can't be read (e.g. the process
+    is gone).
+    """
+    length = _pread(self.fd, self.buffer, STAT_BUFFER_SIZE, 0)
+    if length < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), self.path)
+    data = self.buffer.raw[:length]
+
+    # The command name is in parentheses, and may itself have spaces and 
+    # parentheses in it.   Split off just the fields up to the rss.
+    fields = data[data.rindex(")") + 2:].split(" ", _STAT_RSS + 1)
+
+    return (fields[_STAT_STATE], int(fields[_STAT_UTIME]), 
+        int(fields[_STAT_STIME]), int(fields[_STAT_RSS]))
+
+  def close(self, _close=os.close):
+    # (os may already be gone if this is called while python exits)
+    if self.fd is not None:
+      _close(self.fd)
+      self.fd = None
 
-  # Remove the substring that says "(python)", since it changes the field alignment
-  start_index = data.find("(")
-  if start_index != -1:
-    end_index = data.find(")", start_index)
-    data = data[:start_index-1] + data[end_index+1:]
+  def __del__(self):
+    self.close()
 
-  # Break the data into an array by spaces
-  return data.split(" ")
+
+# The open /proc/PID/stat files, by pid.   The lock is held while one is 
+# being read, since they share a buffer.
+_process_stat_files = {}
+_process_stat_files_lock = threading.Lock()
+
+# Each thread keeps its own /proc/PID/task/TID/stat file open, which is 
+# closed when the thread goes away.   (This is used while user code runs, 
+# so it can't use getattr.)
+class _ThreadStatFile(threading.local):
+  statfile = None
+  pid = None
+
+_thread_stat_file = _ThreadStatFile()
 
 
 def _get_proc_info_by_pid(pid):
@@ -125,18 +234,44 @@ def _get_proc_info_by_pid(pid):
   
   <Arguments>
     pid: The process identifier for which data should be fetched.  
+
+  <Returns>
+    The (state, utime, stime, rss) of the process.
   """
   global last_stat_data
 
-  # Get the file in proc
-  file = "/proc/"+str(pid)+"/stat"
-
-  # Process the status file
-  last_stat_data = _process_stat_file(file)
-  
-  # Check the state, raise an exception if the process is a zombie
-  if "Z" in last_stat_data[FIELDS["state"]]:
-    raise Exception, "Queried Process is a zombie (dead)!"
+  _process_stat_files_lock.acquire()
+  try:
+    # The file is kept open for next time.   If the process has gone away
+    # (and the pid may have been reused), the old file can't be read, so 
+    # open it again.
+    statfile = _process_stat_files.get(pid)
+    if statfile is not None:
+      try:
+        statdata = statfile.read()
+      except OSError:
+        statfile.close()
+        del _process_stat_files[pid]
+        statfile = None
+
+    if statfile is None:
+      statfile = _StatFile("/proc/"+str(pid)+"/stat")
+      _process_stat_files[pid] = statfile
+      statdata = statfile.read()
+
+    last_stat_data = statdata
+
+    # Check the state, raise an exception if the process is a zombie
+    if "Z" in statdata[_STAT_STATE]:
+      # It won't be back, so don't keep its file open
+      statfile.close()
+      del _process_stat_files[pid]
+      raise Exception, "Queried Process is a zombie (dead)!"
+
+  finally:
+    _process_stat_files_lock.release()
+
+  return statdata
   
   
 def get_process_cpu_time(pid):
@@ -150,18 +285,12 @@ def get_process_cpu_time(pid):
   <Returns>
     The total cpu time.
   """
-  global last_stat_data
-  
   # Update our data
-  _get_proc_info_by_pid(pid)
-  
-  # Get the raw usertime and system time
-  total_time_raw = int(last_stat_data[FIELDS["utime"]])+int(last_stat_data[FIELDS["stime"]])
+  (state, utime, stime, rss) = _get_proc_info_by_pid(pid)
   
-  # Adjust by the number of jiffies per second
-  total_time = total_time_raw / JIFFIES_PER_SECOND
-  
-  return total_time
+  # Adjust the raw usertime and system time by the number of jiffies per 
+  # second
+  return (utime + stime) / JIFFIES_PER_SECOND
 
 
 def get_process_rss(force_update=False, pid=None):
@@ -188,12 +317,46 @@ def get_process_rss(force_update=False, pid=None):
     # Update the info
     _get_proc_info_by_pid(pid)
 
-  # Fetch the RSS, convert to an integer
-  rss_pages = int(last_stat_data[FIELDS["rss"]])
-  rss_bytes = rss_pages * PAGE_SIZE
+  # Convert the RSS in pages to bytes
+  (state, utime, stime, rss) = last_stat_data
+  return rss * PAGE_SIZE
+
+
+def close_process_stat_file(pid):
+  """
+  <Purpose>
+    Closes the stat file kept open for a process, once it is no longer 
+    going to be queried.
+
+  <Arguments>
+    pid: The process identifier.
+
+  <Returns>
+    None.
+  """
+  _process_stat_files_lock.acquire()
+  try:
+    if pid in _process_stat_files:
+      _process_stat_files.pop(pid).close()
+  finally:
+    _process_stat_files_lock.release()
+
 
-  # Return the info
-  return rss_bytes
+def get_process_cpu_time_and_rss(pid):
+  """
+  <Purpose>
+    Returns the total CPU time and the Resident Set Size of a process, from
+    a single read of its stat file.   Unlike get_process_rss(), this does 
+    not depend on what other threads read last.
+    
+  <Arguments>
+    pid: The process identifier for the process to query.
+  
+  <Returns>
+    A tuple (total cpu time, RSS in bytes).
+  """
+  (state, utime, stime, rss) = _get_proc_info_by_pid(pid)
+  return ((utime + stime) / JIFFIES_PER_SECOND, rss * PAGE_SIZE)
 
 
 # Get the id of the currently executing thread
@@ -214,26 +377,22 @@ def get_current_thread_cpu_time():
   <Returns>
     A floating amount of time in seconds.
   """
-  # Get the thread id
-  thread_id = _get_current_thread_id()
-
-  # Get our pid
+  # Open the file with our status the first time.   (A forked child has a 
+  # thread of its own, so check that the file is ours.)
   pid = os.getpid()
-
-  # Get the file with our status
-  file = "/proc/"+str(pid)+"/task/"+str(thread_id)+"/stat"
-
-  # Process the status file
-  thread_stat_data = _process_stat_file(file)
+  statfile = _thread_stat_file.statfile
+  if statfile is None or _thread_stat_file.pid != pid:
+    # Get the thread id
+    thread_id = _get_current_thread_id()
+    statfile = _StatFile("/proc/"+str(pid)+"/task/"+str(thread_id)+"/stat")
+    _thread_stat_file.statfile = statfile
+    _thread_stat_file.pid = pid
 
   # Get the raw usertime and system time
-  total_time_raw = int(thread_stat_data[FIELDS["utime"]])+int(thread_stat_data[FIELDS["stime"]])
+  (state, utime, stime, rss) = statfile.read()
   
   # Adjust by the number of jiffies per second
-  total_time = total_time_raw / JIFFIES_PER_SECOND
-
-  # Return the total time
-  return total_time
+  return (utime + stime) / JIFFIES_PER_SECOND
 
 
 def get_system_uptime():
@@ -264,6 +423,32 @@ def get_system_uptime():
   else:
     raise Exception, "Could not find /proc/uptime!"
   
+def get_monotonic_time():
+  """
+  <Purpose>
+    Returns the value of the system's monotonic clock (CLOCK_MONOTONIC).
+    This clock is not affected by NTP steps or changes to the wall clock,
+    and reading it requires neither a lock nor a read from /proc.
+
+  <Exception>
+    Raises Exception if the underlying clock_gettime call fails.
+
+  <Returns>
+    The monotonic time in seconds, as a float. Only differences between
+    two values are meaningful.
+  """
+  # Allocate a structure per call, so concurrent callers never share one
+  time_struct = timespec()
+
+  # Make the call
+  result = _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(time_struct))
+
+  if result != 0:
+    raise Exception, "clock_gettime(CLOCK_MONOTONIC) failed!"
+
+  return time_struct.tv_sec + time_struct.tv_nsec / 1000000000.0
+
+
 def get_uptime_granularity():
   """
   <Purpose>
@@ -326,34 +511,505 @@ def get_interface_ip_addresses(interfaceName):
   
   <Arguments>
     interfaceName: The string name of the interface, e.g. eth0
+
+  <Exceptions>
+    Raises Exception if the addresses can't be listed.
   
   <Returns>
     A list of IP addresses associated with the interface.
   """
+  interfaceName = interfaceName.strip()
 
-  # Launch up a shell, get the feed back
-  # We use ifconfig with the interface name.
-  ifconfig_process = portable_popen.Popen(["/sbin/ifconfig", interfaceName.strip()])
-
-  ifconfig_output, _ = ifconfig_process.communicate()
-  ifconfig_lines = textops.textops_rawtexttolines(ifconfig_output)
-  
-  # Look for ipv4 addresses
-  target_lines = textops.textops_grep("inet", ifconfig_lines)
-  # and not ipv6
-  target_lines = textops.textops_grep("inet6", target_lines, exclude=True)
-
-  # Only take the ip(s)
-  target_lines = textops.textops_cut(target_lines, delimiter=":", fields=[1])
-  target_lines = textops.textops_cut(target_lines, delimiter=" ", fields=[0])
+  # Ask the C library for every address of every interface, rather than 
+  # run ifconfig
+  addresses = ctypes.POINTER(ifaddrs)()
+  if _getifaddrs(ctypes.byref(addresses)) != 0:
+    raise Exception, "getifaddrs failed! Errno: " + str(ctypes.get_errno())
 
   # Create an array for the ip's
   ipaddressList = []
-  
-  for line in target_lines:
-     # Strip the newline and any spacing
-     line = line.strip("\n\t ")
-     ipaddressList.append(line)
+
+  try:
+    address = addresses
+    while address:
+      entry = address.contents
+      # Look for ipv4 addresses of the interface.   (Interfaces without an
+      # address are listed with none.)
+      if entry.ifa_name == interfaceName and entry.ifa_addr and \
+          entry.ifa_addr.contents.sa_family == socket.AF_INET:
+        ip = ctypes.cast(entry.ifa_addr, ctypes.POINTER(sockaddr_in)).contents.sin_addr
+        ipaddressList.append("%d.%d.%d.%d" % tuple(ip))
+      address = entry.ifa_next
+  finally:
+    _freeifaddrs(addresses)
 
   # Done, return the interfaces
   return ipaddressList
+
+
+
+# The kernel's tables of sockets, see proc(5).   The tcp6 and udp6 tables
+# don't exist if the kernel has no IPv6.
+PROC_NET_FILES = {"tcp":["/proc/net/tcp", "/proc/net/tcp6"],
+    "udp":["/proc/net/udp", "/proc/net/udp6"]}
+
+# netstat's names for the TCP states in the tables, see <net/tcp_states.h>
+TCP_STATES = {"01":"ESTABLISHED", "02":"SYN_SENT", "03":"SYN_RECV",
+    "04":"FIN_WAIT1", "05":"FIN_WAIT2", "06":"TIME_WAIT", "07":"CLOSE",
+    "08":"CLOSE_WAIT", "09":"LAST_ACK", "0A":"LISTEN", "0B":"CLOSING"}
+TCP_LISTEN = "0A"
+
+# How long (in seconds) a table that was read may be used to find a
+# socket.   Several connections failing at once then read the table once.
+# A socket that isn't in a table that old is looked for in a new one.
+SOCKET_TABLE_MAX_AGE = .05
+
+# Maps "tcp" and "udp" to (the monotonic time it was read, the table)
+_socket_tables = {}
+
+
+def _get_socket_table_keys(ip, port):
+  # The tables list an address as its bytes read as 32-bit words in the
+  # machine's byte order, in hex, followed by the port in hex.   Make the
+  # ways the IPv4 address can be listed, rather than parse every address in
+  # the tables.   (A socket that accepts IPv4 and IPv6 has the IPv4 address
+  # mapped into IPv6.)   Raises socket.error if ip isn't an IPv4 address.
+  ipbytes = socket.inet_aton(ip)
+  mappedbytes = "\0" * 10 + "\xff\xff" + ipbytes
+  port = "%04X" % port
+
+  ipv4key = "%08X:" % struct.unpack("=I", ipbytes) + port
+  ipv6key = "%08X%08X%08X%08X:" % struct.unpack("=4I", mappedbytes) + port
+  return (ipv4key, ipv6key)
+
+
+def _read_socket_table(protocol):
+  # Returns a dict that maps local addresses to lists of (remote address, 
+  # state) tuples, and keeps it for SOCKET_TABLE_MAX_AGE
+  table = {}
+  for filename in PROC_NET_FILES[protocol]:
+    try:
+      fileobj = myopen(filename, "r")
+    except IOError:
+      if filename.endswith("6"):
+        continue
+      raise
+
+    try:
+      lines = fileobj.readlines()
+    finally:
+      fileobj.close()
+
+    # Skip the header.   The fields start "sl local_address rem_address st"
+    for line in lines[1:]:
+      fields = line.split(None, 4)
+      table.setdefault(fields[1], []).append((fields[2], fields[3]))
+
+  _socket_tables[protocol] = (get_monotonic_time(), table)
+  return table
+
+
+def _search_socket_table(table, localkeys, remotekeys, states):
+  for localkey in localkeys:
+    for (remotekey, state) in table.get(localkey, ()):
+      if remotekeys is not None and remotekey not in remotekeys:
+        continue
+      if states is not None and state not in states:
+        continue
+      return state
+  return None
+
+
+def _find_socket(protocol, localkeys, remotekeys=None, states=None):
+  # Returns the state of a socket with one of the local addresses (and one
+  # of the remote addresses and states, if given), or None.   Raises 
+  # IOError if the table can't be read.
+  cached = _socket_tables.get(protocol)
+  if cached is not None and get_monotonic_time() - cached[0] < SOCKET_TABLE_MAX_AGE:
+    state = _search_socket_table(cached[1], localkeys, remotekeys, states)
+    if state is not None:
+      return state
+
+  table = _read_socket_table(protocol)
+  return _search_socket_table(table, localkeys, remotekeys, states)
+
+
+
+def exists_outgoing_network_socket(localip, localport, remoteip, remoteport):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified unique tuple.
+    Assumes TCP.   Reads the kernel's table of sockets instead of running
+    netstat, unless it can't.
+
+  <Arguments>
+    localip: The IP address of the local socket
+    localport: The port of the local socket
+    remoteip:  The IP of the remote host
+    remoteport: The port of the remote host
+    
+  <Returns>
+    A Tuple, indicating the existence and state of the socket. E.g. (Exists (True/False), State (String or None))
+  """
+  # This only works if all are not of the None type
+  if not (localip and localport and remoteip and remoteport):
+    return (False, None)
+
+  try:
+    localkeys = _get_socket_table_keys(localip, localport)
+    remotekeys = _get_socket_table_keys(remoteip, remoteport)
+    state = _find_socket("tcp", localkeys, remotekeys)
+  except (socket.error, IOError):
+    # Not an IPv4 address, or no /proc
+    return nix_api.exists_outgoing_network_socket(localip, localport, remoteip, remoteport)
+
+  if state is None:
+    return (False, None)
+
+  return (True, TCP_STATES.get(state, state))
+
+
+
+def exists_listening_network_socket(ip, port, tcp):
+  """
+  <Purpose>
+    Determines if there exists a network socket with the specified ip and port which is the LISTEN state.
+    Reads the kernel's table of sockets instead of running netstat, unless
+    it can't.
+  
+  <Arguments>
+    ip: The IP address of the listening socket
+    port: The port of the listening socket
+    tcp: Is the socket of TCP type, else UDP
+    
+  <Returns>
+    True or False.
+  """
+  # This only works if both are not of the None type
+  if not (ip and port):
+    return False
+
+  # UDP connections are stateless, so for TCP check for the LISTEN state
+  # and for UDP, just check that there exists a UDP port
+  if tcp:
+    protocol = "tcp"
+    states = [TCP_LISTEN]
+  else:
+    protocol = "udp"
+    states = None
+
+  try:
+    localkeys = _get_socket_table_keys(ip, port)
+    state = _find_socket(protocol, localkeys, states=states)
+  except (socket.error, IOError):
+    # Not an IPv4 address, or no /proc
+    return nix_api.exists_listening_network_socket(ip, port, tcp)
+
+  return state is not None
+
+
+
+# Socket option to get the credentials of the process on the other end of a 
+# unix domain socket, see <asm-generic/socket.h>.   Python 2 doesn't define
+# it.
+SO_PEERCRED = 17
+
+def get_socket_peer_pid(sock):
+  """
+  <Purpose>
+    Returns the pid of the process on the other end of a connected unix 
+    domain socket, as the kernel saw it when the socket was connected.
+
+  <Arguments>
+    sock: The socket object.
+
+  <Exceptions>
+    socket.error if the socket isn't a connected unix domain socket.
+
+  <Returns>
+    The pid.
+  """
+  # struct ucred is (pid, uid, gid)
+  ucred = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i"))
+  (pid, uid, gid) = struct.unpack("3i", ucred)
+  return pid
+
+
+
+# The sandbox can be put in a cgroup of its own (in the cgroup v2 unified 
+# hierarchy) so that the kernel enforces its CPU and memory limits.   The CPU
+# limit is written to cpu.max as a quota of CPU time per period, in 
+# microseconds.   The kernel needs a quota of at least CGROUP_MIN_CPU_QUOTA, 
+# so the period is stretched (up to CGROUP_MAX_CPU_PERIOD) for small limits.
+CGROUP_CPU_PERIOD = 100000
+CGROUP_MIN_CPU_QUOTA = 1000
+CGROUP_MAX_CPU_PERIOD = 1000000
+
+# The leaf cgroup the monitor moves itself into, so that the cgroup it was
+# in can enable controllers for the sandboxes' cgroups
+CGROUP_MONITOR_NAME = "monitor"
+
+
+def _read_cgroup_file(cgrouppath, filename):
+  fileobj = myopen(os.path.join(cgrouppath, filename))
+  try:
+    return fileobj.read()
+  finally:
+    fileobj.close()
+
+
+def _write_cgroup_file(cgrouppath, filename, data):
+  fileobj = myopen(os.path.join(cgrouppath, filename), "w")
+  try:
+    fileobj.write(data)
+  finally:
+    fileobj.close()
+
+
+# Reads a cgroup file of "key value" lines (like cpu.stat) into a dict
+def _read_cgroup_keyed_file(cgrouppath, filename):
+  values = {}
+  for line in _read_cgroup_file(cgrouppath, filename).split("\n"):
+    fields = line.split()
+    if len(fields) == 2:
+      values[fields[0]] = int(fields[1])
+  return values
+
+
+def _find_own_cgroup():
+  """
+  <Purpose>
+    Finds the cgroup v2 unified hierarchy and this process's cgroup in it.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    EnvironmentError if cgroup v2 isn't mounted or this process isn't in 
+    its hierarchy.
+
+  <Returns>
+    A tuple (the hierarchy's mount point, this process's cgroup), where the
+    cgroup is a path from the mount point, like "/" or "/user.slice".
+  """
+  # Find the unified hierarchy.   (On hybrid systems it isn't at 
+  # /sys/fs/cgroup.)
+  mountpoint = None
+  for line in myopen("/proc/self/mounts"):
+    fields = line.split()
+    if len(fields) >= 3 and fields[2] == "cgroup2":
+      mountpoint = fields[1]
+      break
+
+  if mountpoint is None:
+    raise EnvironmentError, "cgroup v2 is not mounted!"
+
+  # Our cgroup in the unified hierarchy is on the line for hierarchy 0
+  ourcgroup = None
+  for line in myopen("/proc/self/cgroup"):
+    (hierarchy, controllers, path) = line.rstrip("\n").split(":", 2)
+    if hierarchy == "0":
+      ourcgroup = path
+
+  if ourcgroup is None:
+    raise EnvironmentError, "This process is not in a cgroup v2 hierarchy!"
+
+  return (mountpoint, ourcgroup)
+
+
+def create_cgroup(name, pid, cpulimit, memorylimit):
+  """
+  <Purpose>
+    Creates a cgroup with the cpu and memory controllers next to this 
+    process, and moves a process that is in the same cgroup as this one 
+    into it.
+
+    cgroup v2 doesn't let a cgroup other than the root both have processes 
+    and enable controllers for its children.   So unless this process is in
+    the root cgroup, it first moves itself into a leaf cgroup, 
+    CGROUP_MONITOR_NAME, below its cgroup, and the new cgroup is created 
+    next to that.   No other processes may be left in this process's 
+    cgroup.
+
+  <Arguments>
+    name: The name of the new cgroup.
+    pid: The process to move into it, usually forked by this process.
+    cpulimit: The fraction of a CPU the cgroup may use.
+    memorylimit: The number of bytes of memory the cgroup may use.
+
+  <Exceptions>
+    EnvironmentError if cgroup v2 isn't mounted, the cpu and memory 
+    controllers aren't delegated to this process's cgroup, other processes
+    are in it, or the cgroup can't be set up.   Both processes are then 
+    moved back into this process's cgroup.
+
+  <Side Effects>
+    Moves this process into a cgroup of its own.
+
+  <Returns>
+    The path of the new cgroup.
+  """
+  (mountpoint, ourcgroup) = _find_own_cgroup()
+
+  parentpath = mountpoint + ourcgroup.rstrip("/")
+  monitorpath = os.path.join(parentpath, CGROUP_MONITOR_NAME)
+  cgrouppath = os.path.join(parentpath, name)
+
+  try:
+    # Make our cgroup empty.   (The root cgroup may have processes.)
+    if ourcgroup.rstrip("/") != "":
+      try:
+        os.mkdir(monitorpath)
+      except OSError, e:
+        # Another monitor may have created it
+        if e.errno != errno.EEXIST:
+          raise
+      add_process_to_cgroup(monitorpath, os.getpid())
+
+    os.mkdir(cgrouppath)
+    add_process_to_cgroup(cgrouppath, pid)
+
+    # The controllers must be enabled for our children.   The kernel 
+    # refuses this unless they were delegated to us.
+    enabled = _read_cgroup_file(parentpath, "cgroup.subtree_control").split()
+    if "cpu" not in enabled or "memory" not in enabled:
+      _write_cgroup_file(parentpath, "cgroup.subtree_control", "+cpu +memory")
+
+    set_cgroup_limits(cgrouppath, cpulimit, memorylimit)
+
+  except EnvironmentError, e:
+    # Leave things as they were
+    for movedpid in [pid, os.getpid()]:
+      try:
+        add_process_to_cgroup(parentpath, movedpid)
+      except EnvironmentError:
+        pass
+    try:
+      os.rmdir(cgrouppath)
+    except OSError:
+      pass
+
+    raise EnvironmentError, "Can't set up a cgroup with the cpu and memory controllers in '" + parentpath + "' (they must be delegated to it, and it may have no other processes): " + str(e)
+
+  return cgrouppath
+
+
+def set_cgroup_limits(cgrouppath, cpulimit, memorylimit):
+  """
+  <Purpose>
+    Sets the CPU and memory limits of a cgroup.
+
+  <Arguments>
+    cgrouppath: The path of the cgroup.
+    cpulimit: The fraction of a CPU the cgroup may use.
+    memorylimit: The number of bytes of memory the cgroup may use.
+
+  <Exceptions>
+    IOError if the limits can't be written.
+
+  <Returns>
+    None.
+  """
+  period = CGROUP_CPU_PERIOD
+  if cpulimit * period < CGROUP_MIN_CPU_QUOTA:
+    period = min(CGROUP_MAX_CPU_PERIOD, int(CGROUP_MIN_CPU_QUOTA / max(cpulimit, 0.000001)))
+  quota = max(CGROUP_MIN_CPU_QUOTA, int(cpulimit * period))
+
+  _write_cgroup_file(cgrouppath, "cpu.max", str(quota) + " " + str(period))
+  _write_cgroup_file(cgrouppath, "memory.max", str(int(memorylimit)))
+
+  # Otherwise the kernel would swap out memory over the limit rather than 
+  # killing the sandbox.   (There is no swap file if swap accounting is off.)
+  try:
+    _write_cgroup_file(cgrouppath, "memory.swap.max", "0")
+  except IOError:
+    pass
+
+
+def add_process_to_cgroup(cgrouppath, pid):
+  """
+  <Purpose>
+    Moves a process (with all of its threads) into a cgroup.
+
+  <Arguments>
+    cgrouppath: The path of the cgroup.
+    pid: The process id.
+
+  <Exceptions>
+    IOError if the process can't be moved.
+
+  <Returns>
+    None.
+  """
+  _write_cgroup_file(cgrouppath, "cgroup.procs", str(pid))
+
+
+def get_cgroup_cpu_stat(cgrouppath):
+  """
+  <Purpose>
+    Returns the CPU use of a cgroup.
+
+  <Arguments>
+    cgrouppath: The path of the cgroup.
+
+  <Exceptions>
+    IOError if cpu.stat can't be read.
+
+  <Returns>
+    A dict with the fields of cpu.stat, such as 'usage_usec' (the CPU time 
+    used) and 'throttled_usec' (how long the cgroup was throttled), in 
+    microseconds.
+  """
+  return _read_cgroup_keyed_file(cgrouppath, "cpu.stat")
+
+
+def get_cgroup_memory_current(cgrouppath):
+  """
+  <Purpose>
+    Returns the memory use of a cgroup.
+
+  <Arguments>
+    cgrouppath: The path of the cgroup.
+
+  <Exceptions>
+    IOError if memory.current can't be read.
+
+  <Returns>
+    The number of bytes of memory in use.
+  """
+  return int(_read_cgroup_file(cgrouppath, "memory.current"))
+
+
+def get_cgroup_oom_kill_count(cgrouppath):
+  """
+  <Purpose>
+    Returns how many processes in a cgroup the kernel killed for going over
+    the memory limit.
+
+  <Arguments>
+    cgrouppath: The path of the cgroup.
+
+  <Exceptions>
+    IOError if memory.events can't be read.
+
+  <Returns>
+    The number of processes killed.
+  """
+  return _read_cgroup_keyed_file(cgrouppath, "memory.events").get("oom_kill", 0)
+
+
+def remove_cgroup(cgrouppath):
+  """
+  <Purpose>
+    Removes an empty cgroup.
+
+  <Arguments>
+    cgrouppath: The path of the cgroup.
+
+  <Exceptions>
+    OSError if the cgroup still has processes in it.
+
+  <Returns>
+    None.
+  """
+  os.rmdir(cgrouppath)
@@ -0,0 +1,571 @@
+"""
+<Program Name>
+  monitordaemon.py
+
+<Purpose>
+  A resource monitor shared by all the sandboxes on a host.   Normally each
+  repy.py forks a monitor process of its own, which polls its sandbox's
+  CPU, memory and disk use.   A repy.py started with --monitor instead
+  registers with this daemon over a unix domain socket, and the daemon
+  checks every registered sandbox from a single process and thread.
+
+  Each sandbox is treated as its own monitor would treat it.   It is
+  stopped to keep it under its CPU limit, has its resource use published in
+  a stats page (see statspage.py) of its own, and is killed if it uses too
+  much memory or disk.   The sandbox keeps its status files up to date 
+  itself, as on Windows.
+
+  The daemon stops and kills the processes that register with it, so the
+  socket's permissions decide who may register.   Run the daemon as the
+  user the sandboxes run as.   A sandbox that sends something the daemon
+  can't make sense of is no longer monitored (its socket is closed, which
+  makes it exit), but the daemon and the other sandboxes carry on.
+
+<Usage>
+  python monitordaemon.py socketpath
+"""
+
+import os
+import sys
+import errno
+import heapq
+import marshal
+import select
+import signal
+import socket
+
+# nonportable has to be imported before nanny, which imports it
+import nonportable
+import nanny
+import harshexit
+import repy_constants
+import statusstorage
+import statspage
+
+os_api = nonportable.os_api
+getruntime = nonportable.getruntime
+
+
+# How long a sandbox that is over its memory or disk limit has to exit
+# before it is killed
+KILL_GRACE_TIME = 1.0
+
+# The longest message a sandbox may send.   Registrations and limits are 
+# far shorter.
+MAX_MESSAGE_SIZE = 64 * 1024
+
+# How much to read from a socket at a time
+READ_SIZE = 4096
+
+# The kinds of events, in the order they are handled if they are due at the
+# same time
+EVENT_RESUME = 0
+EVENT_CHECK = 1
+EVENT_DISK = 2
+EVENT_KILL = 3
+
+
+
+def parse_messages(buffer):
+  """
+  <Purpose>
+    Splits the messages written by nonportable.write_message_to_pipe() off
+    the front of what has been read from a socket.
+
+  <Arguments>
+    buffer:
+      What has been read from the socket and not parsed yet.
+
+  <Exceptions>
+    ValueError if the buffer doesn't start with a message, or a message is
+    longer than MAX_MESSAGE_SIZE or isn't a marshalled message dict.
+
+  <Returns>
+    A tuple (list of (channel, data) tuples, the rest of the buffer).   The
+    rest is the start of a message that hasn't been read completely.
+  """
+  messages = []
+
+  while True:
+    colonindex = buffer.find(":")
+    if colonindex == -1:
+      # The length of a message can't take more digits than this
+      if len(buffer) > len(str(MAX_MESSAGE_SIZE)):
+        raise ValueError("Message without a length")
+      return (messages, buffer)
+
+    lengthstr = buffer[:colonindex]
+    if not lengthstr.isdigit() or int(lengthstr) > MAX_MESSAGE_SIZE:
+      raise ValueError("Bad message length " + repr(lengthstr[:20]))
+
+    messageend = colonindex + 1 + int(lengthstr)
+    if len(buffer) < messageend:
+      return (messages, buffer)
+
+    try:
+      mesg_dict = marshal.loads(buffer[colonindex + 1:messageend])
+    except (ValueError, EOFError, TypeError):
+      raise ValueError("Message can't be unmarshalled")
+
+    if type(mesg_dict) is not dict or "ch" not in mesg_dict or "d" not in mesg_dict:
+      raise ValueError("Message isn't a message dict")
+
+    messages.append((mesg_dict["ch"], mesg_dict["d"]))
+    buffer = buffer[messageend:]
+
+
+
+def check_limits(limits):
+  """
+  <Purpose>
+    Checks the limits a sandbox sends, as made by
+    nonportable._get_monitored_limits().
+
+  <Arguments>
+    limits:
+      The limits.
+
+  <Exceptions>
+    ValueError unless the cpu, memory and diskused limits are all numbers
+    that aren't negative.
+
+  <Returns>
+    None.
+  """
+  if type(limits) is not dict:
+    raise ValueError("Limits aren't a dict")
+
+  for resource in ['cpu', 'memory', 'diskused']:
+    limit = limits.get(resource)
+    # This is also false for NaN
+    if type(limit) not in [int, long, float] or not limit >= 0:
+      raise ValueError("Bad " + resource + " limit " + repr(limit))
+
+
+
+def check_registration(registration):
+  """
+  <Purpose>
+    Checks a registration, as sent by nonportable.register_with_monitor_daemon().
+
+  <Arguments>
+    registration:
+      The registration.
+
+  <Exceptions>
+    ValueError if anything in it is missing or of the wrong type, or the
+    limits are bad (see check_limits()).
+
+  <Returns>
+    None.
+  """
+  if type(registration) is not dict:
+    raise ValueError("Registration isn't a dict")
+
+  # A pid of 0, -1 or 1 would have the daemon stop process groups, or init
+  pid = registration.get('pid')
+  if type(pid) not in [int, long] or pid <= 1:
+    raise ValueError("Bad pid " + repr(pid))
+
+  if type(registration.get('runtime')) not in [int, long, float]:
+    raise ValueError("Bad runtime " + repr(registration.get('runtime')))
+
+  if type(registration.get('directory')) is not str:
+    raise ValueError("Bad directory " + repr(registration.get('directory')))
+
+  if registration.get('statusprefix') is not None and \
+      type(registration.get('statusprefix')) is not str:
+    raise ValueError("Bad status prefix " + repr(registration.get('statusprefix')))
+
+  check_limits(registration.get('limits'))
+
+
+
+class Sandbox(object):
+  """
+  What the daemon knows about a registered sandbox.   This holds what the
+  locals of nonportable.resource_monitor hold for a forked monitor.
+  """
+
+  __slots__ = ['sock', 'pid', 'limits', 'runtimeoffset', 'directory',
+      'statusprefix', 'statspage', 'statspagepath', 'throttle', 'polling',
+      'diskpolling', 'stopped', 'runtime', 'unreported_stop_time',
+      'unreported_stop_total', 'exceeded']
+
+  def __init__(self, sock, pid, registration):
+    self.sock = sock
+    self.pid = pid
+
+    # The cpu, memory and diskused limits
+    self.limits = registration['limits']
+
+    # The sandbox's getruntime() is this much behind ours
+    self.runtimeoffset = getruntime() - registration['runtime']
+
+    # Where its disk use is measured, and its status files
+    self.directory = registration['directory']
+    self.statusprefix = registration['statusprefix']
+
+    # Where its resource use is published.   The sandbox removes the file 
+    # once it has mapped it.
+    (self.statspage, self.statspagepath) = statspage.create_shared_file()
+
+    self.throttle = nanny.CPUThrottle(repy_constants.CPU_POLLING_FREQ_LINUX)
+    self.polling = nanny.PollingInterval(repy_constants.CPU_POLLING_FREQ_LINUX,
+        repy_constants.MONITOR_POLLING_MAX_LINUX)
+    self.diskpolling = nanny.PollingInterval(repy_constants.RESOURCE_POLLING_FREQ_LINUX,
+        repy_constants.DISK_POLLING_MAX_LINUX)
+
+    # Whether it is stopped now, and how long to let it run once it is
+    # resumed
+    self.stopped = False
+    self.runtime = 0.0
+
+    # Stops are published in batches, as by resource_monitor
+    self.unreported_stop_time = None
+    self.unreported_stop_total = 0.0
+
+    # Why it is being killed, if it is
+    self.exceeded = None
+
+
+
+class MonitorDaemon(object):
+  """
+  The daemon.   serve() waits on the sockets with select(), and handles the
+  checks that are due in between.
+  """
+
+  def __init__(self, socketpath):
+    self.socketpath = socketpath
+
+    # Clean up after a daemon that didn't exit cleanly
+    if os.path.exists(socketpath):
+      os.remove(socketpath)
+
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.listener.bind(socketpath)
+    self.listener.listen(32)
+
+    # Registered sandboxes, by socket
+    self.sandboxes = {}
+
+    # Connections that haven't registered yet
+    self.unregistered = []
+
+    # What has been read from each connection that isn't a whole message 
+    # yet.   The sockets don't block, so a sandbox that sends part of a 
+    # message can't hold up the others.
+    self.buffers = {}
+
+    # (time, kind, sequence number, sandbox), earliest first.   Events for
+    # sandboxes that are gone are skipped when they come up.
+    self.events = []
+    self.eventcount = 0
+
+
+  def schedule(self, thetime, kind, sandbox):
+    self.eventcount += 1
+    heapq.heappush(self.events, (thetime, kind, self.eventcount, sandbox))
+
+
+  def serve(self):
+    """
+    <Purpose>
+      Runs the daemon forever.
+
+    <Arguments>
+      None.
+
+    <Exceptions>
+      As with select.select().   A sandbox that can't be monitored, for
+      whatever reason, is removed.
+
+    <Side Effects>
+      Stops, resumes and kills registered sandboxes.
+
+    <Returns>
+      Never.
+    """
+    while True:
+      if self.events:
+        timeout = max(self.events[0][0] - getruntime(), 0.0)
+      else:
+        timeout = None
+
+      socks = [self.listener] + self.unregistered + self.sandboxes.keys()
+      (readable, writable, errored) = select.select(socks, [], [], timeout)
+
+      for sock in readable:
+        if sock is self.listener:
+          try:
+            (newsock, address) = self.listener.accept()
+          except socket.error:
+            # It went away again
+            continue
+          newsock.setblocking(0)
+          self.unregistered.append(newsock)
+          self.buffers[newsock] = ""
+
+        # An earlier message may have had it dropped
+        elif sock in self.buffers:
+          self.read_messages(sock)
+
+      # Handle the events that are due
+      currenttime = getruntime()
+      while self.events and self.events[0][0] <= currenttime:
+        (eventtime, kind, count, sandbox) = heapq.heappop(self.events)
+        if self.sandboxes.get(sandbox.sock) is not sandbox:
+          continue
+
+        try:
+          if kind == EVENT_RESUME:
+            self.resume(sandbox, currenttime)
+          elif kind == EVENT_CHECK:
+            self.check(sandbox, currenttime)
+          elif kind == EVENT_DISK:
+            self.check_disk(sandbox, currenttime)
+          else:
+            self.kill(sandbox)
+        except EnvironmentError:
+          # The sandbox exited (its /proc entry is gone), or its socket is
+          # broken.   Either way it can't be monitored.
+          self.remove(sandbox)
+        except Exception, e:
+          print >> sys.stderr, "[WARN] Can't monitor sandbox", sandbox.pid, "any more:", e
+          self.remove(sandbox)
+
+
+  def read_messages(self, sock):
+    """
+    Reads what a sandbox has sent, and handles the messages that are
+    complete.   When a sandbox exits, its end of the socket is closed.   A
+    sandbox whose messages can't be parsed or handled is dropped.
+    """
+    try:
+      data = sock.recv(READ_SIZE)
+    except socket.error, e:
+      if e[0] in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+        return
+      data = ""
+
+    if not data:
+      self.drop(sock)
+      return
+
+    try:
+      (messages, self.buffers[sock]) = parse_messages(self.buffers[sock] + data)
+    except ValueError, e:
+      print >> sys.stderr, "[WARN] Dropping a sandbox that sent a bad message:", e
+      self.drop(sock)
+      return
+
+    for (channel, data) in messages:
+      try:
+        self.handle_message(sock, channel, data)
+      except Exception, e:
+        print >> sys.stderr, "[WARN] Dropping a sandbox whose", repr(channel), "message can't be handled:", e
+        self.drop(sock)
+
+      # It may have been dropped or removed
+      if sock not in self.buffers:
+        return
+
+
+  def drop(self, sock):
+    """
+    Stops listening to a connection, registered or not.
+    """
+    if sock in self.sandboxes:
+      self.remove(self.sandboxes[sock])
+    elif sock in self.buffers:
+      self.unregistered.remove(sock)
+      del self.buffers[sock]
+      sock.close()
+
+
+  def handle_message(self, sock, channel, data):
+    """
+    Handles a message from a sandbox.   A sandbox registers, and sends its 
+    new limits when its resource file is reloaded.   Raises an exception if
+    the message is bad.
+    """
+    if channel == "register" and sock in self.unregistered:
+      check_registration(data)
+
+      # Only trust the sandbox to say which process it is if the kernel
+      # can't tell us
+      if hasattr(os_api, "get_socket_peer_pid"):
+        pid = os_api.get_socket_peer_pid(sock)
+      else:
+        pid = data['pid']
+
+      sandbox = Sandbox(sock, pid, data)
+
+      self.unregistered.remove(sock)
+      self.sandboxes[sock] = sandbox
+      self.send(sandbox, "statspage", sandbox.statspagepath)
+
+      currenttime = getruntime()
+      self.schedule(currenttime, EVENT_CHECK, sandbox)
+      self.schedule(currenttime, EVENT_DISK, sandbox)
+
+    elif channel == "limits" and sock in self.sandboxes:
+      check_limits(data)
+      self.sandboxes[sock].limits = data
+
+    else:
+      print >> sys.stderr, "[WARN] Unexpected message on channel", channel
+
+
+  def send(self, sandbox, channel, data):
+    # The socket doesn't block either, so a sandbox that doesn't read what
+    # it is sent is removed rather than holding up the daemon
+    try:
+      nonportable.write_message_to_pipe(sandbox.sock.fileno(), channel, data)
+    except EnvironmentError:
+      self.remove(sandbox)
+
+
+  def remove(self, sandbox):
+    """
+    Stops monitoring a sandbox (which has usually exited).
+    """
+    if self.sandboxes.get(sandbox.sock) is not sandbox:
+      return
+
+    del self.sandboxes[sandbox.sock]
+    del self.buffers[sandbox.sock]
+    sandbox.sock.close()
+    sandbox.statspage.close()
+
+    # In case it never got to map its stats page
+    try:
+      os.remove(sandbox.statspagepath)
+    except OSError:
+      pass
+
+    if hasattr(os_api, "close_process_stat_file"):
+      os_api.close_process_stat_file(sandbox.pid)
+
+    # Don't leave it stopped if it is still around
+    if sandbox.stopped:
+      try:
+        os.kill(sandbox.pid, signal.SIGCONT)
+      except OSError:
+        pass
+
+
+  def check(self, sandbox, currenttime):
+    """
+    Checks a sandbox's CPU and memory use, as resource_monitor does.
+    """
+    limits = sandbox.limits
+
+    try:
+      (totalCPU, memused) = os_api.get_process_cpu_time_and_rss(sandbox.pid)
+    except Exception:
+      # It exited.   (A zombie raises a plain Exception.)
+      self.remove(sandbox)
+      return
+
+    sandbox.statspage.write_usage(totalCPU, memused)
+
+    (stoptime, runtime) = sandbox.throttle.update(limits['cpu'], currenttime, totalCPU)
+
+    if memused > limits['memory']:
+      self.exceed(sandbox, "Memory use '"+str(memused)+"' over limit '"+str(limits['memory'])+"'.", currenttime)
+      return
+
+    fraction = max(nonportable._limit_fraction(sandbox.throttle.share, limits['cpu']),
+        nonportable._limit_fraction(memused, limits['memory']))
+    interval = sandbox.polling.update(fraction, currenttime)
+
+    if stoptime > 0.0:
+      os.kill(sandbox.pid, signal.SIGSTOP)
+      sandbox.stopped = True
+      sandbox.runtime = runtime
+
+      if sandbox.unreported_stop_time is None:
+        sandbox.unreported_stop_time = currenttime
+      sandbox.unreported_stop_total += stoptime
+
+      self.schedule(currenttime + stoptime, EVENT_RESUME, sandbox)
+
+    else:
+      self.schedule(currenttime + interval, EVENT_CHECK, sandbox)
+
+    # Publish the stops in the sandbox's time
+    if sandbox.unreported_stop_time is not None and \
+        (stoptime == 0.0 or currenttime - sandbox.unreported_stop_time >= repy_constants.CPU_POLLING_FREQ_LINUX):
+      sandbox.statspage.add_stop(sandbox.unreported_stop_time - sandbox.runtimeoffset,
+          sandbox.unreported_stop_total)
+      sandbox.unreported_stop_time = None
+      sandbox.unreported_stop_total = 0.0
+
+
+  def resume(self, sandbox, currenttime):
+    os.kill(sandbox.pid, signal.SIGCONT)
+    sandbox.stopped = False
+    self.schedule(currenttime + sandbox.runtime, EVENT_CHECK, sandbox)
+
+
+  def check_disk(self, sandbox, currenttime):
+    """
+    Checks a sandbox's disk use, and publishes it.
+    """
+    diskused = nonportable.compute_disk_use(sandbox.directory)
+    if diskused > sandbox.limits['diskused']:
+      self.exceed(sandbox, "Disk use '"+str(diskused)+"' over limit '"+str(sandbox.limits['diskused'])+"'.", currenttime)
+      return
+
+    sandbox.statspage.write_diskused(diskused)
+
+    self.schedule(currenttime + sandbox.diskpolling.update(
+        nonportable._limit_fraction(diskused, sandbox.limits['diskused']), currenttime),
+        EVENT_DISK, sandbox)
+
+
+  def exceed(self, sandbox, message, currenttime):
+    """
+    Tells a sandbox that is over its memory or disk limit to exit, and kills
+    it if it doesn't.
+    """
+    if sandbox.exceeded is not None:
+      return
+    sandbox.exceeded = message
+
+    if sandbox.stopped:
+      os.kill(sandbox.pid, signal.SIGCONT)
+      sandbox.stopped = False
+
+    self.send(sandbox, "resourceexceeded", message)
+    self.schedule(currenttime + KILL_GRACE_TIME, EVENT_KILL, sandbox)
+
+
+  def kill(self, sandbox):
+    print >> sys.stderr, sandbox.exceeded, "Impolitely killing sandbox", sandbox.pid
+    try:
+      statusstorage.write_status("Terminated", sandbox.statusprefix)
+    except EnvironmentError:
+      pass
+    harshexit.portablekill(sandbox.pid)
+    self.remove(sandbox)
+
+
+
+def main():
+  if len(sys.argv) != 2:
+    print "Usage: python monitordaemon.py socketpath"
+    sys.exit(1)
+
+  if harshexit.ostype not in ['Linux', 'Darwin']:
+    print >> sys.stderr, "The monitor daemon only runs on Linux and Mac."
+    sys.exit(1)
+
+  MonitorDaemon(sys.argv[1]).serve()
+
+
+
+if __name__ == '__main__':
+  main()
@@ -679,12 +679,24 @@ USERCONTEXT_WRAPPER_INFO = {
        'return' : Str()},
   'createvirtualnamespace' :
       {'func' : virtual_namespace.createvirtualnamespace,
-       'args' : [Str(), Str()],
+       'args' : [Str(), Str(), NonCopiedVarArgs()],
        'return' : VirtualNamespace()},
   'getresources' :
       {'func' : nonportable.get_resources,
        'args' : [],
        'return' : (Dict(), Dict(), List())},
+  'getresourceversion' :
+      {'func' : emulmisc.getresourceversion,
+       'args' : [],
+       'return' : Int()},
+  'getresourcewait' :
+      {'func' : emulmisc.getresourcewait,
+       'args' : [Str(), Float()],
+       'return' : Float()},
+  'getresourcehistory' :
+      {'func' : emulmisc.getresourcehistory,
+       'args' : [],
+       'return' : Dict()},
   'getlasterror' :
       {'func' : emulmisc.getlasterror,
        'args' : [],
@@ -17,9 +17,6 @@
    This is a more major change than I wanted to do at this point.
 """
 
-# for sleep
-import time
-
 # needed for cpu, disk, and memory handling
 import nonportable
 
@@ -35,137 +32,479 @@ import resourcemanipulation
 
 import resource_constants
 
+# for the resource history resolution and windows
+import repy_constants
+
 import threading
 
+# for the queues of threads waiting on a renewable resource
+import collections
+
+# for finding the API call that a thread stalled in
+import sys
+
+# for the stall histograms
+import bisect
+
+# for the binary trace of tattles
+import struct
+
+# for the version numbers of resource tables
+import itertools
+
+# This is to get around the safe module, which removes open() and hash() 
+# while the sandbox runs
+safe_open = open
+safe_hash = hash
+
 
 
 # I'm going to global information about the resources allowed and used...
-# These will be initialized when the nanny is started.
+# This will be initialized when the nanny is started.
 # (this would obviously be wrong in GACKS)
-_resources_allowed_dict = None
+_resource_table = None
+
+# The resource file the nanny was started with
+_resource_filename = None
+
+# Maps thread names to dicts of how much of each renewable resource the thread
+# has been charged.   This is None unless enable_resource_ledger() is called,
+# so that tattles only pay for a comparison when it is off.
+_resource_ledger = None
+_resource_ledger_lock = threading.Lock()
+
+# The names of the threads in the ledger that have finished, oldest first.   
+# Only the last repy_constants.RESOURCE_LEDGER_FINISHED_THREADS of them keep 
+# their own entries.   Older ones are added up under LEDGER_FINISHED_KEY, so
+# that programs that start many threads don't grow the ledger forever.
+_finished_ledger_threads = collections.deque()
+LEDGER_FINISHED_KEY = "finished threads"
+
+# Every time the nanny makes a thread wait for a renewable resource, the wait 
+# is recorded here.   This maps resource names to dicts that map the API 
+# function that waited (like 'emulated_file.writeat') to a dict with the
+# 'count', 'total' and 'max' of the waits and a histogram of them in 
+# 'buckets'.   buckets[i] counts the waits of at most STALL_HISTOGRAM_BOUNDS[i]
+# seconds (and longer than the previous bound).   The last bucket counts 
+# waits longer than all of the bounds.
+STALL_HISTOGRAM_BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 
+    0.5, 1.0, 2.0, 5.0]
+_stall_histograms = {}
+_stall_histograms_lock = threading.Lock()
+
+# In shadow mode, tattles are also checked against a second resource table 
+# that is never enforced.   This is None unless start_shadow_nanny() is 
+# called.   _shadow_results maps resource names to dicts with what the shadow
+# limits would have done: the 'stalls' (count), 'stalltime' and 'maxstall' of
+# the sleeps, and how many items would have been 'refused'.   One lock covers
+# all of the shadow state.
+_shadow_table = None
+_shadow_results = None
+_shadow_lock = threading.Lock()
+
+# In trace mode, every tattle is written to a binary trace file that 
+# tracereplay.py can replay against another resource file.   The file starts
+# with TRACE_MAGIC, the length of the resource name list as a 4 byte little 
+# endian integer, and the comma separated resource names (so that resource ids
+# in the records can be mapped back to names).   Every record after that is a
+# TRACE_RECORD: the time of the call (getruntime()), a thread index, the 
+# resource id, the operation, the flags, a key for the item (its hash, or 0
+# for quantities), the quantity (0.0 for items) and how long the call waited 
+# for the resource.
+TRACE_MAGIC = "REPYTRC1"
+TRACE_RECORD = struct.Struct("<dHBBBqdf")
+
+TRACE_QUANTITY = 0
+TRACE_ADD_ITEM = 1
+TRACE_REMOVE_ITEM = 2
+TRACE_IS_ITEM_ALLOWED = 3
+
+# The call blocked (for quantities) or was refused (for items)
+TRACE_BLOCKED = 1
+
+# This is None unless start_trace() is called.   Threads are numbered in the 
+# order they first tattle.   _trace_local.stalledresources maps the resources
+# a thread waited for during the tattle that is being traced to how long it 
+# waited.
+_trace_file = None
+_trace_thread_indices = {}
+_trace_lock = threading.Lock()
+_trace_local = threading.local()
+
+# A sub-quota limits what the code in a VirtualNamespace (and the threads it 
+# creates) may use, on top of the limits of the code that evaluates it.   
+# _quota_local.quotas is the tuple of ResourceQuotas the current thread is 
+# charged to (outermost first).   _quota_items maps (resource, item) to the
+# ResourceTables an item was added to, so that it is removed from the same 
+# ones even if another thread removes it.
+class _QuotaLocal(threading.local):
+  quotas = ()
+
+_quota_local = _QuotaLocal()
+_quota_items = {}
+_quota_items_lock = threading.Lock()
+
+# Every change to a ResourceTable, the ledger or the stall histograms is 
+# given a new version number from here, so that get_resource_information 
+# can tell what changed since it last looked.   Numbers are never reused, but
+# a racing change may store an older number after a newer one, so versions 
+# are only compared for equality.
+_next_version = itertools.count(1).next
+_resource_ledger_version = 0
+_stall_histograms_version = 0
+
+
+
+# A file or socket that is charged at least LEASE_STREAMING_CALLS times within
+# LEASE_STREAMING_WINDOW seconds is streaming, and is charged through leases.
+# Each lease reserves LEASE_DURATION seconds worth of a resource's limit, and
+# expires after LEASE_DURATION seconds.
+LEASE_STREAMING_CALLS = 32
+LEASE_STREAMING_WINDOW = 1.0
+LEASE_DURATION = 0.1
+
+# Short names for the resource indices, used on every tattle
+_resource_ids = resource_constants.resource_ids
+
+_known_resources = resource_constants.known_resources
+
+
+
+
+
+class ResourceTable(object):
+  """
+  Holds the limits and the consumption of every known resource.   All of the
+  per-resource state lives in lists that are indexed by the resource's id in
+  resource_constants.resource_ids, so a tattle needs a single dict lookup 
+  (name to id) and is plain list indexing after that.
+  """
+
+  __slots__ = ['allowed_dict', 'limits', 'capacities', 'consumed',
+      'update_times', 'locks', 'waiters', 'pending', 'totals', 'histories',
+      'version', 'itemversions']
+
+  def __init__(self, resourcesalloweddict):
+    """
+     <Purpose>
+        Initializes the table from a dict of allowed resources.
+
+     <Arguments>
+        resourcesalloweddict:
+           The resource dict, as returned by 
+           resourcemanipulation.read_resourcedict_from_file.
+           
+     <Exceptions>
+        InternalRepyError is raised if a resource is specified as both quantity
+        and item based.
+
+     <Side Effects>
+        None.
+
+     <Returns>
+        None.
+    """
+
+    resourcecount = len(_known_resources)
+
+    # Keep the dict around so that get_resource_information can copy it
+    self.allowed_dict = resourcesalloweddict
+
+    # The limit of each resource.   For individual item resources this is 
+    # the set of allowed items.
+    self.limits = [None] * resourcecount
+
+    # How much of a renewable resource may be used before a tattle blocks.
+    # This is the burst capacity if one was given, or else the amount that 
+    # is renewed in one second (the limit).   Renewable resources work like
+    # a token bucket of this size that refills at the limit per second.
+    self.capacities = [None] * resourcecount
+
+    # Quantities start at 0.0, item resources track the set of items in use
+    self.consumed = [None] * resourcecount
+
+    # When the last update of a renewable resource occurred
+    # (Aside) JAC: I've thought about this and looked through the commit 
+    # history.   I don't see any reason to initialize the renewable resources
+    # with the current time (as was done before).
+    self.update_times = [0.0] * resourcecount
+
+    # I need locks to protect races in accesses to renewable and fungible 
+    # resources...
+    self.locks = [None] * resourcecount
+
+    # Threads that must wait for a renewable resource to drain line up in a 
+    # FIFO queue.   Only the thread at the head of the queue charges and 
+    # sleeps.   This is None for resources that are not renewable.
+    self.waiters = [None] * resourcecount
+
+    # How much the threads in the wait queue behind its head will charge 
+    # once they reach the head
+    self.pending = [0.0] * resourcecount
+
+    # How much of each renewable resource has been charged in total, and a 
+    # UsageHistory of the totals (None for other resources)
+    self.totals = [0.0] * resourcecount
+    self.histories = [None] * resourcecount
+
+    # The version changes whenever anything in the table does, and the item
+    # versions whenever the items in use of that resource do
+    self.version = _next_version()
+    self.itemversions = [0] * resourcecount
+
+    for resource in _known_resources:
+      resourceid = _resource_ids[resource]
+
+      self.limits[resourceid] = resourcesalloweddict[resource]
+
+      if resource in resource_constants.quantity_resources:
+        # double check there is no overlap...
+        if resource in resource_constants.item_resources:
+          raise InternalRepyError("Resource '"+resource+"' cannot be both quantity and item based!")
+
+        self.consumed[resourceid] = 0.0
+      else:
+        self.consumed[resourceid] = set()
+
+      if resource in resource_constants.renewable_resources:
+        self.locks[resourceid] = threading.Lock()
+        self.waiters[resourceid] = collections.deque()
+
+        self.capacities[resourceid] = _get_capacity(resource, resourcesalloweddict)
+        self.histories[resourceid] = UsageHistory()
+
+      elif resource in resource_constants.fungible_item_resources:
+        self.locks[resourceid] = threading.Lock()
+
+
+
+
+
+class UsageHistory(object):
+  """
+  A ring of samples of how much of a renewable resource had been charged in 
+  total, at the multiples of repy_constants.RESOURCE_HISTORY_RESOLUTION.   
+  Samples are taken lazily, by the first tattle after each multiple.   No 
+  charge can have happened between the multiple and that tattle (or it 
+  would have taken the sample), so the sample is exact.   Multiples with no
+  tattle after them have the same total as the next sample (or the current
+  total, if there is none).
+  """
+
+  __slots__ = ['times', 'values', 'newest', 'count', 'nextsample']
+
+  def __init__(self):
+    samplecount = int(max(repy_constants.RESOURCE_HISTORY_WINDOWS) / 
+        repy_constants.RESOURCE_HISTORY_RESOLUTION) + 2
+
+    self.times = [0.0] * samplecount
+    self.values = [0.0] * samplecount
+
+    # Nothing has been charged at the start
+    self.newest = 0
+    self.count = 1
+    self.nextsample = 0.0
+
+
+  def sample(self, thetime, total):
+    """
+     <Purpose>
+        Records the total, if a multiple of the resolution has passed since 
+        the last sample.   The caller must hold the resource's lock.
+
+     <Arguments>
+        thetime:
+           The current time.
+        total:
+           The total charged before the current tattle.
+
+     <Exceptions>
+        None.
+
+     <Side Effects>
+        May overwrite the oldest sample.
+
+     <Returns>
+        None.
+    """
+    if thetime < self.nextsample:
+      return
+
+    resolution = repy_constants.RESOURCE_HISTORY_RESOLUTION
+    boundary = thetime - (thetime % resolution)
+
+    self.newest = (self.newest + 1) % len(self.times)
+    self.times[self.newest] = boundary
+    self.values[self.newest] = total
+    self.count = min(self.count + 1, len(self.times))
+
+    self.nextsample = boundary + resolution
+
+
+  def get_total_at(self, thetime, total):
+    """
+     <Purpose>
+        Finds out how much had been charged in total at a past time.   The 
+        caller must hold the resource's lock.
+
+     <Arguments>
+        thetime:
+           The time to look up.
+        total:
+           The total charged so far.
+
+     <Exceptions>
+        None.
+
+     <Returns>
+        A tuple (a time, the total at that time).   The time is thetime 
+        unless thetime is within a resolution after a sample (where charges 
+        after the sample are unknown), in which case it is the sample's time.
+        If every sample is after thetime, this is the oldest sample.
+    """
+    samplecount = len(self.times)
+    oldest = (self.newest - self.count + 1) % samplecount
+
+    # Binary search the samples, oldest to newest, for the last one that is 
+    # not after thetime
+    low = 0
+    high = self.count
+    while low < high:
+      middle = (low + high) / 2
+      if self.times[(oldest + middle) % samplecount] <= thetime:
+        low = middle + 1
+      else:
+        high = middle
+
+    if low == 0:
+      return (self.times[oldest], self.values[oldest])
+
+    position = low - 1
+    index = (oldest + position) % samplecount
+
+    if thetime < self.times[index] + repy_constants.RESOURCE_HISTORY_RESOLUTION:
+      return (self.times[index], self.values[index])
+
+    # Nothing was charged between the end of this sample's resolution and 
+    # the next sample (or now), so the total then is the next sample's.
+    if position == self.count - 1:
+      return (thetime, total)
+    else:
+      return (thetime, self.values[(index + 1) % samplecount])
 
-_resources_consumed_dict = None
 
 
 
 
 
+# The burst capacity of a renewable resource if one was given, or else its 
+# limit.
+def _get_capacity(resource, resourcesalloweddict):
+  if resource + resource_constants.burst_suffix in resourcesalloweddict:
+    return resourcesalloweddict[resource + resource_constants.burst_suffix]
+  else:
+    return resourcesalloweddict[resource]
+
+
 
 
 
 # Updates the values in the consumption table (taking the current time into 
-# account)
-def _update_resource_consumption_table(resource, resource_allowed_dict, consumed_resource_dict):
+# account).   A caller that updates several resources at once may pass in the
+# time so that the clock is only read once.
+def _update_resource_consumption_table(resourceid, resourcetable, thetime=None):
 
-  thetime = nonportable.getruntime()
+  if thetime is None:
+    thetime = nonportable.getruntime()
 
   # I'm going to reduce all renewable resources by the appropriate amount given
   # the amount of elapsed time.
 
-  elapsedtime = thetime - consumed_resource_dict['renewable_update_time'][resource]
+  elapsedtime = thetime - resourcetable.update_times[resourceid]
 
-  consumed_resource_dict['renewable_update_time'][resource] = thetime
+  resourcetable.update_times[resourceid] = thetime
 
   if elapsedtime < 0:
     # A negative number (likely a NTP reset).   Let's just ignore it.
     return
 
   # Remove the charge
-  reduction = elapsedtime * resource_allowed_dict[resource]
+  reduction = elapsedtime * resourcetable.limits[resourceid]
     
-  if reduction > consumed_resource_dict[resource]:
+  if reduction > resourcetable.consumed[resourceid]:
 
     # It would reduce it below zero (so put it at zero)
-    consumed_resource_dict[resource] = 0.0
+    resourcetable.consumed[resourceid] = 0.0
   else:
 
     # Subtract some for elapsed time...
-    consumed_resource_dict[resource] = consumed_resource_dict[resource] - reduction
-
-
-
-# I want to wait until a resource can be used again...
-def _sleep_until_resource_drains(resource, resourcesalloweddict, resourcesuseddict):
+    resourcetable.consumed[resourceid] = resourcetable.consumed[resourceid] - reduction
 
-  # It'll never drain!
-  if resourcesalloweddict[resource] == 0:
-    raise InternalRepyError, "Resource '"+resource+"' limit set to 0, won't drain!"
-    
-
-  # We may need to go through this multiple times because other threads may
-  # also block and consume resources.
-  while resourcesuseddict[resource] > resourcesalloweddict[resource]:
-
-    # Sleep until we're expected to be under quota
-    sleeptime = (resourcesuseddict[resource] - resourcesalloweddict[resource]) / resourcesalloweddict[resource]
 
-    time.sleep(sleeptime)
+# Adds an amount to the total charged for a renewable resource, sampling the
+# total first if it is due.   The caller must hold the lock for the resource.
+def _add_to_history(resourceid, resourcetable, thetime, quantity):
+  resourcetable.histories[resourceid].sample(thetime, resourcetable.totals[resourceid])
+  resourcetable.totals[resourceid] = resourcetable.totals[resourceid] + quantity
 
-    _update_resource_consumption_table(resource, resourcesalloweddict, resourcesuseddict)
 
 
+# I want to wait until a resource can be used again...
+# The caller must hold the lock for the resource.   waiter is the caller's 
+# condition variable (bound to that lock) in the resource's wait queue, or 
+# None if the resource isn't over quota.   Returns True if it had to wait.
+def _sleep_until_resource_drains(resourceid, resourcetable, waiter):
 
+  waited = False
 
-def _create_resource_consumption_dict():
-  """
-   <Purpose>
-      Initializes the consumed resource portion of the nanny.   This tracks
-      resource use (instead of resource quantity)
+  # We may need to go through this multiple times because we may be woken up
+  # early.
+  while resourcetable.consumed[resourceid] > resourcetable.capacities[resourceid]:
 
-   <Arguments>
-      None.
-         
-   <Exceptions>
-      InternalRepyError is raised if a resource is specified as both quantity and item based.
+    # It'll never drain!   (The limit may have changed while we slept.)
+    if resourcetable.limits[resourceid] == 0:
+      raise InternalRepyError, "Resource '"+_known_resources[resourceid]+"' limit set to 0, won't drain!"
 
-   <Side Effects>
-      None.
+    # Sleep until we're expected to be under quota
+    sleeptime = (resourcetable.consumed[resourceid] - resourcetable.capacities[resourceid]) / resourcetable.limits[resourceid]
 
-   <Returns>
-      A dict for tracking resources consumed.  It has locks, etc. in the right
-      places.
-  """
+    # This releases the resource lock while we sleep, so that other threads
+    # can queue up behind us instead of blocking on the lock
+    waiter.wait(sleeptime)
+    waited = True
 
-  returned_resource_dict = {}
+    _update_resource_consumption_table(resourceid, resourcetable)
+    resourcetable.version = _next_version()
 
-  # things that are quantities should start at 0.0
-  for resource in resource_constants.quantity_resources:
-    returned_resource_dict[resource] = 0.0
+  return waited
 
-  for resource in resource_constants.item_resources:
-    # double check there is no overlap...
-    if resource in resource_constants.quantity_resources:
-      raise InternalRepyError("Resource '"+resource+"' cannot be both quantity and item based!")
 
-    returned_resource_dict[resource] = set()
 
-  # I need locks to protect races in accesses to some items...
-  returned_resource_dict['fungible_locks'] = {}
-  for init_resource in resource_constants.fungible_item_resources:
-    returned_resource_dict['fungible_locks'][init_resource] = threading.Lock()
+# Adds a new waiter to the end of the wait queue for a renewable resource.
+# The caller must hold the lock for the resource.
+def _enqueue_drain_waiter(resourceid, resourcetable):
+  waiter = threading.Condition(resourcetable.locks[resourceid])
+  resourcetable.waiters[resourceid].append(waiter)
+  return waiter
 
-  returned_resource_dict['renewable_locks'] = {}
-  for init_resource in resource_constants.renewable_resources:
-    returned_resource_dict['renewable_locks'][init_resource] = threading.Lock()
 
 
-  # I also need to track when the last update of a renewable resource occurred
-  returned_resource_dict['renewable_update_time'] = {}
+# Removes a waiter from the wait queue and wakes up whoever is next.
+# The caller must hold the lock for the resource.
+def _dequeue_drain_waiter(resourceid, resourcetable, waiter):
+  waitqueue = resourcetable.waiters[resourceid]
+  waitqueue.remove(waiter)
 
-  # (Aside) JAC: I've thought about this and looked through the commit history.
-  # I don't see any reason to initialize the renewable resources with the
-  # current time (as was done before).
-  for init_resource in resource_constants.renewable_resources:
-    returned_resource_dict['renewable_update_time'][init_resource] = 0.0
+  if waitqueue:
+    waitqueue[0].notify()
 
 
-  return returned_resource_dict
 
 
 # let the nanny know that the process is consuming some resource
 # can also be called with quantity '0' for a renewable resource so that the
 # nanny will wait until there is some free "capacity"
-def _tattle_quantity(resource, quantity, resourcesalloweddict, resourcesuseddict):
+def _tattle_quantity(resource, quantity, resourcetable):
   """
    <Purpose>
       Notify the nanny of the consumption of a renewable resource.   A 
@@ -179,6 +518,8 @@ def _tattle_quantity(resource, quantity, resourcesalloweddict, resourcesuseddict
          The amount consumed.   This can be zero (to indicate the program 
          should block if the resource is already over subscribed) but 
          cannot be negative
+      resourcetable:
+         The ResourceTable to charge.
 
    <Exceptions>
       None.
@@ -197,38 +538,201 @@ def _tattle_quantity(resource, quantity, resourcesalloweddict, resourcesuseddict
     # enabled. -Brent
     tracebackrepy.handle_internalerror("Resource '" + resource + 
         "' has a negative quantity " + str(quantity) + "!", 132)
+
+  resourceid = _resource_ids[resource]
+
+  # It's renewable, so I can wait for it to clear.   Only renewable resources
+  # have a wait queue.
+  waitqueue = resourcetable.waiters[resourceid]
+  if waitqueue is None:
+    # Should never have a quantity tattle for a non-renewable resource
+    # This will cause the program to exit and log things if logging is
+    # enabled. -Brent
+    tracebackrepy.handle_internalerror("Resource '" + resource + 
+        "' is not renewable!", 133)
     
   # get the lock for this resource
-  resourcesuseddict['renewable_locks'][resource].acquire()
+  resourcetable.locks[resourceid].acquire()
+
+  # This is set if we have to queue up for the resource
+  waiter = None
+
+  # When we started waiting (if we did)
+  stallstart = None
   
   # release the lock afterwards no matter what
   try: 
+    # If other threads are already waiting for this resource to drain, get in
+    # line behind them.   Waiting releases the lock.
+    if waitqueue:
+      stallstart = nonportable.getruntime()
+      waiter = _enqueue_drain_waiter(resourceid, resourcetable)
+      resourcetable.pending[resourceid] = resourcetable.pending[resourceid] + quantity
+      try:
+        while waitqueue[0] is not waiter:
+          waiter.wait()
+      finally:
+        resourcetable.pending[resourceid] = resourcetable.pending[resourceid] - quantity
+
     # update the resource counters based upon the current time.
-    _update_resource_consumption_table(resource, resourcesalloweddict, resourcesuseddict)
+    thetime = nonportable.getruntime()
+    _update_resource_consumption_table(resourceid, resourcetable, thetime)
 
-    # It's renewable, so I can wait for it to clear
-    if resource not in resource_constants.renewable_resources:
-      # Should never have a quantity tattle for a non-renewable resource
-      # This will cause the program to exit and log things if logging is
-      # enabled. -Brent
-      tracebackrepy.handle_internalerror("Resource '" + resource + 
-          "' is not renewable!", 133)
-  
+    resourcetable.consumed[resourceid] = resourcetable.consumed[resourceid] + quantity
+    resourcetable.version = _next_version()
+    _add_to_history(resourceid, resourcetable, thetime, quantity)
+
+    # If I'm over, I'll need a place at the head of the queue while I wait
+    if waiter is None and resourcetable.consumed[resourceid] > resourcetable.capacities[resourceid]:
+      stallstart = nonportable.getruntime()
+      waiter = _enqueue_drain_waiter(resourceid, resourcetable)
 
-    resourcesuseddict[resource] = resourcesuseddict[resource] + quantity
     # I'll block if I'm over...
-    _sleep_until_resource_drains(resource, resourcesalloweddict, resourcesuseddict)
+    _sleep_until_resource_drains(resourceid, resourcetable, waiter)
   
   finally:
+    # let the next thread in line (if any) proceed
+    if waiter is not None:
+      _dequeue_drain_waiter(resourceid, resourcetable, waiter)
+
     # release the lock for this resource
-    resourcesuseddict['renewable_locks'][resource].release()
+    resourcetable.locks[resourceid].release()
+
+  if stallstart is not None:
+    _record_stall(resource, nonportable.getruntime() - stallstart)
     
 
 
 
 
 
-def _tattle_add_item(resource, item, resourcesalloweddict, resourcesuseddict):
+def _tattle_quantities(quantitydict, resourcetable):
+  """
+   <Purpose>
+      Notify the nanny of the consumption of several renewable resources at 
+      once.   This behaves like calling _tattle_quantity for each resource, 
+      but the locks are taken in a fixed order and the clock is read once.
+
+   <Arguments>
+      quantitydict:
+         A dict mapping resource names to the amount consumed.   As with 
+         _tattle_quantity, an amount can be zero but cannot be negative.
+      resourcetable:
+         The ResourceTable to charge.
+
+   <Exceptions>
+      InternalRepyError is raised if one of the resources has a limit of 0.
+
+   <Side Effects>
+      May sleep the program until the resources are available.
+
+   <Returns>
+      None.
+  """
+
+  resourceidlist = []
+
+  for resource in quantitydict:
+    # I assume that the quantity will never be negative
+    if quantitydict[resource] < 0:
+      tracebackrepy.handle_internalerror("Resource '" + resource + 
+          "' has a negative quantity " + str(quantitydict[resource]) + "!", 132)
+
+    resourceid = _resource_ids[resource]
+
+    if resourcetable.waiters[resourceid] is None:
+      tracebackrepy.handle_internalerror("Resource '" + resource + 
+          "' is not renewable!", 133)
+
+    # It'll never drain!   (check this now so we never raise while queued)
+    if resourcetable.limits[resourceid] == 0:
+      raise InternalRepyError, "Resource '"+resource+"' limit set to 0, won't drain!"
+
+    resourceidlist.append(resourceid)
+
+
+  # Always lock in the same order so that batched tattles can't deadlock
+  resourceidlist.sort()
+
+  for resourceid in resourceidlist:
+    resourcetable.locks[resourceid].acquire()
+
+  # If other threads are already waiting for one of these resources, we 
+  # have to get in line.   Do this the slow way, one resource at a time.
+  mustqueue = False
+  for resourceid in resourceidlist:
+    if resourcetable.waiters[resourceid]:
+      mustqueue = True
+
+  if mustqueue:
+    for resourceid in resourceidlist:
+      resourcetable.locks[resourceid].release()
+
+    for resource in quantitydict:
+      _tattle_quantity(resource, quantitydict[resource], resourcetable)
+    return
+
+
+  # These are (resourceid, waiter) tuples for the resources that went over
+  waiterlist = []
+
+  try:
+    thetime = nonportable.getruntime()
+
+    for resourceid in resourceidlist:
+      _update_resource_consumption_table(resourceid, resourcetable, thetime)
+
+      resourcetable.consumed[resourceid] = resourcetable.consumed[resourceid] + quantitydict[_known_resources[resourceid]]
+      _add_to_history(resourceid, resourcetable, thetime, quantitydict[_known_resources[resourceid]])
+
+      # The queue is empty, so this puts us at the head of it
+      if resourcetable.consumed[resourceid] > resourcetable.capacities[resourceid]:
+        waiterlist.append((resourceid, _enqueue_drain_waiter(resourceid, resourcetable)))
+
+    resourcetable.version = _next_version()
+
+  finally:
+    for resourceid in resourceidlist:
+      resourcetable.locks[resourceid].release()
+
+
+  # Now wait for the resources that went over, one at a time
+  try:
+    while waiterlist:
+      (resourceid, waiter) = waiterlist[0]
+
+      stallstart = nonportable.getruntime()
+
+      resourcetable.locks[resourceid].acquire()
+      try:
+        # It drained while we waited for the resources before it, maybe 
+        # enough that we don't have to wait for it at all
+        _update_resource_consumption_table(resourceid, resourcetable)
+        resourcetable.version = _next_version()
+        waited = _sleep_until_resource_drains(resourceid, resourcetable, waiter)
+      finally:
+        _dequeue_drain_waiter(resourceid, resourcetable, waiter)
+        del waiterlist[0]
+        resourcetable.locks[resourceid].release()
+
+      if waited:
+        _record_stall(_known_resources[resourceid], nonportable.getruntime() - stallstart)
+
+  finally:
+    # If something went wrong, don't leave other threads queued up behind 
+    # waiters we never got to
+    for (resourceid, waiter) in waiterlist:
+      resourcetable.locks[resourceid].acquire()
+      try:
+        _dequeue_drain_waiter(resourceid, resourcetable, waiter)
+      finally:
+        resourcetable.locks[resourceid].release()
+
+
+
+
+
+def _tattle_add_item(resource, item, resourcetable):
   """
    <Purpose>
       Let the nanny know that the process is trying to consume a fungible but 
@@ -241,6 +745,8 @@ def _tattle_add_item(resource, item, resourcesalloweddict, resourcesuseddict):
          A unique identifier that specifies the resource.   It is used to
          prevent duplicate additions and removals and so must be unique for
          each item used.
+      resourcetable:
+         The ResourceTable to charge.
          
    <Exceptions>
       InternalRepyError is raised if the consumption of the resource has exceded the limit.
@@ -253,33 +759,37 @@ def _tattle_add_item(resource, item, resourcesalloweddict, resourcesuseddict):
       None.
   """
 
-  resourcesuseddict['fungible_locks'][resource].acquire()
+  resourceid = _resource_ids[resource]
+  itemsused = resourcetable.consumed[resourceid]
+
+  resourcetable.locks[resourceid].acquire()
 
   # always unlock as we exit...
   try: 
 
     # It's already acquired.   This is always allowed.
-    if item in resourcesuseddict[resource]:
+    if item in itemsused:
       return
 
-    if len(resourcesuseddict[resource]) > resourcesalloweddict[resource]:
-      raise InternalRepyError, "Should not be able to exceed resource count"
-
-    if len(resourcesuseddict[resource]) == resourcesalloweddict[resource]:
+    # This may be over the limit if the resource file was reloaded with a 
+    # lower limit.   The items in use are kept, but no more can be added 
+    # until enough are released.
+    if len(itemsused) >= resourcetable.limits[resourceid]:
       # it's clobberin time!
       raise ResourceExhaustedError("Resource '"+resource+"' limit exceeded!!")
 
     # add the item to the list.   We're done now...
-    resourcesuseddict[resource].add(item)
+    itemsused.add(item)
+    resourcetable.itemversions[resourceid] = resourcetable.version = _next_version()
 
   finally:
-    resourcesuseddict['fungible_locks'][resource].release()
+    resourcetable.locks[resourceid].release()
 
     
 
 
 
-def _tattle_remove_item(resource, item, resourcesalloweddict, resourcesuseddict):
+def _tattle_remove_item(resource, item, resourcetable):
   """
    <Purpose>
       Let the nanny know that the process is releasing a fungible but 
@@ -292,6 +802,8 @@ def _tattle_remove_item(resource, item, resourcesalloweddict, resourcesuseddict)
          A unique identifier that specifies the resource.   It is used to
          prevent duplicate additions and removals and so must be unique for
          each item used.
+      resourcetable:
+         The ResourceTable to update.
          
    <Exceptions>
       None.
@@ -303,24 +815,28 @@ def _tattle_remove_item(resource, item, resourcesalloweddict, resourcesuseddict)
       None.
   """
 
-  resourcesuseddict['fungible_locks'][resource].acquire()
+  resourceid = _resource_ids[resource]
+
+  resourcetable.locks[resourceid].acquire()
 
   # always unlock as we exit...
   try: 
     
     try:
-      resourcesuseddict[resource].remove(item)
+      resourcetable.consumed[resourceid].remove(item)
     except KeyError:
       # may happen because removal is idempotent
       pass
+    else:
+      resourcetable.itemversions[resourceid] = resourcetable.version = _next_version()
 
   finally:
-    resourcesuseddict['fungible_locks'][resource].release()
+    resourcetable.locks[resourceid].release()
 
 
 
 # used for individual_item_resources
-def _is_item_allowed(resource, item, resourcesalloweddict, resourcesuseddict):
+def _is_item_allowed(resource, item, resourcetable):
   """
    <Purpose>
       Check if the process can acquire a non-fungible, non-renewable resource.
@@ -332,6 +848,8 @@ def _is_item_allowed(resource, item, resourcesalloweddict, resourcesuseddict):
          A unique identifier that specifies the resource.   It has some
          meaning to the caller (like a port number for TCP or UDP), but is 
          opaque to the nanny.   
+      resourcetable:
+         The ResourceTable to check.
          
    <Exceptions>
       None.
@@ -343,10 +861,15 @@ def _is_item_allowed(resource, item, resourcesalloweddict, resourcesuseddict):
       True or False
   """
 
-  if item in resourcesalloweddict[resource]:
+  resourceid = _resource_ids[resource]
+
+  # The allowed items are a sorted list of ranges
+  if resourcemanipulation.is_item_in_ranges(resourcetable.limits[resourceid], item):
     # this is semi nonsensical, but allows us to indicate which ports are used
     # through get_resource_information()
-    resourcesuseddict[resource].add(item)
+    if item not in resourcetable.consumed[resourceid]:
+      resourcetable.consumed[resourceid].add(item)
+      resourcetable.itemversions[resourceid] = resourcetable.version = _next_version()
     return True
 
   else:
@@ -355,178 +878,1876 @@ def _is_item_allowed(resource, item, resourcesalloweddict, resourcesuseddict):
 
 
 
+# used for renewable_resources
+def _get_resource_wait(resource, quantity, resourcetable):
+  """
+   <Purpose>
+      Estimate how long tattling a quantity of a renewable resource would 
+      block, without consuming anything.
+
+   <Arguments>
+      resource:
+         A string with the resource name.   
+      quantity:
+         The amount that would be consumed.   
+      resourcetable:
+         The ResourceTable to check.
+         
+   <Exceptions>
+      RepyArgumentError if the resource isn't a renewable resource or the 
+      quantity is negative.
+      ResourceForbiddenError if the charge would need to wait but the 
+      resource's limit is 0 (so the wait would be forever).
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      The number of seconds the charge would be expected to block.   This 
+      includes the time to drain the charges of any threads already waiting,
+      including those still queued behind the one that is sleeping.
+  """
+
+  if resource not in _resource_ids or \
+      resourcetable.waiters[_resource_ids[resource]] is None:
+    raise RepyArgumentError("'"+str(resource)+"' is not a renewable resource")
+
+  if quantity < 0:
+    raise RepyArgumentError("The quantity must be non-negative")
 
+  resourceid = _resource_ids[resource]
 
-############################ Externally called ########################
+  resourcetable.locks[resourceid].acquire()
+  try:
+    _update_resource_consumption_table(resourceid, resourcetable)
+    resourcetable.version = _next_version()
 
+    # The thread at the head of the wait queue has charged what it uses, 
+    # but the threads behind it charge once they reach the head.   All of 
+    # that, and this charge, must drain down to the capacity first.
+    excess = resourcetable.consumed[resourceid] + \
+        resourcetable.pending[resourceid] + quantity - \
+        resourcetable.capacities[resourceid]
+    limit = resourcetable.limits[resourceid]
 
+  finally:
+    resourcetable.locks[resourceid].release()
 
-def start_resource_nanny(resourcefilename):
+  if excess <= 0:
+    return 0.0
+
+  if limit == 0:
+    raise ResourceForbiddenError("Resource '"+resource+"' limit set to 0, won't drain!")
+
+  return excess / float(limit)
+
+
+
+
+
+
+def _reload_resource_table(resourcesalloweddict, resourcetable):
   """
    <Purpose>
-      Initializes the resource information the nanny needs to do monitoring.
+      Swaps new limits into a resource table, keeping everything that has 
+      been consumed.
 
    <Arguments>
-      resourcefilename: the file that contains the set of resources we will
-      use.
+      resourcesalloweddict:
+         The new resource dict, as returned by 
+         resourcemanipulation.read_resourcedict_from_file.
+      resourcetable:
+         The ResourceTable to update.
          
    <Exceptions>
-      ResourceParseError if the resource file is invalid
+      None.
 
    <Side Effects>
-      None
+      The locks of all renewable and fungible resources are held while the 
+      limits change, so no tattle sees a mix of old and new limits.   
+      Renewable resources drain at the old rate up to now and at the new rate
+      after.   If a limit on items is lowered below what is in use, the items
+      in use are kept and new items are refused until enough are released.
 
    <Returns>
       None.
   """
 
-  global _resources_allowed_dict
+  lockedids = []
+  for resourceid in range(len(_known_resources)):
+    if resourcetable.locks[resourceid] is not None:
+      lockedids.append(resourceid)
 
-  global _resources_consumed_dict 
-
-  # get the resource information from disk
-  _resources_allowed_dict, call_list = resourcemanipulation.read_resourcedict_from_file(resourcefilename)
+  # Always lock in order of resource id so that this can't deadlock with
+  # tattle_quantities
+  for resourceid in lockedids:
+    resourcetable.locks[resourceid].acquire()
 
-  # this sets up a dictionary with the correct locks, etc. for tracking
-  # resource use.
-  _resources_consumed_dict = _create_resource_consumption_dict()
-  
+  try:
+    thetime = nonportable.getruntime()
 
-def tattle_quantity(resource, quantity):
-  return _tattle_quantity(resource, quantity, _resources_allowed_dict, _resources_consumed_dict)
-  
+    for resource in _known_resources:
+      resourceid = _resource_ids[resource]
 
-def tattle_add_item(resource, item):
-  return _tattle_add_item(resource, item, _resources_allowed_dict, _resources_consumed_dict)
+      if resourcetable.waiters[resourceid] is not None:
+        _update_resource_consumption_table(resourceid, resourcetable, thetime)
+        resourcetable.capacities[resourceid] = _get_capacity(resource, resourcesalloweddict)
 
+      resourcetable.limits[resourceid] = resourcesalloweddict[resource]
 
-def tattle_remove_item(resource, item):
-  return _tattle_remove_item(resource, item, _resources_allowed_dict, _resources_consumed_dict)
+      # Let the thread that is sleeping on this resource recompute how long
+      # to wait
+      if resourcetable.waiters[resourceid]:
+        resourcetable.waiters[resourceid][0].notify()
 
-def is_item_allowed(resource, item):
-  return _is_item_allowed(resource, item, _resources_allowed_dict, _resources_consumed_dict)
+    resourcetable.allowed_dict = resourcesalloweddict
+    resourcetable.version = _next_version()
 
+  finally:
+    for resourceid in lockedids:
+      resourcetable.locks[resourceid].release()
 
 
-# Armon: This is an extremely basic wrapper function, that just allows
-# for pre/post processing if required in the future
-def get_resource_limit(resource):
-  """
-  <Purpose>
-    Returns the limit or availability of a resource.
 
-  <Arguments>
-    resource:
-      The resource about which information is being requested.
 
-  <Exceptions>
-    KeyError if the resource does not exist.
 
-  <Side Effects>
-    None
 
-  <Returns>
-    The resource availability or limit.
+class ResourceLease(object):
+  """
+  A budget of a renewable resource that was charged to the nanny up front.
+  The holder consumes it without involving the nanny, and returns whatever
+  is left when it releases the lease.   A lease is not thread safe, so its 
+  holder must serialize access to it.
   """
 
-  return _resources_allowed_dict[resource]
+  __slots__ = ['resource', 'resourcetable', 'remaining', 'expiretime']
 
+  def __init__(self, resource, resourcetable, quantity, expiretime):
+    self.resource = resource
+    self.resourcetable = resourcetable
+    self.remaining = quantity
+    self.expiretime = expiretime
 
 
+  def consume(self, quantity, thetime):
+    """
+     <Purpose>
+        Consumes part of the lease's budget, if there is enough left and the
+        lease hasn't expired.
 
+     <Arguments>
+        quantity:
+           The amount consumed.
+        thetime:
+           The current time (from getruntime).
 
+     <Exceptions>
+        None.
 
+     <Side Effects>
+        None.
 
+     <Returns>
+        True if the quantity was taken from the lease, False if the lease 
+        can't cover it (in which case nothing is consumed).
+    """
+    if thetime > self.expiretime or quantity > self.remaining:
+      return False
 
+    self.remaining = self.remaining - quantity
+    return True
 
-def calculate_cpu_sleep_interval(cpulimit, percentused, elapsedtime):
-  """
-  <Purpose>
-    Calculates proper CPU sleep interval to best achieve target cpulimit.
-  
-  <Arguments>
-    cpulimit:
-      The target cpu usage limit
-    percentused:
-      The percentage of cpu used in the interval between the last sample of the process
-    elapsedtime:
-      The amount of time elapsed between last sampling the process
-  
-  <Exceptions>
-    ZeroDivisionError if elapsedtime is 0.
-  
-  <Side Effects>
-    None, this just does math
 
-  <Returns>
-    Time period the process should sleep
-  """
-  # Debug: Used to calculate averages
-  #global totaltime, rawcpu, appstart
 
-  # Return 0 if elapsedtime is non-positive
-  if elapsedtime <= 0:
-    return 0
-    
-  # Calculate Stoptime
-  #  Mathematically Derived from:
-  #  (PercentUsed * TotalTime) / ( TotalTime + StopTime) = CPULimit
-  stoptime = max(((percentused * elapsedtime) / cpulimit) - elapsedtime , 0)
 
-  # Print debug info
-  #rawcpu += percentused*elapsedtime
-  #totaltime = time.time() - appstart
-  #print totaltime , "," , (rawcpu/totaltime) , "," ,elapsedtime , "," ,percentused
-  #print percentused, elapsedtime
-  #print "Stopping: ", stoptime
+def _acquire_leases(quantitydict, resourcetable):
+  """
+   <Purpose>
+      Charges several renewable resources up front and returns leases for 
+      the charged amounts.   This may sleep just like _tattle_quantities.
 
-  # Return amount of time to sleep for
-  return stoptime
+   <Arguments>
+      quantitydict:
+         A dict mapping resource names to the budget to lease.
+      resourcetable:
+         The ResourceTable to charge.
 
+   <Exceptions>
+      As with _tattle_quantities.
 
+   <Side Effects>
+      May sleep the program until the resources are available.
 
-def get_resource_information():
+   <Returns>
+      A dict mapping resource names to ResourceLease objects.
   """
-  <Purpose>
-    Returns information about how many resources have been used.
-  
-  <Arguments>
-    None
-  
-  <Exceptions>
-    None
-  
-  <Side Effects>
-    None
+  _tattle_quantities(quantitydict, resourcetable)
 
-  <Returns>
-    A tuple: (the allowed resource dict, and usage dict).   Usage information
-    is sanitized to remove unnecessary things like locks.
-  """
+  expiretime = nonportable.getruntime() + LEASE_DURATION
 
+  leasedict = {}
+  for resource in quantitydict:
+    leasedict[resource] = ResourceLease(resource, resourcetable, quantitydict[resource], expiretime)
 
-  # the resources we are allowed to use is easy.   We just copy this...
-  resource_limit_dict = _resources_allowed_dict.copy()
+  return leasedict
 
-  
-  # from the other dict, we only take the resource information.   (this omits
-  # locks and timing information that isn't needed)
 
-  # first, let's do the easy thing, the quantity resources.   These are just 
-  # floats
-  resource_use_dict = {}
-  for resourcename in resource_constants.quantity_resources:
-    resource_use_dict[resourcename] = _resources_consumed_dict[resourcename]
 
-  # for the fungible resources (files opened, etc,), we only need a count...
-  for resourcename in resource_constants.fungible_item_resources:
-    resource_use_dict[resourcename] = len(_resources_consumed_dict[resourcename])
+def _release_lease(lease):
+  """
+   <Purpose>
+      Gives the unused part of a lease back to the resource table it was 
+      charged to.   Releasing a lease twice is harmless.
 
-  # for the individual item resources (ports, etc,), we copy the set...
-  for resourcename in resource_constants.individual_item_resources:
-    resource_use_dict[resourcename] = _resources_consumed_dict[resourcename].copy()
+   <Arguments>
+      lease:
+         The ResourceLease to release.
 
-  # and that's it!
-  return (resource_limit_dict, resource_use_dict)
+   <Exceptions>
+      None.
 
+   <Side Effects>
+      Wakes the thread at the head of the resource's wait queue (if any), so
+      it can notice that the resource drained early.
 
+   <Returns>
+      None.
+  """
+  resourcetable = lease.resourcetable
+  resourceid = _resource_ids[lease.resource]
+
+  resourcetable.locks[resourceid].acquire()
+  try:
+    thetime = nonportable.getruntime()
+    _update_resource_consumption_table(resourceid, resourcetable, thetime)
+
+    # The unused part of the lease was never really used
+    _add_to_history(resourceid, resourcetable, thetime, -lease.remaining)
+
+    # The charge may already have partly drained, so don't go below zero
+    if lease.remaining > resourcetable.consumed[resourceid]:
+      resourcetable.consumed[resourceid] = 0.0
+    else:
+      resourcetable.consumed[resourceid] = resourcetable.consumed[resourceid] - lease.remaining
+
+    resourcetable.version = _next_version()
+    lease.remaining = 0.0
+
+    if resourcetable.waiters[resourceid]:
+      resourcetable.waiters[resourceid][0].notify()
+
+  finally:
+    resourcetable.locks[resourceid].release()
+
+
+
+
+
+############################ Externally called ########################
+
+
+
+def start_resource_nanny(resourcefilename):
+  """
+   <Purpose>
+      Initializes the resource information the nanny needs to do monitoring.
+
+   <Arguments>
+      resourcefilename: the file that contains the set of resources we will
+      use.
+         
+   <Exceptions>
+      ResourceParseError if the resource file is invalid
+
+   <Side Effects>
+      None
+
+   <Returns>
+      None.
+  """
+
+  global _resource_table
+  global _resource_filename
+
+  # get the resource information from disk
+  resources_allowed_dict, call_list = resourcemanipulation.read_resourcedict_from_file(resourcefilename)
+
+  # remember where it came from, in case we are asked to reload it
+  _resource_filename = resourcefilename
+
+  # this sets up a table with the correct locks, etc. for tracking
+  # resource use.
+  _resource_table = ResourceTable(resources_allowed_dict)
+  
+
+def reload_resource_nanny(resourcefilename=None):
+  """
+   <Purpose>
+      Re-reads the resource file and swaps the new limits in.   Consumption
+      that has already been charged is kept.
+
+   <Arguments>
+      resourcefilename: the file that contains the new set of resources.   
+      This defaults to the file the nanny was started with.
+         
+   <Exceptions>
+      ResourceParseError if the resource file is invalid, or sets the limit
+      of a renewable resource to 0.   The old limits are kept in this case.
+
+   <Side Effects>
+      See _reload_resource_table.
+
+   <Returns>
+      The new dict of allowed resources.
+  """
+
+  if resourcefilename is None:
+    resourcefilename = _resource_filename
+
+  resources_allowed_dict, call_list = resourcemanipulation.read_resourcedict_from_file(resourcefilename)
+
+  # A thread waiting for a renewable resource to drain never would
+  for resource in resource_constants.renewable_resources:
+    if resources_allowed_dict.get(resource) == 0:
+      raise resourcemanipulation.ResourceParseError("Resource '"+resource+"' can't be reloaded with a limit of 0")
+
+  update_resource_limits(resources_allowed_dict)
+
+  return resources_allowed_dict
+
+
+def update_resource_limits(resourcesalloweddict):
+  return _reload_resource_table(resourcesalloweddict, _resource_table)
+  
+
+def tattle_quantity(resource, quantity):
+  if _quota_local.quotas:
+    _tattle_quotas({resource: quantity}, _quota_local.quotas)
+
+  if _resource_ledger is not None:
+    _record_in_ledger({resource: quantity})
+
+  if _shadow_table is not None:
+    _shadow_tattle_quantities({resource: quantity})
+
+  if _trace_file is not None:
+    return _traced_tattle_quantities({resource: quantity}, _tattle_quantities, _resource_table)
+
+  return _tattle_quantity(resource, quantity, _resource_table)
+  
+
+def tattle_quantities(quantitydict):
+  if _quota_local.quotas:
+    _tattle_quotas(quantitydict, _quota_local.quotas)
+
+  if _resource_ledger is not None:
+    _record_in_ledger(quantitydict)
+
+  if _shadow_table is not None:
+    _shadow_tattle_quantities(quantitydict)
+
+  if _trace_file is not None:
+    return _traced_tattle_quantities(quantitydict, _tattle_quantities, _resource_table)
+
+  return _tattle_quantities(quantitydict, _resource_table)
+
+
+def tattle_add_item(resource, item):
+  if _quota_local.quotas:
+    return _tattle_add_item_to_quotas(resource, item, _quota_local.quotas, _tattle_add_item_to_nanny)
+
+  return _tattle_add_item_to_nanny(resource, item)
+
+
+def _tattle_add_item_to_nanny(resource, item):
+  if _trace_file is not None:
+    thetime = nonportable.getruntime()
+    flags = TRACE_BLOCKED
+    try:
+      _tattle_add_item(resource, item, _resource_table)
+      flags = 0
+    finally:
+      _write_trace_record(thetime, resource, TRACE_ADD_ITEM, flags, safe_hash(item), 0.0)
+
+  else:
+    _tattle_add_item(resource, item, _resource_table)
+
+  # only items the real nanny allowed are shadowed
+  if _shadow_table is not None:
+    _shadow_tattle_add_item(resource, item)
+
+
+def tattle_remove_item(resource, item):
+  if _quota_items:
+    _tattle_remove_item_from_quotas(resource, item)
+
+  if _shadow_table is not None:
+    _shadow_tattle_remove_item(resource, item)
+
+  if _trace_file is not None:
+    _write_trace_record(nonportable.getruntime(), resource, TRACE_REMOVE_ITEM, 0, safe_hash(item), 0.0)
+
+  return _tattle_remove_item(resource, item, _resource_table)
+
+def is_item_allowed(resource, item):
+  for quota in _quota_local.quotas:
+    if resource in quota.resources and not _is_item_allowed(resource, item, quota.table):
+      return False
+
+  if _shadow_table is not None:
+    _shadow_is_item_allowed(resource, item)
+
+  allowed = _is_item_allowed(resource, item, _resource_table)
+
+  if _trace_file is not None:
+    if allowed:
+      flags = 0
+    else:
+      flags = TRACE_BLOCKED
+    _write_trace_record(nonportable.getruntime(), resource, TRACE_IS_ITEM_ALLOWED, flags, safe_hash(item), 0.0)
+
+  return allowed
+
+def get_resource_wait(resource, quantity):
+  wait = _get_resource_wait(resource, quantity, _resource_table)
+
+  # The charge would also wait for the sub-quotas (if any)
+  for quota in _quota_local.quotas:
+    if resource in quota.resources:
+      wait = max(wait, _get_resource_wait(resource, quantity, quota.table))
+
+  return wait
+
+
+
+def get_resource_history():
+  """
+   <Purpose>
+      Returns how fast the renewable resources have been used recently.   
+      CPU is left out, since the nanny doesn't see it being used (it is 
+      measured and enforced by the monitor).
+
+   <Arguments>
+      None.
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A dict mapping each renewable resource to a dict that maps each window
+      in repy_constants.RESOURCE_HISTORY_WINDOWS (in seconds) to the average
+      rate (per second) the resource was used at over that window.   Early
+      on, when less than a window has passed, the rate is over the time so 
+      far.   Windows are accurate to repy_constants.RESOURCE_HISTORY_RESOLUTION.
+  """
+  resourcetable = _resource_table
+
+  historydict = {}
+  for resource in resource_constants.renewable_resources:
+    if resource == 'cpu':
+      continue
+
+    resourceid = _resource_ids[resource]
+
+    resourcetable.locks[resourceid].acquire()
+    try:
+      thetime = nonportable.getruntime()
+      total = resourcetable.totals[resourceid]
+      history = resourcetable.histories[resourceid]
+
+      ratedict = {}
+      for window in repy_constants.RESOURCE_HISTORY_WINDOWS:
+        (sampletime, sampletotal) = history.get_total_at(thetime - window, total)
+
+        # Nothing can have been used yet if no time has passed
+        if thetime <= sampletime:
+          ratedict[window] = 0.0
+        else:
+          ratedict[window] = (total - sampletotal) / (thetime - sampletime)
+
+    finally:
+      resourcetable.locks[resourceid].release()
+
+    historydict[resource] = ratedict
+
+  return historydict
+
+
+
+def enable_resource_ledger():
+  """
+   <Purpose>
+      Starts charging renewable resources to the thread that uses them, as 
+      well as to the process.   The ledger is returned by 
+      get_resource_information() under the 'ledger' key of the usage dict.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      Every tattle of a renewable resource is also recorded in the ledger.
+
+   <Returns>
+      None.
+  """
+  global _resource_ledger
+
+  if _resource_ledger is None:
+    _resource_ledger = {}
+
+
+def _record_in_ledger(quantitydict):
+  global _resource_ledger_version
+
+  threadname = threading.currentThread().getName()
+
+  _resource_ledger_lock.acquire()
+  try:
+    if threadname not in _resource_ledger:
+      _resource_ledger[threadname] = {}
+
+    threadentry = _resource_ledger[threadname]
+    for resource in quantitydict:
+      threadentry[resource] = threadentry.get(resource, 0.0) + quantitydict[resource]
+
+    _resource_ledger_version = _next_version()
+
+  finally:
+    _resource_ledger_lock.release()
+
+
+def retire_ledger_thread():
+  """
+   <Purpose>
+      Tells the ledger that the current thread is finishing.   Its entry is
+      kept until RESOURCE_LEDGER_FINISHED_THREADS threads have finished after
+      it, and then added to the LEDGER_FINISHED_KEY entry.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      May merge the entries of older finished threads.
+
+   <Returns>
+      None.
+  """
+  global _resource_ledger_version
+
+  if _resource_ledger is None:
+    return
+
+  threadname = threading.currentThread().getName()
+
+  _resource_ledger_lock.acquire()
+  try:
+    # Threads that never used a renewable resource have no entry
+    if threadname not in _resource_ledger:
+      return
+
+    _finished_ledger_threads.append(threadname)
+
+    while len(_finished_ledger_threads) > repy_constants.RESOURCE_LEDGER_FINISHED_THREADS:
+      oldentry = _resource_ledger.pop(_finished_ledger_threads.popleft())
+
+      if LEDGER_FINISHED_KEY not in _resource_ledger:
+        _resource_ledger[LEDGER_FINISHED_KEY] = {}
+
+      finishedentry = _resource_ledger[LEDGER_FINISHED_KEY]
+      for resource in oldentry:
+        finishedentry[resource] = finishedentry.get(resource, 0.0) + oldentry[resource]
+
+      _resource_ledger_version = _next_version()
+
+  finally:
+    _resource_ledger_lock.release()
+
+
+def get_resource_ledger():
+  """
+   <Purpose>
+      Returns a copy of the ledger.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A dict mapping thread names (as given out by 
+      idhelper.get_new_thread_name) to dicts of how much of each renewable 
+      resource the thread has been charged since the ledger was enabled.   
+      The threads that finished before the last 
+      RESOURCE_LEDGER_FINISHED_THREADS to finish are added up under 
+      LEDGER_FINISHED_KEY instead.   This is None if the ledger is not 
+      enabled.
+  """
+  if _resource_ledger is None:
+    return None
+
+  _resource_ledger_lock.acquire()
+  try:
+    ledgercopy = {}
+    for threadname in _resource_ledger:
+      ledgercopy[threadname] = _resource_ledger[threadname].copy()
+
+    return ledgercopy
+
+  finally:
+    _resource_ledger_lock.release()
+
+
+
+# Finds the API function the current thread is in.   This is the function 
+# called by namespace's wrapped_function, qualified by its class if it is a 
+# method.   Threads that aren't in an API call get 'internal'.
+def _get_calling_api():
+  frame = sys._getframe(1)
+  callee = None
+
+  while frame is not None:
+    code = frame.f_code
+    if code.co_name == 'wrapped_function' and \
+        code.co_filename.replace('\\', '/').split('/')[-1] == 'namespace.py':
+      break
+    callee = frame
+    frame = frame.f_back
+
+  if frame is None or callee is None:
+    return 'internal'
+
+  if 'self' in callee.f_locals:
+    return type(callee.f_locals['self']).__name__ + '.' + callee.f_code.co_name
+
+  return callee.f_code.co_name
+
+
+# Adds a wait for a renewable resource to the stall histograms
+def _record_stall(resource, stalltime):
+  global _stall_histograms_version
+
+  if _trace_file is not None:
+    try:
+      stalledresources = _trace_local.stalledresources
+      if stalledresources is not None:
+        stalledresources[resource] = stalledresources.get(resource, 0.0) + stalltime
+    except AttributeError:
+      # This thread isn't in a traced tattle
+      pass
+
+  apiname = _get_calling_api()
+  bucket = bisect.bisect_left(STALL_HISTOGRAM_BOUNDS, stalltime)
+
+  _stall_histograms_lock.acquire()
+  try:
+    if resource not in _stall_histograms:
+      _stall_histograms[resource] = {}
+
+    if apiname not in _stall_histograms[resource]:
+      _stall_histograms[resource][apiname] = {'count':0, 'total':0.0, 
+          'max':0.0, 'buckets':[0] * (len(STALL_HISTOGRAM_BOUNDS) + 1)}
+
+    entry = _stall_histograms[resource][apiname]
+    entry['count'] = entry['count'] + 1
+    entry['total'] = entry['total'] + stalltime
+    entry['max'] = max(entry['max'], stalltime)
+    entry['buckets'][bucket] = entry['buckets'][bucket] + 1
+
+    _stall_histograms_version = _next_version()
+
+  finally:
+    _stall_histograms_lock.release()
+
+
+def get_stall_histograms():
+  """
+   <Purpose>
+      Returns a copy of the stall histograms.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A dict as described for _stall_histograms.
+  """
+  _stall_histograms_lock.acquire()
+  try:
+    histogramscopy = {}
+    for resource in _stall_histograms:
+      histogramscopy[resource] = {}
+      for apiname in _stall_histograms[resource]:
+        entry = _stall_histograms[resource][apiname].copy()
+        entry['buckets'] = entry['buckets'][:]
+        histogramscopy[resource][apiname] = entry
+
+    return histogramscopy
+
+  finally:
+    _stall_histograms_lock.release()
+
+
+def write_stall_histograms(filename):
+  """
+   <Purpose>
+      Writes the stall histograms to a file, one line per resource and API 
+      function.   The line has the resource, the function, the count, total 
+      and max of the waits, and then the histogram buckets.
+
+   <Arguments>
+      filename:
+         The file to write.
+         
+   <Exceptions>
+      As with open() and file.write().
+
+   <Side Effects>
+      Overwrites the file.
+
+   <Returns>
+      None.
+  """
+  histograms = get_stall_histograms()
+
+  header = ['# resource', 'function', 'count', 'total', 'max']
+  for bound in STALL_HISTOGRAM_BOUNDS:
+    header.append('<=' + str(bound))
+  header.append('>' + str(STALL_HISTOGRAM_BOUNDS[-1]))
+
+  lines = [' '.join(header)]
+
+  resourcelist = histograms.keys()
+  resourcelist.sort()
+  for resource in resourcelist:
+    apinamelist = histograms[resource].keys()
+    apinamelist.sort()
+    for apiname in apinamelist:
+      entry = histograms[resource][apiname]
+      fields = [resource, apiname, str(entry['count']), 
+          '%.6f' % entry['total'], '%.6f' % entry['max']]
+      for bucketcount in entry['buckets']:
+        fields.append(str(bucketcount))
+      lines.append(' '.join(fields))
+
+  fileobj = safe_open(filename, 'w')
+  try:
+    fileobj.write('\n'.join(lines) + '\n')
+  finally:
+    fileobj.close()
+
+
+
+def start_shadow_nanny(resourcefilename):
+  """
+   <Purpose>
+      Starts shadow mode.   Every tattle is also checked against the limits 
+      in another resource file, and the sleeps and refusals those limits 
+      would have caused are recorded (but not enforced).
+
+   <Arguments>
+      resourcefilename: the file that contains the shadow set of resources.
+         
+   <Exceptions>
+      ResourceParseError if the resource file is invalid
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      None.
+  """
+  global _shadow_table
+  global _shadow_results
+
+  resources_allowed_dict, call_list = resourcemanipulation.read_resourcedict_from_file(resourcefilename)
+
+  results = {}
+  for resource in _known_resources:
+    results[resource] = {'stalls':0, 'stalltime':0.0, 'maxstall':0.0, 'refused':0}
+
+  _shadow_results = results
+  _shadow_table = ResourceTable(resources_allowed_dict)
+
+
+def _shadow_tattle_quantities(quantitydict):
+  thetime = nonportable.getruntime()
+
+  _shadow_lock.acquire()
+  try:
+    for resource in quantitydict:
+      resourceid = _resource_ids[resource]
+
+      _update_resource_consumption_table(resourceid, _shadow_table, thetime)
+
+      _shadow_table.consumed[resourceid] = _shadow_table.consumed[resourceid] + quantitydict[resource]
+
+      excess = _shadow_table.consumed[resourceid] - _shadow_table.capacities[resourceid]
+      if excess <= 0:
+        continue
+
+      results = _shadow_results[resource]
+
+      # It would never drain, so the real nanny would have failed
+      if _shadow_table.limits[resourceid] == 0:
+        results['refused'] = results['refused'] + 1
+        continue
+
+      stalltime = excess / _shadow_table.limits[resourceid]
+      results['stalls'] = results['stalls'] + 1
+      results['stalltime'] = results['stalltime'] + stalltime
+      results['maxstall'] = max(results['maxstall'], stalltime)
+
+      # The thread would have slept until the resource drained to its 
+      # capacity, so don't charge this excess again on the next tattle.
+      _shadow_table.consumed[resourceid] = _shadow_table.capacities[resourceid]
+
+  finally:
+    _shadow_lock.release()
+
+
+def _shadow_tattle_add_item(resource, item):
+  resourceid = _resource_ids[resource]
+
+  _shadow_lock.acquire()
+  try:
+    itemsused = _shadow_table.consumed[resourceid]
+
+    if item in itemsused:
+      return
+
+    # This would have been a ResourceExhaustedError.   Don't keep the item, 
+    # since the program wouldn't have had it.
+    if len(itemsused) >= _shadow_table.limits[resourceid]:
+      _shadow_results[resource]['refused'] = _shadow_results[resource]['refused'] + 1
+      return
+
+    itemsused.add(item)
+
+  finally:
+    _shadow_lock.release()
+
+
+def _shadow_tattle_remove_item(resource, item):
+  _shadow_lock.acquire()
+  try:
+    _shadow_table.consumed[_resource_ids[resource]].discard(item)
+  finally:
+    _shadow_lock.release()
+
+
+def _shadow_is_item_allowed(resource, item):
+  _shadow_lock.acquire()
+  try:
+    # The allowed items are a sorted list of ranges
+    if not resourcemanipulation.is_item_in_ranges(_shadow_table.limits[_resource_ids[resource]], item):
+      _shadow_results[resource]['refused'] = _shadow_results[resource]['refused'] + 1
+  finally:
+    _shadow_lock.release()
+
+
+def get_shadow_information():
+  """
+   <Purpose>
+      Returns what the shadow limits would have done.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A tuple (the shadow allowed resource dict, the results dict described 
+      for _shadow_results), or None if shadow mode is off.
+  """
+  if _shadow_table is None:
+    return None
+
+  _shadow_lock.acquire()
+  try:
+    resultscopy = {}
+    for resource in _shadow_results:
+      resultscopy[resource] = _shadow_results[resource].copy()
+
+    return (_shadow_table.allowed_dict.copy(), resultscopy)
+
+  finally:
+    _shadow_lock.release()
+
+
+def format_shadow_report():
+  """
+   <Purpose>
+      Describes what the shadow limits would have done, one line per resource
+      with the shadow limit, the number of sleeps, their total and longest 
+      time, and the number of refused items.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      The report as a string, or '' if shadow mode is off.
+  """
+  shadowinformation = get_shadow_information()
+  if shadowinformation is None:
+    return ''
+
+  (shadowlimits, results) = shadowinformation
+
+  lines = ['# resource shadowlimit stalls stalltime maxstall refused']
+  for resource in _known_resources:
+    limit = shadowlimits[resource]
+    # Ranges of items are written as in a resource file, without spaces
+    if type(limit) is list:
+      rangestrings = []
+      for (first, last) in limit:
+        if first == last:
+          rangestrings.append(str(first))
+        else:
+          rangestrings.append(str(first) + "-" + str(last))
+      limit = ','.join(rangestrings) or '-'
+
+    entry = results[resource]
+    lines.append(' '.join([resource, str(limit), str(entry['stalls']), 
+        '%.6f' % entry['stalltime'], '%.6f' % entry['maxstall'], 
+        str(entry['refused'])]))
+
+  return '\n'.join(lines) + '\n'
+
+
+def write_shadow_report(filename):
+  """
+   <Purpose>
+      Writes format_shadow_report() to a file.
+
+   <Arguments>
+      filename:
+         The file to write.
+         
+   <Exceptions>
+      As with open() and file.write().
+
+   <Side Effects>
+      Overwrites the file.
+
+   <Returns>
+      None.
+  """
+  report = format_shadow_report()
+
+  fileobj = safe_open(filename, 'w')
+  try:
+    fileobj.write(report)
+  finally:
+    fileobj.close()
+
+
+
+def start_trace(tracefilename):
+  """
+   <Purpose>
+      Starts writing every tattle to a binary trace file.   See TRACE_MAGIC 
+      for the format.
+
+   <Arguments>
+      tracefilename: the file to write the trace to.
+         
+   <Exceptions>
+      As with open() and file.write().
+
+   <Side Effects>
+      Overwrites the trace file.   stop_trace() must be called to make sure 
+      everything is written out, and flush_trace() before forking.
+
+   <Returns>
+      None.
+  """
+  global _trace_file
+
+  resourcenames = ','.join(_known_resources)
+
+  tracefile = safe_open(tracefilename, 'wb')
+  tracefile.write(TRACE_MAGIC + struct.pack("<I", len(resourcenames)) + resourcenames)
+  tracefile.flush()
+
+  _trace_file = tracefile
+
+
+def flush_trace():
+  """
+   <Purpose>
+      Writes out the part of the trace that is still buffered.   This must be
+      done before forking, or both processes write it out when they exit.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      As with file.flush().
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      None.
+  """
+  _trace_lock.acquire()
+  try:
+    if _trace_file is not None:
+      _trace_file.flush()
+  finally:
+    _trace_lock.release()
+
+
+def stop_trace():
+  """
+   <Purpose>
+      Stops tracing and closes the trace file.
+
+   <Arguments>
+      None.
+         
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      None.
+  """
+  global _trace_file
+
+  _trace_lock.acquire()
+  try:
+    if _trace_file is not None:
+      _trace_file.close()
+      _trace_file = None
+  finally:
+    _trace_lock.release()
+
+
+def _write_trace_record(thetime, resource, operation, flags, itemkey, quantity, stalltime=0.0):
+  threadname = threading.currentThread().getName()
+
+  _trace_lock.acquire()
+  try:
+    # We may have stopped while this thread was tattling
+    if _trace_file is None:
+      return
+
+    if threadname not in _trace_thread_indices:
+      _trace_thread_indices[threadname] = len(_trace_thread_indices) & 0xffff
+
+    _trace_file.write(TRACE_RECORD.pack(thetime, _trace_thread_indices[threadname],
+        _resource_ids[resource], operation, flags, itemkey, quantity, stalltime))
+
+  finally:
+    _trace_lock.release()
+
+
+# Calls tattlefunc(quantitydict, *args) and writes a trace record for each 
+# resource.   The records say if (and how long) the thread had to wait for 
+# the resource.
+def _traced_tattle_quantities(quantitydict, tattlefunc, *args):
+  _trace_local.stalledresources = {}
+  thetime = nonportable.getruntime()
+
+  try:
+    return tattlefunc(quantitydict, *args)
+
+  finally:
+    stalledresources = _trace_local.stalledresources
+    _trace_local.stalledresources = None
+
+    for resource in quantitydict:
+      if resource in stalledresources:
+        _write_trace_record(thetime, resource, TRACE_QUANTITY, TRACE_BLOCKED, 
+            0, quantitydict[resource], stalledresources[resource])
+      else:
+        _write_trace_record(thetime, resource, TRACE_QUANTITY, 0, 0, quantitydict[resource])
+
+
+
+class ResourceQuota(object):
+  """
+  A sub-quota for the code in a VirtualNamespace.   resources is the set of
+  resources the sub-quota limits, and table is a ResourceTable with those 
+  limits.   The other resources in the table are never charged.
+  """
+
+  __slots__ = ['resources', 'table']
+
+  def __init__(self, resources, table):
+    self.resources = resources
+    self.table = table
+
+
+
+def create_resource_quota(quotadict):
+  """
+   <Purpose>
+      Makes a sub-quota from a dict of limits.
+
+   <Arguments>
+      quotadict:
+         A dict mapping resource names to limits.   Renewable resources (like
+         'netsend') and fungible item resources (like 'events') take a 
+         number.   'messport' and 'connport' take a list of allowed ports 
+         and (first, last) port ranges, like getresources() returns.
+         Resources that aren't in the dict are only limited by the code that
+         evaluates the namespace.
+
+   <Exceptions>
+      RepyArgumentError if the dict is malformed, or it limits 'cpu', 
+      'memory' or 'diskused' (which are measured for the whole process).
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A ResourceQuota.
+  """
+  if type(quotadict) is not dict:
+    raise RepyArgumentError("Sub-quota must be a dict!")
+
+  # The dict belongs to the program, which could change it while we look
+  quotadict = quotadict.copy()
+
+  # Start from the nanny's limits, without any burst capacities (which would
+  # otherwise apply to the sub-quota's renewable resources)
+  resourcesalloweddict = {}
+  for resource in _known_resources:
+    resourcesalloweddict[resource] = _resource_table.allowed_dict[resource]
+
+  resources = set()
+  for resource in quotadict:
+    if type(resource) is not str or resource not in _resource_ids:
+      raise RepyArgumentError("Unknown resource '"+str(resource)+"' in sub-quota!")
+
+    if resource in resource_constants.must_assign_resources:
+      raise RepyArgumentError("Resource '"+resource+"' is measured for the whole process and can't have a sub-quota!")
+
+    limit = quotadict[resource]
+
+    if resource in resource_constants.individual_item_resources:
+      if type(limit) is not list:
+        raise RepyArgumentError("Sub-quota for '"+resource+"' must be a list of ports!")
+
+      rangelist = []
+      for port in limit[:]:
+        if type(port) in [int, long]:
+          rangelist.append((port, port))
+        elif type(port) is tuple and len(port) == 2 and \
+            type(port[0]) in [int, long] and type(port[1]) in [int, long] and \
+            port[0] <= port[1]:
+          rangelist.append(port)
+        else:
+          raise RepyArgumentError("Sub-quota for '"+resource+"' must be a list of ports!")
+
+      resourcesalloweddict[resource] = resourcemanipulation.merge_ranges(rangelist)
+
+    else:
+      if type(limit) not in [int, long, float]:
+        raise RepyArgumentError("Sub-quota for '"+resource+"' must be a number!")
+
+      # A renewable resource with a limit of 0 would never drain
+      if limit < 0 or (limit == 0 and resource in resource_constants.renewable_resources):
+        raise RepyArgumentError("Sub-quota for '"+resource+"' must be positive!")
+
+      resourcesalloweddict[resource] = limit
+
+    resources.add(resource)
+
+  return ResourceQuota(resources, ResourceTable(resourcesalloweddict))
+
+
+
+def get_thread_quotas():
+  """
+   <Purpose>
+      Returns the sub-quotas the current thread is charged to.   A thread 
+      that creates another should pass these to set_thread_quotas() in the 
+      new thread.
+
+   <Arguments>
+      None.
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None.
+
+   <Returns>
+      A tuple of ResourceQuotas, outermost first.
+  """
+  return _quota_local.quotas
+
+
+def set_thread_quotas(quotas):
+  _quota_local.quotas = quotas
+
+
+
+# Charges renewable resources to the sub-quotas that limit them
+def _tattle_quotas(quantitydict, quotas):
+  for quota in quotas:
+    quotaquantitydict = {}
+    for resource in quantitydict:
+      if resource in quota.resources:
+        quotaquantitydict[resource] = quantitydict[resource]
+
+    if quotaquantitydict:
+      _tattle_quantities(quotaquantitydict, quota.table)
+
+
+# Adds an item to the sub-quotas that limit its resource, then calls 
+# addfunc(resource, item) (which charges the nanny).   If any of them refuse 
+# the item, it is taken back out of the sub-quotas it was added to.
+def _tattle_add_item_to_quotas(resource, item, quotas, addfunc):
+  addedtables = []
+  try:
+    for quota in quotas:
+      if resource in quota.resources:
+        # It's already acquired, so there is nothing to undo
+        if item in quota.table.consumed[_resource_ids[resource]]:
+          continue
+
+        _tattle_add_item(resource, item, quota.table)
+        addedtables.append(quota.table)
+
+    addfunc(resource, item)
+
+  except:
+    for resourcetable in addedtables:
+      _tattle_remove_item(resource, item, resourcetable)
+    raise
+
+  if addedtables:
+    _quota_items_lock.acquire()
+    try:
+      _quota_items[(resource, item)] = addedtables
+    finally:
+      _quota_items_lock.release()
+
+
+# Removes an item from the sub-quotas it was added to
+def _tattle_remove_item_from_quotas(resource, item):
+  _quota_items_lock.acquire()
+  try:
+    addedtables = _quota_items.pop((resource, item), [])
+  finally:
+    _quota_items_lock.release()
+
+  for resourcetable in addedtables:
+    _tattle_remove_item(resource, item, resourcetable)
+
+
+
+def acquire_leases(quantitydict):
+  return _acquire_leases(quantitydict, _resource_table)
+
+
+def release_lease(lease):
+  return _release_lease(lease)
+
+
+
+class LeasedTattler(object):
+  """
+  Charges renewable resources on behalf of a single file or socket.   It
+  passes charges straight through to the nanny until the object is charged
+  LEASE_STREAMING_CALLS times within LEASE_STREAMING_WINDOW seconds.   From
+  then on it charges leases of LEASE_DURATION seconds worth of each 
+  resource's limit, so that most charges don't touch the nanny's locks.
+
+  Unused lease budget is returned when a lease runs out or expires (on the 
+  next charge) and when release() is called, which the owner must do when 
+  it is closed.
+  """
+
+  __slots__ = ['lock', 'leases', 'windowstart', 'callcount', 'streaming']
+
+  def __init__(self):
+    # This only serializes the threads using this one file or socket
+    self.lock = threading.Lock()
+
+    # Maps resource names to ResourceLease objects
+    self.leases = {}
+
+    # When the current streaming detection window started, and how many 
+    # charges we've seen in it.   We stop streaming after a whole window 
+    # with too few charges.
+    self.windowstart = 0.0
+    self.callcount = 0
+    self.streaming = False
+
+
+  def tattle_quantity(self, resource, quantity):
+    """
+     <Purpose>
+        Charges a renewable resource, like nanny.tattle_quantity.
+
+     <Arguments>
+        resource:
+           A string with the resource name.
+        quantity:
+           The amount consumed.   This can be zero (to block if the resource 
+           is over subscribed and no lease covers it).
+
+     <Exceptions>
+        As with nanny.tattle_quantity.
+
+     <Side Effects>
+        May sleep the program until the resource is available.
+
+     <Returns>
+        None.
+    """
+    self.tattle_quantities({resource: quantity})
+
+
+  def tattle_quantities(self, quantitydict):
+    """
+     <Purpose>
+        Charges several renewable resources, like nanny.tattle_quantities.
+
+     <Arguments>
+        quantitydict:
+           A dict mapping resource names to the amount consumed.
+
+     <Exceptions>
+        As with nanny.tattle_quantities.
+
+     <Side Effects>
+        May sleep the program until the resources are available.
+
+     <Returns>
+        None.
+    """
+    if _quota_local.quotas:
+      _tattle_quotas(quantitydict, _quota_local.quotas)
+
+    if _resource_ledger is not None:
+      _record_in_ledger(quantitydict)
+
+    if _shadow_table is not None:
+      _shadow_tattle_quantities(quantitydict)
+
+    if _trace_file is not None:
+      _traced_tattle_quantities(quantitydict, self._charge)
+    else:
+      self._charge(quantitydict)
+
+
+  def _charge(self, quantitydict):
+    # Charges the quantities, from the leases if we're streaming
+    thetime = nonportable.getruntime()
+
+    # The charges the current leases can't cover
+    uncovered = {}
+
+    # Leases we need to give back to the nanny
+    staleleases = []
+
+    self.lock.acquire()
+    try:
+      # Are we streaming?
+      if thetime - self.windowstart > LEASE_STREAMING_WINDOW:
+        # (the last window only counts if it just ended)
+        self.streaming = self.callcount >= LEASE_STREAMING_CALLS and \
+            thetime - self.windowstart <= 2 * LEASE_STREAMING_WINDOW
+        self.windowstart = thetime
+        self.callcount = 0
+
+      self.callcount = self.callcount + 1
+      if self.callcount >= LEASE_STREAMING_CALLS:
+        self.streaming = True
+
+      streaming = self.streaming
+
+      for resource in quantitydict:
+        if resource in self.leases:
+          if streaming and self.leases[resource].consume(quantitydict[resource], thetime):
+            continue
+
+          # This lease has run out, expired, or we stopped streaming
+          staleleases.append(self.leases[resource])
+          del self.leases[resource]
+
+        uncovered[resource] = quantitydict[resource]
+
+    finally:
+      self.lock.release()
+
+    for lease in staleleases:
+      _release_lease(lease)
+
+    if not uncovered:
+      return
+
+    if not streaming:
+      _tattle_quantities(uncovered, _resource_table)
+      return
+
+    # Lease enough for this charge and then some
+    leasequantitydict = {}
+    for resource in uncovered:
+      leasequantitydict[resource] = max(uncovered[resource], 
+          _resource_table.limits[_resource_ids[resource]] * LEASE_DURATION)
+
+    newleases = _acquire_leases(leasequantitydict, _resource_table)
+
+    self.lock.acquire()
+    try:
+      for resource in newleases:
+        newleases[resource].remaining = newleases[resource].remaining - uncovered[resource]
+
+        # Another thread using this object may have beaten us to it
+        if resource in self.leases:
+          staleleases.append(self.leases[resource])
+        self.leases[resource] = newleases[resource]
+
+    finally:
+      self.lock.release()
+
+    for lease in staleleases:
+      _release_lease(lease)
+
+
+  def release(self):
+    """
+     <Purpose>
+        Returns the unused part of all leases to the nanny.   The tattler 
+        can still be used afterwards.
+
+     <Arguments>
+        None.
+
+     <Exceptions>
+        None.
+
+     <Side Effects>
+        None.
+
+     <Returns>
+        None.
+    """
+    self.lock.acquire()
+    try:
+      staleleases = self.leases.values()
+      self.leases = {}
+    finally:
+      self.lock.release()
+
+    for lease in staleleases:
+      _release_lease(lease)
+
+
+
+# Armon: This is an extremely basic wrapper function, that just allows
+# for pre/post processing if required in the future
+def get_resource_limit(resource):
+  """
+  <Purpose>
+    Returns the limit or availability of a resource.
+
+  <Arguments>
+    resource:
+      The resource about which information is being requested.
+
+  <Exceptions>
+    KeyError if the resource does not exist.
+
+  <Side Effects>
+    None
+
+  <Returns>
+    The resource availability or limit.
+  """
+
+  return _resource_table.limits[_resource_ids[resource]]
+
+
+
+
+
+
+
+
+
+class CPUThrottle(object):
+  """
+  Decides when, and for how long, to stop a process so that its CPU use 
+  tracks the CPU limit.   Rather than one long stop after each sample, it 
+  stops the process for at most repy_constants.CPU_STOP_MAX at a time and 
+  lets it run in short slices in between, so its threads never freeze for 
+  long.
+
+  This is a PI controller.   The integral term is the CPU time the process 
+  has used beyond its limit (the debt), which the stops pay back.   The 
+  proportional term is how far over the limit the process has been over the
+  last repy_constants.CPU_STOP_WINDOW seconds.   It predicts the debt the 
+  next run slice will add, so that it is paid as it is made.
+  """
+
+  __slots__ = ['pollinterval', 'lasttime', 'lastcpu', 'debt', 'window', 'share']
+
+  def __init__(self, pollinterval):
+    # How often to sample the process while it is under its limit
+    self.pollinterval = pollinterval
+
+    self.lasttime = None
+    self.lastcpu = None
+    self.debt = 0.0
+
+    # The fraction of a CPU the process used over the window
+    self.share = 0.0
+
+    # (time, CPU time) samples over the last CPU_STOP_WINDOW seconds
+    self.window = collections.deque()
+
+
+  def update(self, cpulimit, thetime, cputime):
+    """
+     <Purpose>
+        Records a sample of the process's CPU use, and decides how long to
+        stop the process for.
+
+     <Arguments>
+        cpulimit:
+           The fraction of a CPU the process may use.
+        thetime:
+           The time of the sample (getruntime()).
+        cputime:
+           The total CPU time the process has used.
+
+     <Exceptions>
+        None.
+
+     <Side Effects>
+        None.
+
+     <Returns>
+        A tuple (how long to stop the process for now, how long to let it
+        run before the next sample), in seconds.
+    """
+    pollinterval = self.pollinterval
+
+    # Give them a free pass if it's their first time...
+    if self.lasttime is None:
+      self.lasttime = thetime
+      self.lastcpu = cputime
+      self.window.append((thetime, cputime))
+      return (0.0, pollinterval)
+
+    elapsedtime = thetime - self.lasttime
+    if elapsedtime <= 0:
+      return (0.0, pollinterval)
+
+    # The integral term.   An idle process may bank at most a window's 
+    # worth of CPU (like a burst).
+    self.debt = self.debt + (cputime - self.lastcpu) - cpulimit * elapsedtime
+    self.debt = max(self.debt, -cpulimit * repy_constants.CPU_STOP_WINDOW)
+
+    self.lasttime = thetime
+    self.lastcpu = cputime
+
+    # Keep one sample from before the window so the window is full
+    self.window.append((thetime, cputime))
+    windowstart = thetime - repy_constants.CPU_STOP_WINDOW
+    while len(self.window) > 2 and self.window[1][0] <= windowstart:
+      self.window.popleft()
+
+    (oldesttime, oldestcpu) = self.window[0]
+    windowshare = (cputime - oldestcpu) / (thetime - oldesttime)
+    self.share = windowshare
+
+    # Under the limit, so just keep an eye on it
+    if self.debt <= 0 and windowshare <= cpulimit:
+      return (0.0, pollinterval)
+
+    # It'll never be allowed to run
+    if cpulimit <= 0:
+      return (repy_constants.CPU_STOP_MAX, 0.0)
+
+    # The run slice that, with the longest stop, uses exactly the limit
+    if cpulimit < 1:
+      runtime = min(repy_constants.CPU_STOP_MAX * cpulimit / (1 - cpulimit), pollinterval)
+    else:
+      runtime = pollinterval
+
+    # The proportional term: the debt the next run slice adds at the rate
+    # the process has been using the CPU
+    predicteddebt = max(windowshare - cpulimit, 0) * runtime
+
+    # The process uses no CPU while it is stopped, so each second stopped 
+    # pays back cpulimit seconds of debt
+    stoptime = (max(self.debt, 0) + predicteddebt) / cpulimit
+
+    if stoptime > repy_constants.CPU_STOP_MAX:
+      # The longest stop can't pay it all, so pay the rest by letting it run
+      # for less time.   (This also makes up for the time it takes us to 
+      # stop and start it, which it gets to run for too.)   It must still 
+      # get to run between stops, or the stops would add up to a long one.
+      unpaiddebt = (stoptime - repy_constants.CPU_STOP_MAX) * cpulimit
+      stoptime = repy_constants.CPU_STOP_MAX
+      if cpulimit < 1:
+        runtime = max(runtime - unpaiddebt / (1 - cpulimit), runtime / 2)
+
+    return (stoptime, runtime)
+
+
+
+class PollingInterval(object):
+  """
+  Decides how long to wait before checking a resource again, given how 
+  close to its limit the resource is.   The wait doubles (up to maximum) 
+  while the resource stays under repy_constants.MONITOR_HEADROOM of its 
+  limit, and is cut so that, at the rate the use is growing, it can't get 
+  past that before the next check.   Once it is past, the wait is minimum.
+  """
+
+  __slots__ = ['minimum', 'maximum', 'interval', 'lasttime', 'lastfraction']
+
+  def __init__(self, minimum, maximum):
+    self.minimum = minimum
+    # The minimum may have been raised for a slow device
+    self.maximum = max(maximum, minimum)
+    self.interval = minimum
+
+    self.lasttime = None
+    self.lastfraction = None
+
+
+  def update(self, fraction, thetime):
+    """
+     <Purpose>
+        Records how much of its limit a resource is using, and decides when
+        to check it next.
+
+     <Arguments>
+        fraction:
+           How much of its limit the resource is using (1.0 is all of it).
+        thetime:
+           The time of the check (getruntime()).
+
+     <Exceptions>
+        None.
+
+     <Side Effects>
+        None.
+
+     <Returns>
+        How long to wait before the next check, in seconds.
+    """
+    headroom = repy_constants.MONITOR_HEADROOM
+
+    if fraction >= headroom:
+      interval = self.minimum
+
+    else:
+      interval = min(self.interval * 2, self.maximum)
+
+      # Don't let it get past the headroom between checks
+      if self.lasttime is not None and thetime > self.lasttime:
+        rate = (fraction - self.lastfraction) / (thetime - self.lasttime)
+        if rate > 0:
+          interval = min(interval, (headroom - fraction) / rate)
+
+      interval = max(interval, self.minimum)
+
+    self.interval = interval
+    self.lasttime = thetime
+    self.lastfraction = fraction
+
+    return interval
+
+
+
+# The ids of the resources get_resource_information reports, by kind
+_quantity_resource_ids = []
+for _resourcename in resource_constants.quantity_resources:
+  _quantity_resource_ids.append(_resource_ids[_resourcename])
+
+_fungible_item_resource_ids = []
+for _resourcename in resource_constants.fungible_item_resources:
+  _fungible_item_resource_ids.append(_resource_ids[_resourcename])
+
+_individual_item_resource_ids = []
+for _resourcename in resource_constants.individual_item_resources:
+  _individual_item_resource_ids.append(_resource_ids[_resourcename])
+
+
+
+class _InformationSnapshot(object):
+  """
+  What get_resource_information last returned, and the versions of the 
+  resource table, stall histograms and ledger it was built from.
+  """
+
+  __slots__ = ['resourcetable', 'version', 'allowed_dict', 'limits',
+      'itemversions', 'usage']
+
+  def __init__(self, resourcetable, version):
+    self.resourcetable = resourcetable
+    self.version = version
+    self.allowed_dict = None
+    self.limits = None
+    self.itemversions = [0] * len(_known_resources)
+    self.usage = None
+
+
+
+# The snapshot get_resource_information returns until something changes
+_information_snapshot = None
+_information_snapshot_lock = threading.Lock()
+
+
+
+def get_resource_version():
+  """
+  <Purpose>
+    Returns something that changes whenever what get_resource_information()
+    returns does.
+
+  <Arguments>
+    None
+  
+  <Exceptions>
+    None
+  
+  <Side Effects>
+    None
+
+  <Returns>
+    A tuple of the versions of the resource table, the stall histograms and
+    the ledger.   Only compare it for equality.
+  """
+  return (_resource_table.version, _stall_histograms_version, _resource_ledger_version)
+
+
+
+def get_resource_information():
+  """
+  <Purpose>
+    Returns information about how many resources have been used.   Only the
+    parts that changed since the last call are rebuilt.
+  
+  <Arguments>
+    None
+  
+  <Exceptions>
+    None
+  
+  <Side Effects>
+    None
+
+  <Returns>
+    A tuple: (the allowed resource dict, and usage dict).   Usage information
+    is sanitized to remove unnecessary things like locks.   The dicts (and
+    what they hold) are shared with later calls, until something changes,
+    so they must not be modified.
+  """
+  global _information_snapshot
+
+  _information_snapshot_lock.acquire()
+  try:
+    resourcetable = _resource_table
+
+    # Read the versions before anything else, so that a change made while 
+    # the snapshot is built makes the next call build it again
+    version = get_resource_version()
+
+    oldsnapshot = _information_snapshot
+    if oldsnapshot is not None and oldsnapshot.resourcetable is not resourcetable:
+      oldsnapshot = None
+
+    if oldsnapshot is not None and oldsnapshot.version == version:
+      return (oldsnapshot.limits, oldsnapshot.usage)
+
+    snapshot = _InformationSnapshot(resourcetable, version)
+
+    # the resources we are allowed to use only change when the resource 
+    # file is reloaded.   We just copy this...
+    snapshot.allowed_dict = resourcetable.allowed_dict
+    if oldsnapshot is not None and oldsnapshot.allowed_dict is snapshot.allowed_dict:
+      snapshot.limits = oldsnapshot.limits
+    else:
+      snapshot.limits = snapshot.allowed_dict.copy()
+
+    # from the table, we only take the consumption.   (this omits locks and 
+    # timing information that isn't needed)
+
+    # first, let's do the easy thing, the quantity resources.   These are 
+    # just floats
+    resource_use_dict = {}
+    for resourceid in _quantity_resource_ids:
+      resource_use_dict[_known_resources[resourceid]] = resourcetable.consumed[resourceid]
+
+    # for the fungible resources (files opened, etc,), we only need a count...
+    for resourceid in _fungible_item_resource_ids:
+      resource_use_dict[_known_resources[resourceid]] = len(resourcetable.consumed[resourceid])
+
+    # for the individual item resources (ports, etc,), we copy the set, 
+    # unless it is the same as last time...
+    for resourceid in _individual_item_resource_ids:
+      resource = _known_resources[resourceid]
+      itemversion = resourcetable.itemversions[resourceid]
+      if oldsnapshot is not None and oldsnapshot.itemversions[resourceid] == itemversion:
+        resource_use_dict[resource] = oldsnapshot.usage[resource]
+      else:
+        resource_use_dict[resource] = resourcetable.consumed[resourceid].copy()
+      snapshot.itemversions[resourceid] = itemversion
+
+    # how long threads waited for renewable resources, and in which calls
+    if oldsnapshot is not None and oldsnapshot.version[1] == version[1]:
+      resource_use_dict['stalls'] = oldsnapshot.usage['stalls']
+    else:
+      resource_use_dict['stalls'] = get_stall_histograms()
+
+    # the ledger (if there is one) says which threads used the renewable 
+    # resources
+    if _resource_ledger is not None:
+      if oldsnapshot is not None and oldsnapshot.version[2] == version[2] and \
+          'ledger' in oldsnapshot.usage:
+        resource_use_dict['ledger'] = oldsnapshot.usage['ledger']
+      else:
+        resource_use_dict['ledger'] = get_resource_ledger()
+
+    snapshot.usage = resource_use_dict
+    _information_snapshot = snapshot
+
+    # and that's it!
+    return (snapshot.limits, snapshot.usage)
+
+  finally:
+    _information_snapshot_lock.release()
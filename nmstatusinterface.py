@@ -3,7 +3,8 @@
 #
 # This file houses the code used for interactions between repy and the node manager.
 # Namely, it checks for a stopfile to inform us to terminate, and it periodically
-# writes a status file informing the NM of our status.
+# writes a status file informing the NM of our status.   It can also check for 
+# a reload file, which tells us to re-read the resource file.
 #
 
 # This is used to write out our status
@@ -36,6 +37,12 @@ safe_open = open
 # Store our important variables
 stopfilename = None
 statusfilename_prefix = None
+reloadfilename = None
+reloadfunction = None
+
+# Functions (taking no arguments) that are called each time we write our 
+# status, to write out more status information
+statusfunctions = []
 frequency = 1     # Check rate in seconds
 
 # This lock is to allow the thread to run
@@ -43,7 +50,7 @@ frequency = 1     # Check rate in seconds
 run_thread_lock = threading.Lock()
 
 
-def init(stopfile=None, statusfile=None, freq=1):
+def init(stopfile=None, statusfile=None, freq=1, reloadfile=None, reloadfunc=None):
   """
   <Purpose>
     Prepares the module to run.
@@ -57,8 +64,16 @@ def init(stopfile=None, statusfile=None, freq=1):
 
     freq:
       The frequency of checks for the stopfile and status updates. 1 second is default.
+
+    reloadfile:
+      The name of the reload file to check for. When it is created, it is removed
+      and reloadfunc is called. Set to None to disable checking for a reload file.
+
+    reloadfunc:
+      A function taking no arguments that re-reads the resource file.
   """
   global stopfilename, statusfilename_prefix, frequency
+  global reloadfilename, reloadfunction
 
   # Check for the stopfile
   if stopfile != None and os.path.exists(stopfile):
@@ -68,6 +83,8 @@ def init(stopfile=None, statusfile=None, freq=1):
   stopfilename = stopfile
   statusfilename_prefix = statusfile
   frequency = freq
+  reloadfilename = reloadfile
+  reloadfunction = reloadfunc
 
   # Initialize statusstorage
   statusstorage.init(statusfilename_prefix)
@@ -87,8 +104,8 @@ def launch(pid):
   """
 
   # Check if we need to do anything
-  global stopfilename, statusfilename_prefix
-  if stopfilename == None and statusfilename_prefix == None:
+  global stopfilename, statusfilename_prefix, reloadfilename
+  if stopfilename == None and statusfilename_prefix == None and reloadfilename == None:
     return
 
   # Launch the thread    
@@ -110,8 +127,9 @@ def stop():
 # This is an internal function called when the stopfile is found
 # It handles some of the nonportable details for nm_interface_thread
 def _stopfile_exit(exitcode, pid):
-  # On Windows, we are in the Repy process, so we can just use harshexit
-  if harshexit.ostype in ["Windows"]:
+  # On Windows (or with the shared monitor daemon), we are in the Repy 
+  # process, so we can just use harshexit
+  if harshexit.ostype in ["Windows"] or pid is None:
     # Harshexit will store the appriopriate status for us
     harshexit.harshexit(exitcode)
 
@@ -147,7 +165,7 @@ class nm_interface_thread(threading.Thread):
 
 
   def run(self):
-    global stopfilename, frequency, run_thread_lock
+    global stopfilename, reloadfilename, frequency, run_thread_lock
     
     # On Windows elevate our priority above the user code.
     if harshexit.ostype in ["Windows"]:
@@ -171,6 +189,13 @@ class nm_interface_thread(threading.Thread):
       # Release the status lock
       statuslock.release()
 
+      # Write out any other status information
+      for statusfunction in statusfunctions:
+        try:
+          statusfunction()
+        except Exception, e:
+          print "[WARN] Failed to write status information:", e
+
       # Look for the stopfile
       if stopfilename != None and os.path.exists(stopfilename):
         try:
@@ -205,6 +230,20 @@ class nm_interface_thread(threading.Thread):
           # On any issue, just do "Stopped" (44)
           _stopfile_exit(44, self.repy_process_id)
 
+      # Look for the reload file
+      if reloadfilename != None and os.path.exists(reloadfilename):
+        # Remove it first, so that it can be created again while we reload
+        try:
+          os.remove(reloadfilename)
+        except OSError:
+          pass
+
+        # If the new resource file is bad, we keep running with the old limits
+        try:
+          reloadfunction()
+        except Exception, e:
+          print "[WARN] Failed to reload the resource file:", e
+
       # Sleep until the next loop around.
       time.sleep(frequency)
 
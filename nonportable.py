@@ -54,6 +54,9 @@ import nanny
 # This is used for IPC
 import marshal
 
+# The resource monitor publishes repy's resource use in a shared page
+import statspage
+
 # This will fail on non-windows systems
 try:
   import windows_api as windows_api
@@ -120,8 +123,10 @@ def preparesocket(socketobject):
 # and a thread on the external process for *NIX
 def monitor_cpu_disk_and_mem():
   if ostype == 'Linux' or ostype == 'Darwin':  
-    # Startup a CPU monitoring thread/process
-    do_forked_resource_monitor()
+    # Register with the shared monitor if we were asked to, or startup a 
+    # CPU monitoring thread/process
+    if monitor_socket_path is None or not register_with_monitor_daemon():
+      do_forked_resource_monitor()
     
   elif ostype == 'Windows':
     # Now we set up a cpu nanny...
@@ -152,10 +157,62 @@ last_timestamp = time.time()
 # This is our uptime granularity
 granularity = 1
 
-# This ensures only one thread calling getruntime at any given time
+# This ensures only one thread calling _getruntime_uptime at any given time
 runtimelock = threading.Lock()
 
+# If the OS API provides a monotonic clock, getruntime uses it instead of
+# reconciling the system uptime with time.time(). The start value is taken
+# when this module is loaded.
+monotonic_clock_available = False
+monotonic_starttime = 0.0
+
 def getruntime():
+  """
+   <Purpose>
+      Return the amount of time the program has been running.   This is in
+      wall clock time.   On systems with a monotonic clock the returned
+      values never decrease, and no lock is taken.
+
+   <Arguments>
+      None
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None
+
+   <Returns>
+      The elapsed time as float
+  """
+  if monotonic_clock_available:
+    return _getruntime_monotonic()
+  else:
+    return _getruntime_uptime()
+
+
+def _getruntime_monotonic():
+  """
+   <Purpose>
+      getruntime backend for systems with a monotonic clock. It does not
+      lock, and does not read /proc.
+
+   <Arguments>
+      None
+
+   <Exceptions>
+      None.
+
+   <Side Effects>
+      None
+
+   <Returns>
+      The elapsed time as float
+  """
+  return os_api.get_monotonic_time() - monotonic_starttime
+
+
+def _getruntime_uptime():
   """
    <Purpose>
       Return the amount of time the program has been running.   This is in
@@ -253,13 +310,31 @@ def getruntime():
   return elapsedtime
  
 
-# This lock is used to serialize calls to get_resources
+# This lock is used to serialize reading the process's resource use from
+# the OS
 get_resources_lock = threading.Lock()
 
-# Cache the disk used from the external process
+# The (cpu, memory) that was last read from the OS, and when (getruntime())
+process_usage_sample = None
+process_usage_sample_time = None
+
+# The CPU time of each thread that was last read from the OS, and when
+class _ThreadCPUSample(threading.local):
+  cpu = 0.0
+  time = None
+
+thread_cpu_sample = _ThreadCPUSample()
+
+# The disk used, if there is no stats page.   (Windows doesn't measure it 
+# for getresources.)
 cached_disk_used = 0L
 
-# This array holds the times that repy was stopped.
+# The page the resource monitor publishes repy's resource use in, on *NIX.
+# A forked monitor maps it before it forks, and the monitor daemon sends 
+# repy its file on the "statspage" channel.
+stats_page = None
+
+# This array holds the times that repy was stopped on Windows.
 # It is an array of tuples, of the form (time, amount)
 # where time is when repy was stopped (from getruntime()) and amount
 # is the stop time in seconds. The last process_stopped_max_entries are retained
@@ -280,10 +355,15 @@ def get_resources():
     A tuple of dictionaries and an array (limits, usage, stoptimes).
 
     Limits is the dictionary which maps the resource name
-    to its maximum limit.
+    to its maximum limit.   'messport' and 'connport' map to a 
+    sorted list of (first, last) ranges of allowed ports.
 
     Usage is the dictionary which maps the resource name
-    to its current usage.
+    to its current usage.   If repy was started with --ledger, 
+    usage['ledger'] maps each thread name to a dictionary of 
+    how much of each renewable resource that thread has used.
+    usage['stalls'] maps each renewable resource to the API 
+    functions that waited for it, and how long they waited.
 
     Stoptimes is an array of tuples with the times which the Repy process
     was stopped and for how long, due to CPU over-use.
@@ -293,60 +373,147 @@ def get_resources():
 
     The stop times array holds a fixed number of the last stop times.
     Currently, it holds the last 100 stop times.
+
+    On *NIX, the cpu, memory and diskused usage and the stop times are 
+    what the resource monitor last published in the stats page.   What is
+    read from the OS may be up to repy_constants.RESOURCE_USAGE_MAX_AGE 
+    seconds old.
   """
+  # The nanny's part is shared with later calls (until something is used), 
+  # so add to a copy of it
+  (limits,usage) = nanny.get_resource_information()
+  usage = usage.copy()
+
+  currenttime = getruntime()
+
+  # What the resource monitor last published, if it has
+  stats = None
+  if stats_page is not None:
+    stats = stats_page.read()
+
+  if stats is not None:
+    (usage["cpu"], usage["memory"], usage["diskused"], stoptimes) = stats
+
+  else:
+    (usage["cpu"], usage["memory"]) = _get_process_usage(currenttime)
+
+    # Use the cached disk used amount
+    usage["diskused"] = cached_disk_used
+
+    # Copy the stop times
+    stoptimes = process_stopped_timeline[:]
+
+  # Only the thread itself can find its CPU use
+  usage["threadcpu"] = _get_thread_cpu_time(currenttime)
+
+  # Return the dictionaries and the stoptimes
+  return (limits,usage,stoptimes)
+
+
+# Returns the process's (cpu, memory), reading them from the OS if the last
+# reading is too old
+def _get_process_usage(currenttime):
+  global process_usage_sample
+  global process_usage_sample_time
+
   # Acquire the lock...
   get_resources_lock.acquire()
 
   # ...but always release it
   try:
-    # Construct the dictionaries as copies from nanny
-    (limits,usage) = nanny.get_resource_information()
-
+    if process_usage_sample_time is not None and \
+        currenttime - process_usage_sample_time <= repy_constants.RESOURCE_USAGE_MAX_AGE:
+      return process_usage_sample
 
-    # Calculate all the usage's
     pid = os.getpid()
 
-    # Get CPU and memory, this is thread specific
     if ostype in ["Linux", "Darwin"]:
-    
-      # Get CPU first, then memory
-      usage["cpu"] = os_api.get_process_cpu_time(pid)
-
-      # This uses the cached PID data from the CPU check
-      usage["memory"] = os_api.get_process_rss()
-
-      # Get the thread specific CPU usage
-      usage["threadcpu"] = os_api.get_current_thread_cpu_time() 
+      # Get CPU and memory with one query
+      (cpu, memory) = os_api.get_process_cpu_time_and_rss(pid)
 
+      # The kernel enforces the limits if we are in a cgroup, so use its
+      # numbers
+      if cgroup_path is not None:
+        cpu = os_api.get_cgroup_cpu_stat(cgroup_path)["usage_usec"] / 1000000.0
+        memory = os_api.get_cgroup_memory_current(cgroup_path)
 
     # Windows Specific versions
     elif ostype in ["Windows"]:
     
       # Get the CPU time
-      usage["cpu"] = windows_api.get_process_cpu_time(pid)
+      cpu = windows_api.get_process_cpu_time(pid)
 
       # Get the memory, use the resident set size
-      usage["memory"] = windows_api.process_memory_info(pid)['WorkingSetSize'] 
-
-      # Get thread-level CPU 
-      usage["threadcpu"] = windows_api.get_current_thread_cpu_time()
+      memory = windows_api.process_memory_info(pid)['WorkingSetSize'] 
 
     # Unknown OS
     else:
       raise EnvironmentError("Unsupported Platform!")
 
-    # Use the cached disk used amount
-    usage["diskused"] = cached_disk_used
+    process_usage_sample = (cpu, memory)
+    process_usage_sample_time = currenttime
+    return process_usage_sample
 
   finally:
     # Release the lock
     get_resources_lock.release()
 
-  # Copy the stop times
-  stoptimes = process_stopped_timeline[:]
 
-  # Return the dictionaries and the stoptimes
-  return (limits,usage,stoptimes)
+# Returns the current thread's CPU time, reading it from the OS if the last
+# reading is too old
+def _get_thread_cpu_time(currenttime):
+  sample = thread_cpu_sample
+
+  if sample.time is None or currenttime - sample.time > repy_constants.RESOURCE_USAGE_MAX_AGE:
+    if ostype in ["Windows"]:
+      sample.cpu = windows_api.get_current_thread_cpu_time()
+    else:
+      sample.cpu = os_api.get_current_thread_cpu_time()
+    sample.time = currenttime
+
+  return sample.cpu
+
+
+# getresourceversion() counts the changes it has seen to what getresources()
+# returns
+resource_version = 0
+resource_version_key = None
+resource_version_lock = threading.Lock()
+
+def get_resource_version():
+  """
+  <Purpose>
+    Returns a number that changes whenever what get_resources() returns 
+    does, other than the calling thread's CPU time.   Programs can skip 
+    calling get_resources() while it stays the same.
+
+  <Arguments>
+    None.
+
+  <Returns>
+    An int that grows by one each time a change is seen.
+  """
+  global resource_version
+  global resource_version_key
+
+  if stats_page is not None:
+    monitorversion = stats_page.get_sequence()
+  else:
+    # What is read from the OS changes all the time, but it is only read 
+    # again once it is RESOURCE_USAGE_MAX_AGE old
+    monitorversion = int(getruntime() / repy_constants.RESOURCE_USAGE_MAX_AGE)
+
+  key = (nanny.get_resource_version(), monitorversion)
+
+  resource_version_lock.acquire()
+  try:
+    if key != resource_version_key:
+      resource_version = resource_version + 1
+      resource_version_key = key
+    return resource_version
+
+  finally:
+    resource_version_lock.release()
 
 
 ###################     Windows specific functions   #######################
@@ -406,44 +573,19 @@ class WindowsNannyThread(threading.Thread):
 
 
 # Windows specific CPU Nanny Stuff
-winlastcpuinfo = [0,0]
+win_cpu_throttle = nanny.CPUThrottle(repy_constants.CPU_POLLING_FREQ_WIN)
 
-# Enforces CPU limit on Windows and Windows CE
+# Enforces CPU limit on Windows and Windows CE.   Returns how long to let the
+# process run before checking again, or -1 if something went wrong.
 def win_check_cpu_use(cpulim, pid):
-  global winlastcpuinfo
-  
   # get use information and time...
   now = getruntime()
 
   # Get the total cpu time
   usertime = windows_api.get_process_cpu_time(pid)
 
-  useinfo = [usertime, now]
-
-  # get the previous time and cpu so we can compute the percentage
-  oldusertime = winlastcpuinfo[0]
-  oldnow = winlastcpuinfo[1]
-
-  if winlastcpuinfo == [0,0]:
-    winlastcpuinfo = useinfo
-    # give them a free pass if it's their first time...
-    return 0
-
-  # save this data for next time...
-  winlastcpuinfo = useinfo
-
-  # Get the elapsed time...
-  elapsedtime = now - oldnow
-
-  # This is a problem
-  if elapsedtime == 0:
-    return -1 # Error condition
-    
-  # percent used is the amount of change divided by the time...
-  percentused = (usertime - oldusertime) / elapsedtime
-
   # Calculate amount of time to sleep for
-  stoptime = nanny.calculate_cpu_sleep_interval(cpulim, percentused,elapsedtime)
+  (stoptime, runtime) = win_cpu_throttle.update(cpulim, now, usertime)
 
   if stoptime > 0.0:
     # Try to timeout the process
@@ -454,17 +596,12 @@ def win_check_cpu_use(cpulim, pid):
       # Drop the first element if the length is greater than the maximum entries
       if len(process_stopped_timeline) > process_stopped_max_entries:
         process_stopped_timeline.pop(0)
-
-      # Return how long we slept so parent knows whether it should sleep
-      return stoptime
   
     else:
       # Process must have been making system call, try again next time
       return -1
   
-  # If the stop time is 0, then avoid calling timeout_process
-  else:
-    return 0.0
+  return runtime
     
             
 # Dedicated Thread for monitoring CPU, this is run as a part of repy
@@ -487,18 +624,14 @@ class WinCPUNannyThread(threading.Thread):
     # Run while the process is running
     while True:
       try:
-        # Get the frequency
-        frequency = repy_constants.CPU_POLLING_FREQ_WIN
+        # Let the process run for as long as win_check_cpu_use says
+        runtime = win_check_cpu_use(nanny.get_resource_limit("cpu"), self.pid)
         
-        # Base amount of sleeping on return value of 
-    	  # win_check_cpu_use to prevent under/over sleeping
-        slept = win_check_cpu_use(nanny.get_resource_limit("cpu"), self.pid)
-        
-        if slept == -1:
+        if runtime == -1:
           # Something went wrong, try again
           pass
-        elif (slept < frequency):
-          time.sleep(frequency-slept)
+        else:
+          time.sleep(runtime)
 
       except windows_api.DeadProcess:
         #  Process may be dead
@@ -517,24 +650,48 @@ class WinCPUNannyThread(threading.Thread):
 
 ##############     *nix specific functions (may include Mac)  ###############
 
-# This method handles messages on the "diskused" channel from
-# the external process. When the external process measures disk used,
-# it is piped in and cached for calls to getresources.
-def IPC_handle_diskused(bytes):
-  cached_disk_used = bytes
+# This method handles messages on the "statspage" channel from the shared 
+# monitor daemon. The daemon publishes repy's resource use in a page in the 
+# file at path, which we map (and remove, now that it is mapped).
+def IPC_handle_statspage(path):
+  global stats_page
+  try:
+    page = statspage.open_shared_file(path)
+    os.remove(path)
+  except EnvironmentError, e:
+    print >> sys.stderr, "[WARN] Can't map the stats page, reading resource use directly:", e
+    return
+  stats_page = page
+
+
+# This method handles messages on the "reloadresources" channel from
+# the external process. When the external process reloads the resource file,
+# it sends us the new dict of allowed resources.
+def IPC_handle_reloadresources(resourcesalloweddict):
+  nanny.update_resource_limits(resourcesalloweddict)
 
 
-# This method handles messages on the "repystopped" channel from
-# the external process. When the external process stops repy, it sends
-# a tuple with (TOS, amount) where TOS is time of stop (getruntime()) and
-# amount is the amount of time execution was suspended.
-def IPC_handle_stoptime(info):
-  # Push this onto the timeline
-  process_stopped_timeline.append(info)
+# This method handles messages on the "cgroup" channel from the external 
+# process. When the external process puts repy in a cgroup, it sends the 
+# cgroup's path so that getresources can read the cgroup's accounting.
+def IPC_handle_cgroup(path):
+  global cgroup_path
+  cgroup_path = path
 
-  # Drop the first element if the length is greater than the max
-  if len(process_stopped_timeline) > process_stopped_max_entries:
-    process_stopped_timeline.pop(0)
+
+# This method handles messages on the "resourceexceeded" channel from the
+# shared monitor daemon. Repy is over its memory or disk limit, and must exit
+# (or the daemon will kill it).
+def IPC_handle_resourceexceeded(message):
+  print >> sys.stderr, message + " Impolitely killing child!"
+  harshexit.harshexit(98)
+
+
+# This method handles messages on the "writeshadowstatus" channel from
+# the external process. The shadow resource table is kept by the repy 
+# process, so the external process asks us to write the shadow report.
+def IPC_handle_writeshadowstatus(data):
+  write_shadow_status()
 
 
 # Use a special class of exception for when
@@ -543,6 +700,9 @@ class ResourceException(Exception):
   pass
 
 
+# Serializes writes to the pipe to the repy process
+pipe_write_lock = threading.Lock()
+
 # Armon: Method to write a message to the pipe, used for IPC.
 # This allows the pipe to be multiplexed by sending simple dictionaries
 def write_message_to_pipe(writehandle, channel, data):
@@ -574,13 +734,18 @@ def write_message_to_pipe(writehandle, channel, data):
   # Make a full string
   mesg = str(len(mesg_dict_str)) + ":" + mesg_dict_str
 
-  # Send this
-  index = 0
-  while index < len(mesg):
-    bytes = os.write(writehandle, mesg[index:])
-    if bytes == 0:
-      raise EnvironmentError, "Write send 0 bytes! Pipe broken!"
-    index += bytes
+  # Send this.   More than one thread may write to the pipe, so don't let 
+  # the messages interleave.
+  pipe_write_lock.acquire()
+  try:
+    index = 0
+    while index < len(mesg):
+      bytes = os.write(writehandle, mesg[index:])
+      if bytes == 0:
+        raise EnvironmentError, "Write send 0 bytes! Pipe broken!"
+      index += bytes
+  finally:
+    pipe_write_lock.release()
 
 
 # Armon: Method to read a message from the pipe, used for IPC.
@@ -647,10 +812,13 @@ def read_message_from_pipe(readhandle):
 
 
 # This dictionary defines the functions that handle messages
-# on each channel. E.g. when a message arrives on the "repystopped" channel,
-# the IPC_handle_stoptime function should be invoked to handle it.
-IPC_HANDLER_FUNCTIONS = {"repystopped":IPC_handle_stoptime,
-                         "diskused":IPC_handle_diskused }
+# on each channel. E.g. when a message arrives on the "cgroup" channel,
+# the IPC_handle_cgroup function should be invoked to handle it.
+IPC_HANDLER_FUNCTIONS = {"statspage":IPC_handle_statspage,
+                         "reloadresources":IPC_handle_reloadresources,
+                         "cgroup":IPC_handle_cgroup,
+                         "resourceexceeded":IPC_handle_resourceexceeded,
+                         "writeshadowstatus":IPC_handle_writeshadowstatus }
 
 
 # This thread checks that the parent process is alive and invokes
@@ -703,14 +871,228 @@ class parent_process_checker(threading.Thread):
 # pid for the actual repy process is stored here
 repy_process_id = None
 
+# The external process keeps the write end of the pipe to the repy process
+# here
+repy_process_pipe = None
+
+# If this is set (by repy.py --cgroup), the external process tries to put 
+# the repy process in a cgroup of its own on Linux, so that the kernel 
+# enforces the CPU and memory limits instead of the resource monitor 
+# stopping and killing it.   If the cgroup can't be set up, the resource 
+# monitor polls as usual.
+use_cgroup = False
+
+# The path of the repy process's cgroup, if it is in one
+cgroup_path = None
+
+# If this is set (by repy.py --monitor), repy registers with the shared 
+# monitor daemon (monitordaemon.py) listening on this unix domain socket, 
+# instead of forking a monitor of its own.
+monitor_socket_path = None
+
+# The socket to the monitor daemon, if repy registered with one
+monitor_socket = None
+
+
+def write_shadow_status():
+  """
+  <Purpose>
+    Writes what the shadow limits would have done next to the status files,
+    to "<status prefix>.shadow".   On *NIX this is called in the external 
+    process, which asks the repy process to do it.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    As with open() and file.write().
+
+  <Side Effects>
+    Overwrites the shadow report.
+
+  <Returns>
+    None.
+  """
+  if repy_process_pipe is not None:
+    write_message_to_pipe(repy_process_pipe, "writeshadowstatus", None)
+
+  elif statusstorage.statusfilenameprefix:
+    nanny.write_shadow_report(statusstorage.statusfilenameprefix + ".shadow")
+
+
+def reload_resources():
+  """
+  <Purpose>
+    Re-reads the resource file and swaps the new limits into the nanny.   On
+    *NIX this is called in the external process, which sends the new limits
+    on to the repy process.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    ResourceParseError if the resource file is invalid, or can't be 
+    reloaded (see nanny.reload_resource_nanny).   The old limits are kept in
+    this case.
+
+  <Side Effects>
+    Changes the resource limits.
+
+  <Returns>
+    None.
+  """
+  resourcesalloweddict = nanny.reload_resource_nanny()
+
+  if repy_process_pipe is not None:
+    write_message_to_pipe(repy_process_pipe, "reloadresources", resourcesalloweddict)
+
+  # The monitor daemon keeps its own copy of the limits it enforces
+  if monitor_socket is not None:
+    write_message_to_pipe(monitor_socket.fileno(), "limits", _get_monitored_limits())
+
+
+def _get_monitored_limits():
+  # The limits a resource monitor enforces
+  return {'cpu':nanny.get_resource_limit("cpu"),
+      'memory':nanny.get_resource_limit("memory"),
+      'diskused':nanny.get_resource_limit("diskused")}
+
+
+def register_with_monitor_daemon():
+  """
+  <Purpose>
+    Registers repy with the shared monitor daemon at monitor_socket_path, 
+    which then monitors repy as a forked monitor would.   Status files are 
+    written by repy itself, as on Windows.
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    None.   If the daemon can't be reached, a warning is printed.
+
+  <Side Effects>
+    Starts threads to read messages from the daemon and to write status.
+
+  <Returns>
+    True if repy registered, False if a monitor process should be forked 
+    instead.
+  """
+  global monitor_socket
+
+  statusprefix = statusstorage.statusfilenameprefix
+  if statusprefix:
+    statusprefix = os.path.abspath(statusprefix)
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(monitor_socket_path)
+    write_message_to_pipe(sock.fileno(), "register", {'pid':os.getpid(), 
+        'runtime':getruntime(), 'limits':_get_monitored_limits(),
+        'directory':repy_constants.REPY_CURRENT_DIR, 'statusprefix':statusprefix})
+  except EnvironmentError, e:
+    print >> sys.stderr, "[WARN] Can't register with the monitor daemon, starting a monitor process instead:", e
+    sock.close()
+    return False
+
+  monitor_socket = sock
+
+  # Exit if the daemon dies, and handle what it sends us
+  parent_process_checker(sock.fileno()).start()
+
+  # Repy isn't run in an external process, so pass None instead of a 
+  # process id
+  nmstatusinterface.launch(None)
+
+  return True
+
+
+def start_cgroup(childpid):
+  """
+  <Purpose>
+    Puts the repy process in a cgroup of its own, with the CPU and memory
+    limits from the resource file.   This is called in the external process.
+
+  <Arguments>
+    childpid: The pid of the repy process.
+
+  <Exceptions>
+    None.   If the cgroup can't be set up, a warning is printed and 
+    cgroup_path stays None.
+
+  <Side Effects>
+    Creates a cgroup and moves the repy process into it.   This process is
+    moved into a cgroup of its own too (see os_api.create_cgroup).
+
+  <Returns>
+    None.
+  """
+  global cgroup_path
+
+  if not hasattr(os_api, "create_cgroup"):
+    print >> sys.stderr, "[WARN] cgroups are only supported on Linux, polling for resource use instead."
+    return
+
+  try:
+    path = os_api.create_cgroup("repy-" + str(childpid), childpid,
+        nanny.get_resource_limit("cpu"), nanny.get_resource_limit("memory"))
+  except EnvironmentError, e:
+    print >> sys.stderr, "[WARN] Can't use a cgroup, polling for resource use instead:", e
+    return
+
+  cgroup_path = path
+
+
+def remove_cgroup(childpid):
+  """
+  <Purpose>
+    Removes the repy process's cgroup (if any), once the repy process has 
+    exited.   This is called in the external process.
+
+  <Arguments>
+    childpid: The pid of the repy process.
+
+  <Exceptions>
+    None.
+
+  <Side Effects>
+    Waits for the repy process to exit, and removes its cgroup.
+
+  <Returns>
+    None.
+  """
+  if cgroup_path is None:
+    return
+
+  # The cgroup can't be removed while repy is still in it (even as a zombie)
+  try:
+    os.waitpid(childpid, 0)
+  except OSError:
+    pass
+
+  try:
+    os_api.remove_cgroup(cgroup_path)
+  except OSError:
+    pass
+
+
 # Forks Repy. The child will continue execution, and the parent
 # will become a resource monitor
 def do_forked_resource_monitor():
   global repy_process_id
+  global repy_process_pipe
+  global stats_page
 
   # Get a pipe
   (readhandle, writehandle) = os.pipe()
 
+  # And a page to publish repy's resource use in
+  stats_page = statspage.StatsPage()
+
+  # Otherwise the monitor would write out the buffered part of the trace 
+  # again when it exits
+  nanny.flush_trace()
+
   # I'll fork a copy of myself
   childpid = os.fork()
 
@@ -726,8 +1108,20 @@ def do_forked_resource_monitor():
     # We are the parent, close the read end
     os.close(readhandle)
 
-  # Store the childpid
+    # The exit functions are meant for the repy process, which is our child 
+    # now.   (We would overwrite what it wrote.)
+    del harshexit.exitfunctions[:]
+
+  # Store the childpid and the pipe to it
   repy_process_id = childpid
+  repy_process_pipe = writehandle
+
+  # Let the kernel enforce the limits if we can, and tell repy where to find
+  # its accounting
+  if use_cgroup:
+    start_cgroup(childpid)
+    if cgroup_path is not None:
+      write_message_to_pipe(writehandle, "cgroup", cgroup_path)
 
   # Start the nmstatusinterface
   nmstatusinterface.launch(repy_process_id)
@@ -746,6 +1140,8 @@ def do_forked_resource_monitor():
     # Kill repy
     harshexit.portablekill(childpid)
 
+    remove_cgroup(childpid)
+
     try:
       # Write out status information, repy was Stopped
       statusstorage.write_status("Terminated")  
@@ -758,7 +1154,10 @@ def do_forked_resource_monitor():
     (pid, status) = os.waitpid(childpid,os.WNOHANG)
     
     # Launch the resource monitor, if it fails determine why and restart if necessary
-    resource_monitor(childpid, writehandle)
+    if cgroup_path is not None:
+      cgroup_resource_monitor(childpid, stats_page)
+    else:
+      resource_monitor(childpid, stats_page)
     
   except ResourceException, exp:
     # Repy exceeded its resource limit, kill it
@@ -775,68 +1174,57 @@ def do_forked_resource_monitor():
     
     # Check if this is repy exiting
     if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+      remove_cgroup(childpid)
       sys.exit(0)
     
     else:
       _internal_error(str(exp)+" Monitor death! Impolitely killing child!")
       raise
   
-def resource_monitor(childpid, pipe_handle):
+def resource_monitor(childpid, page):
   """
   <Purpose>
     Function runs in a loop forever, checking resource usage and throttling CPU.
-    Checks CPU, memory, and disk.
+    Checks CPU, memory, and disk, more often the closer repy is to its limits.
     
   <Arguments>
     childpid:
       The child pid, e.g. the pid of repy
 
-    pipe_handle:
-      A handle to the pipe to the repy process. Allows sending resource use information.
+    page:
+      The statspage.StatsPage shared with the repy process, to publish its 
+      resource use in.
   """
-  # Get our pid
-  ourpid = os.getpid()
-  
-  # Calculate how often disk should be checked
-  disk_interval = int(repy_constants.RESOURCE_POLLING_FREQ_LINUX / repy_constants.CPU_POLLING_FREQ_LINUX)
-  current_interval = -1 # What cycle are we on  
-  
-  # Store time of the last interval
-  last_time = getruntime()
-  last_CPU_time = 0
-  resume_time = 0 
+  # Decides how to stop repy to keep it under the CPU limit
+  throttle = nanny.CPUThrottle(repy_constants.CPU_POLLING_FREQ_LINUX)
+
+  # Decide how often to check, from how close repy is to its limits
+  polling = nanny.PollingInterval(repy_constants.CPU_POLLING_FREQ_LINUX, 
+      repy_constants.MONITOR_POLLING_MAX_LINUX)
+  diskpolling = nanny.PollingInterval(repy_constants.RESOURCE_POLLING_FREQ_LINUX, 
+      repy_constants.DISK_POLLING_MAX_LINUX)
+
+  # When to check the disk next
+  next_disk_time = getruntime()
+
+  # Stops are short and frequent, so they are reported to repy in batches.
+  # This is when the first unreported stop started, and how long the 
+  # unreported stops were in total.
+  unreported_stop_time = None
+  unreported_stop_total = 0.0
   
   # Run forever...
   while True:
     ########### Check CPU ###########
-    # Get elapsed time
     currenttime = getruntime()
-    elapsedtime1 = currenttime - last_time     # Calculate against last run
-    elapsedtime2 = currenttime - resume_time   # Calculate since we last resumed repy
-    elapsedtime = min(elapsedtime1, elapsedtime2) # Take the minimum interval
-    last_time = currenttime  # Save the current time
-    
-    # Safety check, prevent ZeroDivisionError
-    if elapsedtime == 0.0:
-      continue
-    
-    # Get the total cpu at this point
-    totalCPU =  os_api.get_process_cpu_time(ourpid)   # Our own usage
-    totalCPU += os_api.get_process_cpu_time(childpid) # Repy's usage
-    
-    # Calculate percentage of CPU used
-    percentused = (totalCPU - last_CPU_time) / elapsedtime
-    
-    # Do not throttle for the first interval, wrap around
-    # Store the totalCPU for the next cycle
-    if last_CPU_time == 0:
-      last_CPU_time = totalCPU    
-      continue
-    else:
-      last_CPU_time = totalCPU
-      
-    # Calculate stop time
-    stoptime = nanny.calculate_cpu_sleep_interval(nanny.get_resource_limit("cpu"), percentused, elapsedtime)
+    
+    # Get the total cpu at this point, and how much memory repy is using.
+    # (Only repy's usage counts, since we sample much more often while repy
+    # is throttled.)
+    (totalCPU, memused) = os_api.get_process_cpu_time_and_rss(childpid)
+    page.write_usage(totalCPU, memused)
+    
+    (stoptime, runtime) = throttle.update(nanny.get_resource_limit("cpu"), currenttime, totalCPU)
     
     # If we are supposed to stop repy, then suspend, sleep and resume
     if stoptime > 0.0:
@@ -848,22 +1236,23 @@ def resource_monitor(childpid, pipe_handle):
 
       # And now they can start back up!
       os.kill(childpid, signal.SIGCONT)
-      
-      # Save the resume time
-      resume_time = getruntime()
 
-      # Send this information as a tuple containing the time repy was stopped and
-      # for how long it was stopped
-      write_message_to_pipe(pipe_handle, "repystopped", (currenttime, stoptime))
+      if unreported_stop_time is None:
+        unreported_stop_time = currenttime
+      unreported_stop_total += stoptime
       
+    # Publish the stops as one, from the time repy was first stopped and for
+    # how long it was stopped since then
+    if unreported_stop_time is not None and \
+        (stoptime == 0.0 or currenttime - unreported_stop_time >= repy_constants.CPU_POLLING_FREQ_LINUX):
+      page.add_stop(unreported_stop_time, unreported_stop_total)
+      unreported_stop_time = None
+      unreported_stop_total = 0.0
     
     ########### End Check CPU ###########
     # 
     ########### Check Memory ###########
     
-    # Get how much memory repy is using
-    memused = os_api.get_process_rss()
-    
     # Check if it is using too much memory
     if memused > nanny.get_resource_limit("memory"):
       raise ResourceException, "Memory use '"+str(memused)+"' over limit '"+str(nanny.get_resource_limit("memory"))+"'."
@@ -871,14 +1260,8 @@ def resource_monitor(childpid, pipe_handle):
     ########### End Check Memory ###########
     # 
     ########### Check Disk Usage ###########
-    # Increment our current cycle
-    current_interval += 1;
-    
     # Check if it is time to check the disk usage
-    if (current_interval % disk_interval) == 0:
-      # Reset the interval
-      current_interval = 0
-       
+    if currenttime >= next_disk_time:
       # Calculate disk used
       diskused = compute_disk_use(repy_constants.REPY_CURRENT_DIR)
 
@@ -886,13 +1269,118 @@ def resource_monitor(childpid, pipe_handle):
       if diskused > nanny.get_resource_limit("diskused"):
         raise ResourceException, "Disk use '"+str(diskused)+"' over limit '"+str(nanny.get_resource_limit("diskused"))+"'."
 
-      # Send the disk usage information, raw bytes used
-      write_message_to_pipe(pipe_handle, "diskused", diskused)
+      # Publish the disk usage information, raw bytes used
+      page.write_diskused(diskused)
+
+      next_disk_time = currenttime + diskpolling.update(
+          _limit_fraction(diskused, nanny.get_resource_limit("diskused")), currenttime)
     
     ########### End Check Disk ###########
+
+    # While repy isn't being stopped, check again when the closest of the 
+    # CPU and memory to its limit needs it
+    fraction = max(_limit_fraction(throttle.share, nanny.get_resource_limit("cpu")),
+        _limit_fraction(memused, nanny.get_resource_limit("memory")))
+    interval = polling.update(fraction, currenttime)
+    if stoptime == 0.0:
+      runtime = interval
+    
+    # Let repy run until the next check
+    time.sleep(runtime)
+
+
+
+def _limit_fraction(used, limit):
+  """
+  <Purpose>
+    Computes how much of a limit is used, for nanny.PollingInterval.
+
+  <Arguments>
+    used:
+      How much of the resource is used.
+    limit:
+      The limit.
+
+  <Returns>
+    used / limit, or 1.0 if the limit is 0.
+  """
+  if limit <= 0:
+    return 1.0
+  return float(used) / limit
+
+
+def cgroup_resource_monitor(childpid, page):
+  """
+  <Purpose>
+    Function runs in a loop forever, like resource_monitor, for a repy 
+    process in a cgroup.   The kernel throttles the CPU and enforces the 
+    memory limit, so this only checks disk, keeps the cgroup's limits in 
+    step with the resource file, and reports how long repy was throttled.
     
-    # Sleep before the next iteration
-    time.sleep(repy_constants.CPU_POLLING_FREQ_LINUX)
+  <Arguments>
+    childpid:
+      The child pid, e.g. the pid of repy
+
+    page:
+      The statspage.StatsPage shared with the repy process, to publish its 
+      resource use in.
+  """
+  # The limits that are in the cgroup now
+  cpulimit = nanny.get_resource_limit("cpu")
+  memorylimit = nanny.get_resource_limit("memory")
+
+  last_throttled_usec = os_api.get_cgroup_cpu_stat(cgroup_path).get("throttled_usec", 0)
+  oom_kill_count = os_api.get_cgroup_oom_kill_count(cgroup_path)
+
+  # Run forever...
+  while True:
+    currenttime = getruntime()
+
+    ########### Check Repy ###########
+    (pid, status) = os.waitpid(childpid, os.WNOHANG)
+    if pid == childpid:
+      # The kernel killed repy for using too much memory
+      if os_api.get_cgroup_oom_kill_count(cgroup_path) > oom_kill_count:
+        nmstatusinterface.stop()
+        print >> sys.stderr, "Memory use over limit '"+str(memorylimit)+"'. Repy was killed by the kernel."
+        remove_cgroup(childpid)
+        harshexit.harshexit(98)
+
+      # Repy exited
+      remove_cgroup(childpid)
+      sys.exit(0)
+
+    ########### Check Limits ###########
+    # The resource file may have been reloaded
+    if nanny.get_resource_limit("cpu") != cpulimit or nanny.get_resource_limit("memory") != memorylimit:
+      cpulimit = nanny.get_resource_limit("cpu")
+      memorylimit = nanny.get_resource_limit("memory")
+      os_api.set_cgroup_limits(cgroup_path, cpulimit, memorylimit)
+
+    ########### Check CPU ###########
+    # Publish the cgroup's accounting, which is what the kernel enforces
+    cpustat = os_api.get_cgroup_cpu_stat(cgroup_path)
+    page.write_usage(cpustat["usage_usec"] / 1000000.0, os_api.get_cgroup_memory_current(cgroup_path))
+
+    # Report any throttling like the stops of the polling monitor
+    throttled_usec = cpustat.get("throttled_usec", 0)
+    if throttled_usec > last_throttled_usec:
+      page.add_stop(currenttime, (throttled_usec - last_throttled_usec) / 1000000.0)
+      last_throttled_usec = throttled_usec
+
+    ########### Check Disk Usage ###########
+    diskused = compute_disk_use(repy_constants.REPY_CURRENT_DIR)
+
+    # Raise exception if we are over limit
+    if diskused > nanny.get_resource_limit("diskused"):
+      raise ResourceException, "Disk use '"+str(diskused)+"' over limit '"+str(nanny.get_resource_limit("diskused"))+"'."
+
+    # Publish the disk usage information, raw bytes used
+    page.write_diskused(diskused)
+
+    # Sleep before the next iteration.   Nothing needs to be checked as 
+    # often as the CPU of a polled process.
+    time.sleep(repy_constants.RESOURCE_POLLING_FREQ_LINUX)
 
 
 ###########     functions that help me figure out the os type    ###########
@@ -961,10 +1449,15 @@ if ostype in ["Windows"]:
 # Initialize getruntime for other platforms 
 else:
   # Set the starttime to the initial uptime
-  starttime = getruntime()
+  starttime = _getruntime_uptime()
   last_uptime = starttime
 
   # Reset elapsed time 
   elapsedtime = 0
 
+  # Prefer the monotonic clock where the OS API has one
+  if hasattr(os_api, "get_monotonic_time"):
+    monotonic_starttime = os_api.get_monotonic_time()
+    monotonic_clock_available = True
+
 
@@ -36,7 +36,26 @@
   --stop filename        : Repy will watch for the creation of this file and abort when it happens
                          : File can have format EXITCODE;EXITMESG. Code 44 is Stopped and is the default.
                          : EXITMESG will be printed prior to exiting if it is non-null.
+  --reload filename      : Repy will watch for the creation of this file, remove it, and re-read the
+                         : resource file. Limits change but resources already consumed are kept.
   --status filename.txt  : Write status information into this file
+  --stalls filename      : At exit, write histograms of how long the sandbox made threads wait for each
+                         : renewable resource, and in which API calls, to this file.
+  --shadow filename      : Also check resource use against the limits in this resource file, without
+                         : enforcing them. What they would have done is written to stderr at exit and,
+                         : with --status, to the status prefix plus ".shadow".
+  --trace filename       : Write every resource charge to this binary trace file. tracereplay.py can replay
+                         : it against another resource file.
+  --ledger               : Keep track of which thread uses renewable resources. getresources() returns
+                         : this in the usage dict, under 'ledger'. All but the last 100 threads to finish are
+                         : added up under 'finished threads'.
+  --cgroup               : On Linux, put the sandbox in a cgroup (v2) of its own so the kernel enforces the
+                         : CPU and memory limits. If that isn't possible, resource use is polled as usual.
+                         : The cpu and memory controllers must be delegated to the cgroup repy is started in,
+                         : and no other processes may be in it.
+  --monitor socketpath   : Have the shared monitor daemon (monitordaemon.py) listening on this unix socket
+                         : monitor the sandbox, instead of forking a monitor process. If the daemon can't be
+                         : reached, a monitor process is forked as usual (and --cgroup applies to it).
   --cwd dir              : Set Current working directory
   --servicelog           : Enable usage of the servicelogger for internal errors
 """
@@ -208,10 +227,38 @@ def add_repy_options(parser):
                     action="store", type="string", dest="stopfile",
                     help="Watch for the creation of stopfile and abort when it is created"
                     )
+  parser.add_option('--reload',
+                    action="store", type="string", dest="reloadfile",
+                    help="Watch for the creation of reloadfile and re-read the resource file when it is created"
+                    )
   parser.add_option('--status',
                     action="store", type="string", dest="statusfile",
                     help="Write status information into statusfile"
                     )
+  parser.add_option('--stalls',
+                    action="store", type="string", dest="stallfile",
+                    help="Write histograms of resource throttling waits to stallfile at exit"
+                    )
+  parser.add_option('--shadow',
+                    action="store", type="string", dest="shadowfile",
+                    help="Record what the limits in shadowfile would have done, without enforcing them"
+                    )
+  parser.add_option('--trace',
+                    action="store", type="string", dest="tracefile",
+                    help="Write a binary trace of resource charges to tracefile, for tracereplay.py"
+                    )
+  parser.add_option('--ledger',
+                    action="store_true", dest="ledger", default=False,
+                    help="Keep a per-thread ledger of renewable resource use, returned by getresources()"
+                    )
+  parser.add_option('--cgroup',
+                    action="store_true", dest="cgroup", default=False,
+                    help="On Linux, have the kernel enforce the CPU and memory limits with a cgroup v2, if one can be set up"
+                    )
+  parser.add_option('--monitor',
+                    action="store", type="string", dest="monitorsocket",
+                    help="Register with the shared monitor daemon listening on this unix socket, instead of forking a monitor"
+                    )
   parser.add_option('--cwd',
                     action="store", type="string", dest="cwd",
                     help="Set Current working directory to cwd"
@@ -265,6 +312,38 @@ def parse_options(options):
   # can be found regardless of where we are called from...
   tracebackrepy.initialize(options.servicelog, repy_constants.REPY_START_DIR)
 
+  # Write out the stall histograms when we exit.   The file goes in the 
+  # initial working directory, like the log file.
+  if options.stallfile:
+    stallfile = os.path.abspath(options.stallfile)
+    harshexit.exitfunctions.append(lambda: nanny.write_stall_histograms(stallfile))
+
+  # Check resource use against the shadow limits too, and report what they
+  # would have done
+  if options.shadowfile:
+    nanny.start_shadow_nanny(options.shadowfile)
+    harshexit.exitfunctions.append(lambda: sys.stderr.write(nanny.format_shadow_report()))
+    nmstatusinterface.statusfunctions.append(nonportable.write_shadow_status)
+
+  # Trace the resource charges.   The trace has to be closed on the way out,
+  # or the end of it may not be written.
+  if options.tracefile:
+    nanny.start_trace(options.tracefile)
+    harshexit.exitfunctions.append(nanny.stop_trace)
+
+  # Charge renewable resources to threads as well as to the process
+  if options.ledger:
+    nanny.enable_resource_ledger()
+
+  # Let the kernel enforce the CPU and memory limits, if it can
+  if options.cgroup:
+    nonportable.use_cgroup = True
+
+  # Register with the monitor daemon instead of forking a monitor.   The
+  # socket is relative to the initial working directory.
+  if options.monitorsocket:
+    nonportable.monitor_socket_path = os.path.abspath(options.monitorsocket)
+
   # Set Current Working Directory
   if options.cwd:
     os.chdir(options.cwd)
@@ -273,7 +352,8 @@ def parse_options(options):
   repy_constants.REPY_CURRENT_DIR = os.path.abspath(os.getcwd())
 
   # Initialize the NM status interface
-  nmstatusinterface.init(options.stopfile, options.statusfile)
+  nmstatusinterface.init(options.stopfile, options.statusfile,
+      reloadfile=options.reloadfile, reloadfunc=nonportable.reload_resources)
   
   # Write out our initial status
   statusstorage.write_status("Started")
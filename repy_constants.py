@@ -36,9 +36,57 @@ CPU_POLLING_FREQ_LINUX = .1 # Linux
 CPU_POLLING_FREQ_WIN = .1 # Windows
 CPU_POLLING_FREQ_WINCE = .5 # Mobile devices are pretty slow
 
+# The sandbox is stopped for at most CPU_STOP_MAX seconds at a time when it
+# is over its CPU limit, and is let run in short slices in between.   How far
+# over the limit it is, is judged over the last CPU_STOP_WINDOW seconds.
+CPU_STOP_MAX = .02
+CPU_STOP_WINDOW = 1.0
+
+# The Linux resource monitor checks less often while the sandbox is well 
+# under its limits.   It checks CPU and memory every CPU_POLLING_FREQ_LINUX 
+# to MONITOR_POLLING_MAX_LINUX seconds and the disk every 
+# RESOURCE_POLLING_FREQ_LINUX to DISK_POLLING_MAX_LINUX seconds, as fast as
+# it can once the sandbox is using MONITOR_HEADROOM of a limit (or is 
+# heading there quickly).
+MONITOR_POLLING_MAX_LINUX = .5
+DISK_POLLING_MAX_LINUX = 5
+MONITOR_HEADROOM = .5
+
 #Disk Polling Frequency:
 DISK_POLLING_HDD = 3
 
+# The nanny samples how much of each renewable resource has been used every 
+# RESOURCE_HISTORY_RESOLUTION seconds, and keeps enough samples to compute 
+# the usage rates over each of the RESOURCE_HISTORY_WINDOWS (in seconds) that
+# getresourcehistory() returns.
+RESOURCE_HISTORY_RESOLUTION = .1
+RESOURCE_HISTORY_WINDOWS = [1, 10, 60]
+
+# getresources() reuses each thread's CPU time, and the process's CPU time 
+# and memory when the resource monitor doesn't publish them, for up to 
+# RESOURCE_USAGE_MAX_AGE seconds after reading them from the OS.   Programs
+# that call it in a loop don't read /proc every time.
+RESOURCE_USAGE_MAX_AGE = .01
+
+# When --ip or --iface restrict the IP addresses repy may use, the sending
+# and connecting calls look up the interfaces' addresses and check that 
+# they can be bound only if they were last checked IP_CACHE_MAX_AGE seconds
+# ago or more.
+IP_CACHE_MAX_AGE = 5
+
+# getmyip() reuses the IP it found (or that it found none) for 
+# MYIP_REFRESH_AGE seconds, and then looks it up again in the background,
+# still returning the old IP meanwhile.   If it wasn't looked up for 
+# MYIP_MAX_AGE seconds, the caller waits for the lookup.
+MYIP_REFRESH_AGE = 10
+MYIP_MAX_AGE = 60
+
+# With --ledger, the threads that finished keep their own entries in the 
+# ledger until RESOURCE_LEDGER_FINISHED_THREADS more threads finish after 
+# them.   Then they are added up in a single entry, so the ledger doesn't 
+# grow with every thread a program ever started.
+RESOURCE_LEDGER_FINISHED_THREADS = 100
+
 # These IP addresses are used to resolve our external IP address
 # We attempt to connect to these IP addresses, and then check our local IP
 # These addresses were choosen since they have been historically very stable
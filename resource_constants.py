@@ -41,8 +41,20 @@ item_resources = fungible_item_resources + individual_item_resources
 # all resource names
 known_resources = quantity_resources + item_resources 
 
+# A renewable resource may be given a burst capacity in the resource file
+# ("resource netsend 10000 burst 200000").   It is stored in the resource dict
+# under the resource name plus this suffix (e.g. "netsend_burst").
+burst_suffix = "_burst"
+
 # Whenever a resource file is attached to a vessel, an exception should
 # be thrown if these resources are not present.  If any of these are left
 # unassigned, mysterious node manager errors will arise -Brent
 must_assign_resources = ["cpu", "memory", "diskused"]
 
+
+
+# Each known resource has a fixed index.   The nanny uses these to keep its
+# per-resource state in lists rather than in dicts keyed by resource name.
+resource_ids = {}
+for _resourcename in known_resources:
+  resource_ids[_resourcename] = len(resource_ids)
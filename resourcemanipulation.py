@@ -19,6 +19,9 @@
 # resources, etc.
 import resource_constants
 
+# for looking items up in lists of ranges
+import bisect
+
 
 class ResourceParseError(Exception):
   """This exception is thrown if the resource file is invalid"""
@@ -31,7 +34,7 @@ class ResourceMathError(Exception):
 # be sure no resources are negative...
 def _assert_resourcedict_doesnt_have_negative_resources(newdict):
   for resource in newdict:
-    if type(newdict[resource]) != set and newdict[resource] < 0.0:
+    if type(newdict[resource]) != list and newdict[resource] < 0.0:
       raise ResourceMathError("Insufficient quantity: Resource '"+resource+"' has a negative quantity")
 
 
@@ -49,6 +52,120 @@ def _assert_resourcedict_has_required_resources(newdict):
 
 
 
+############################ Item ranges #############################
+
+"""
+Individual item resources (like ports) are kept as a sorted list of 
+(first, last) tuples, each of which is an inclusive range of allowed items.
+The ranges never overlap or touch, so a vessel with a large port range 
+costs the same to store, copy and check as one with a single port.
+"""
+
+
+def merge_ranges(rangelist):
+  """
+    <Purpose>
+        Sorts a list of ranges and merges the ranges that overlap or touch.
+
+    <Arguments>
+        rangelist: a list of (first, last) tuples
+
+    <Exceptions>
+        None
+
+    <Side Effects>
+        None
+
+    <Returns>
+        A new sorted list of (first, last) tuples that don't overlap or touch
+  """
+  # (sorted() isn't available while the sandboxed program runs)
+  sortedlist = list(rangelist)
+  sortedlist.sort()
+
+  mergedlist = []
+  for (first, last) in sortedlist:
+    if mergedlist and first <= mergedlist[-1][1] + 1:
+      if last > mergedlist[-1][1]:
+        mergedlist[-1] = (mergedlist[-1][0], last)
+    else:
+      mergedlist.append((first, last))
+
+  return mergedlist
+
+
+
+def is_item_in_ranges(rangelist, item):
+  """
+    <Purpose>
+        Checks if an item is in a list of ranges, in O(log n) time.
+
+    <Arguments>
+        rangelist: a merged list of (first, last) tuples
+        item: the item (a number) to look for
+
+    <Exceptions>
+        None
+
+    <Side Effects>
+        None
+
+    <Returns>
+        True or False
+  """
+  # Find the last range that starts at or before the item
+  index = bisect.bisect_right(rangelist, (item, float('inf'))) - 1
+  return index >= 0 and item <= rangelist[index][1]
+
+
+
+def subtract_ranges(rangelist1, rangelist2):
+  """
+    <Purpose>
+        Removes the items in one list of ranges from another.
+
+    <Arguments>
+        rangelist1: a merged list of (first, last) tuples
+        rangelist2: a merged list of (first, last) tuples to remove
+
+    <Exceptions>
+        ResourceMathError: if rangelist2 has items that rangelist1 does not
+
+    <Side Effects>
+        None
+
+    <Returns>
+        A new merged list of (first, last) tuples
+  """
+  for (first, last) in rangelist2:
+    # The whole range must be inside one range of rangelist1
+    index = bisect.bisect_right(rangelist1, (first, float('inf'))) - 1
+    if index < 0 or last > rangelist1[index][1]:
+      raise ResourceMathError('Subtracted resource dictionary does not contain all elements')
+
+  retlist = []
+  index2 = 0
+  for (first, last) in rangelist1:
+    # cut each range of rangelist2 that overlaps this one out of it
+    while index2 < len(rangelist2) and rangelist2[index2][0] <= last:
+      (removefirst, removelast) = rangelist2[index2]
+      if removefirst > first:
+        retlist.append((first, removefirst - 1))
+      first = removelast + 1
+      if removelast > last:
+        break
+      index2 += 1
+
+    if first <= last:
+      retlist.append((first, last))
+
+  return retlist
+
+
+
+
+
+
 ############################ Parsing and I/O #############################
 
 """ 
@@ -67,6 +184,12 @@ resource outsockets 1			# Can initiate one outgoing comm
 resource insocket 2			# Can listen for 2 incoming comms
 resource messport 2023 			# Can use messageport 2023 
 resource messport 2043 			# Can use messageport 2043 
+resource connport 20000-29999		# Can use connports 20000 to 29999
+
+Renewable resources may also have a burst capacity.   The resource refills at
+its limit per second, but up to the burst capacity may be used at once 
+(after an idle period):
+resource netsend 10000 burst 200000	# 10000 bytes/s, bursts of up to 200000
 
 """
 
@@ -128,10 +251,10 @@ def parse_resourcedict_from_string(resourcestring):
   returned_resource_dict = {}
   returned_call_list = []
 
-  # I must create an empty set for any resource types that are sets.
-  # (these are things like messports, etc.)
+  # I must create an empty list of ranges for any resource types that are 
+  # lists of ranges.   (these are things like messports, etc.)
   for resourcename in resource_constants.individual_item_resources:
-    returned_resource_dict[resourcename] = set()
+    returned_resource_dict[resourcename] = []
 
 
   # ensure we don't have problems with windows style newlines... (only LF)
@@ -162,8 +285,9 @@ def parse_resourcedict_from_string(resourcestring):
 
     if linetypestring == 'resource':
 
-      ####### Okay, it's a resource.  It must have two other tokens!
-      if len(tokenlist) != 3:
+      ####### Okay, it's a resource.  It must have two other tokens, or four
+      ####### if it has a burst capacity!
+      if len(tokenlist) != 3 and len(tokenlist) != 5:
         raise ResourceParseError("Line '"+line+"' has wrong number of items")
 
       # the other tokens are the resource and the resource value
@@ -174,6 +298,33 @@ def parse_resourcedict_from_string(resourcestring):
       if knownresourcename not in resource_constants.known_resources:
         raise ResourceParseError("Line '"+line+"' has an unknown resource '"+knownresourcename+"'")
 
+      # if it's an individual_item_resource, then there can be a list of 
+      # different values for the resource (like ports).   Each value is an
+      # integer or an inclusive range of them ("20000-29999").
+      if knownresourcename in resource_constants.individual_item_resources:
+        if len(tokenlist) != 3:
+          raise ResourceParseError("Line '"+line+"' has wrong number of items")
+
+        rangetokens = resourcevaluestring.split('-')
+        try:
+          if len(rangetokens) == 1:
+            first = last = int(rangetokens[0])
+          elif len(rangetokens) == 2:
+            first = int(rangetokens[0])
+            last = int(rangetokens[1])
+          else:
+            raise ValueError
+        except ValueError:
+          raise ResourceParseError("Line '"+line+"' has an invalid resource value '"+resourcevaluestring+"'")
+
+        if first > last:
+          raise ResourceParseError("Line '"+line+"' has an empty range '"+resourcevaluestring+"'")
+
+        # I'm implicitly ignoring duplicates in the file.   Is that wise?
+        # (They're merged away below)
+        returned_resource_dict[knownresourcename].append((first, last))
+        continue
+
       # and the last item should be a valid float or int, 
       # depending on the resource type (SeattleTestbed/repy_v2#59)
       try:
@@ -195,18 +346,29 @@ def parse_resourcedict_from_string(resourcestring):
       except ValueError:
         raise ResourceParseError("Line '"+line+"' has an invalid resource value '"+resourcevaluestring+"'")
 
-      # if it's an individual_item_resource, then there can be a list of 
-      # different values for the resource (like ports)
-      if knownresourcename in resource_constants.individual_item_resources:
-
-        # I'm implicitly ignoring duplicates in the file.   Is that wise?
-        returned_resource_dict[knownresourcename].add(resourcevalue)
-        continue
-
       # other resources should not have been previously assigned
       if knownresourcename in returned_resource_dict:
         raise ResourceParseError("Line '"+line+"' has a duplicate resource rule for '"+knownresourcename+"'")
 
+      # a burst capacity is only allowed for renewable resources, and must 
+      # be at least the amount that is renewed each second
+      if len(tokenlist) == 5:
+        if tokenlist[3] != 'burst':
+          raise ResourceParseError("Line '"+line+"' not understood.")
+
+        if knownresourcename not in resource_constants.renewable_resources:
+          raise ResourceParseError("Line '"+line+"' has a burst capacity for non-renewable resource '"+knownresourcename+"'")
+
+        try:
+          burstvalue = float(tokenlist[4])
+        except ValueError:
+          raise ResourceParseError("Line '"+line+"' has an invalid burst capacity '"+tokenlist[4]+"'")
+
+        if burstvalue < resourcevalue:
+          raise ResourceParseError("Line '"+line+"' has a burst capacity smaller than the resource limit")
+
+        returned_resource_dict[knownresourcename + resource_constants.burst_suffix] = burstvalue
+
         
       # Finally, we assign it to the table
       returned_resource_dict[knownresourcename] = resourcevalue
@@ -228,6 +390,10 @@ def parse_resourcedict_from_string(resourcestring):
       raise ResourceParseError("Internal error for '"+line+"'")
 
 
+  # sort the ranges of individual items and merge any that overlap
+  for resourcename in resource_constants.individual_item_resources:
+    returned_resource_dict[resourcename] = merge_ranges(returned_resource_dict[resourcename])
+
   # make sure that if there are required resources, they are defined
   _assert_resourcedict_has_required_resources(returned_resource_dict)
 
@@ -275,9 +441,18 @@ def write_resourcedict_to_file(resourcedict, filename, call_list=None):
 
   outfo = open(filename,"w")
   for resource in resourcedict:
-    if type(resourcedict[resource]) == set:
-      for item in resourcedict[resource]:
-        print >> outfo, "resource "+resource+" "+str(item)
+    # burst capacities are written out on the line of their resource
+    if resource.endswith(resource_constants.burst_suffix):
+      continue
+
+    if type(resourcedict[resource]) == list:
+      for (first, last) in resourcedict[resource]:
+        if first == last:
+          print >> outfo, "resource "+resource+" "+str(first)
+        else:
+          print >> outfo, "resource "+resource+" "+str(first)+"-"+str(last)
+    elif resource + resource_constants.burst_suffix in resourcedict:
+      print >> outfo, "resource "+resource+" "+str(resourcedict[resource])+" burst "+str(resourcedict[resource + resource_constants.burst_suffix])
     else:
       print >> outfo, "resource "+resource+" "+str(resourcedict[resource])
 
@@ -326,15 +501,15 @@ def add_resourcedicts(dict1, dict2):
   # dict2 doesn't have the key, it doesn't matter.
   for resource in dict2:
 
-    # if this is a set, then get the union
-    if type(retdict[resource]) == set:
-      retdict[resource] = retdict[resource].union(dict2[resource])
-      continue
-
-    # empty if not preexisting
+    # empty if not preexisting (e.g. a burst capacity only dict2 has)
     if resource not in retdict:
       retdict[resource] = 0.0
 
+    # if this is a list of ranges, then get the union
+    if type(retdict[resource]) == list:
+      retdict[resource] = merge_ranges(retdict[resource] + dict2[resource])
+      continue
+
     if type(retdict[resource]) not in [float, int]:
       raise ResourceMathError("Resource dictionary contain an element of unknown type '"+str(type(retdict[resource]))+"'")
 
@@ -392,12 +567,9 @@ def subtract_resourcedicts(dict1, dict2):
       retdict[resource] = retdict[resource] - dict2[resource]
 
     # otherwise we need to be sure we're only subtracting items that exist
-    elif type(retdict[resource]) == set:
-      if not retdict[resource].issuperset(dict2[resource]):
-        raise ResourceMathError('Subtracted resource dictionary does not contain all elements')
-
-      # use the set subtraction
-      retdict[resource] = retdict[resource] - dict2[resource]
+    # (subtract_ranges checks this)
+    elif type(retdict[resource]) == list:
+      retdict[resource] = subtract_ranges(retdict[resource], dict2[resource])
 
     # otherwise, WTF is this?
     else:
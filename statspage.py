@@ -0,0 +1,253 @@
+"""
+<Program Name>
+  statspage.py
+
+<Purpose>
+  A page of memory shared between the resource monitor and the repy process
+  it monitors.   The monitor publishes the latest CPU time, memory and disk
+  use it measured, and the times it stopped repy, in the page, and
+  getresources() reads them from there.   Reading the page takes no system
+  calls, and keeps the pipe between the two for control messages.
+
+  The monitor is the only writer.   The page is protected by a sequence
+  number (a seqlock): the writer makes it odd before it changes the page
+  and even again after, and a reader retries if the number was odd or
+  changed while it read the page.   Repy never waits for the monitor,
+  which it couldn't do anyway while the monitor has it stopped.
+
+  A forked monitor shares an anonymous page with repy.   The monitor daemon
+  can't, so it creates a file for the page, which repy maps and removes.
+"""
+
+import os
+import mmap
+import struct
+import tempfile
+
+
+# The header is the sequence number, then the fields: the CPU time, the 
+# memory and disk used, and how many stops were ever added.   The last 
+# STOP_ENTRIES stops follow it, each written over the oldest.
+_SEQUENCE = struct.Struct("<Q")
+_FIELDS = struct.Struct("<dQQQ")
+_HEADER_BYTES = _SEQUENCE.size + _FIELDS.size
+_STOP = struct.Struct("<dd")
+
+# Keep as many stops as getresources() returns
+STOP_ENTRIES = 100
+
+# All the stops, to read them at once
+_STOPS = struct.Struct("<" + "dd" * STOP_ENTRIES)
+
+PAGE_BYTES = _HEADER_BYTES + STOP_ENTRIES * _STOP.size
+
+# How many times to try to read the page while the monitor is writing it
+# before giving up
+READ_ATTEMPTS = 100
+
+
+
+class StatsPage(object):
+  """
+  The shared page.   Only one process may call the write methods, and only
+  from one thread.
+  """
+
+  __slots__ = ['page', 'sequence', 'cpu', 'memory', 'diskused', 'stopcount',
+      'readstops']
+
+  def __init__(self, fileno=-1):
+    """
+    <Purpose>
+      Maps the page.
+
+    <Arguments>
+      fileno:
+        A file of at least PAGE_BYTES bytes to map, or -1 for an anonymous
+        page that is shared with the children forked after this.
+
+    <Exceptions>
+      As with mmap.mmap().
+
+    <Side Effects>
+      None.
+
+    <Returns>
+      None.
+    """
+    self.page = mmap.mmap(fileno, PAGE_BYTES)
+
+    # The writer's copy of the header.   (A new page is all zeros.)
+    self.sequence = 0
+    self.cpu = 0.0
+    self.memory = 0
+    self.diskused = 0
+    self.stopcount = 0
+
+    # The reader's (stopcount, stoptimes) from the last time the stops were
+    # read, since they change much less often than the rest
+    self.readstops = (0, [])
+
+
+  def _begin_write(self):
+    self.sequence += 1
+    _SEQUENCE.pack_into(self.page, 0, self.sequence)
+
+
+  def _end_write(self):
+    # The fields have to be complete before the sequence number says so
+    _FIELDS.pack_into(self.page, _SEQUENCE.size, self.cpu, self.memory,
+        self.diskused, self.stopcount)
+    self.sequence += 1
+    _SEQUENCE.pack_into(self.page, 0, self.sequence)
+
+
+  def write_usage(self, cpu, memory):
+    """
+    Publishes the CPU time (in seconds) and memory (in bytes) repy used.
+    """
+    self._begin_write()
+    self.cpu = cpu
+    self.memory = memory
+    self._end_write()
+
+
+  def write_diskused(self, diskused):
+    """
+    Publishes the disk space (in bytes) repy used.
+    """
+    self._begin_write()
+    self.diskused = diskused
+    self._end_write()
+
+
+  def add_stop(self, stoptime, amount):
+    """
+    Publishes that repy was stopped at stoptime (repy's getruntime()) for
+    amount seconds.
+    """
+    self._begin_write()
+    _STOP.pack_into(self.page, _HEADER_BYTES + (self.stopcount % STOP_ENTRIES) * _STOP.size,
+        stoptime, amount)
+    self.stopcount += 1
+    self._end_write()
+
+
+  def get_sequence(self):
+    """
+    Returns the sequence number, which changes every time the monitor 
+    publishes something.
+    """
+    return _SEQUENCE.unpack_from(self.page, 0)[0]
+
+
+  def read(self):
+    """
+    <Purpose>
+      Reads what the monitor published.
+
+    <Arguments>
+      None.
+
+    <Exceptions>
+      None.
+
+    <Side Effects>
+      None.
+
+    <Returns>
+      A tuple (cpu, memory, diskused, stoptimes), where stoptimes is a list
+      of (time, amount) tuples, oldest first.   None if the monitor hasn't
+      published anything yet, or was always writing the page.
+    """
+    for attempt in xrange(READ_ATTEMPTS):
+      # The sequence number is read before anything it protects
+      sequence = _SEQUENCE.unpack_from(self.page, 0)[0]
+      if sequence == 0:
+        return None
+      if sequence % 2 == 1:
+        continue
+
+      (cpu, memory, diskused, stopcount) = _FIELDS.unpack_from(self.page, _SEQUENCE.size)
+
+      readstops = self.readstops
+      if stopcount != readstops[0]:
+        values = _STOPS.unpack_from(self.page, _HEADER_BYTES)
+        stoptimes = zip(values[0::2], values[1::2])
+        if stopcount <= STOP_ENTRIES:
+          stoptimes = stoptimes[:stopcount]
+        else:
+          oldest = stopcount % STOP_ENTRIES
+          stoptimes = stoptimes[oldest:] + stoptimes[:oldest]
+        readstops = (stopcount, stoptimes)
+
+      # Don't use what was read if the monitor changed the page meanwhile
+      if _SEQUENCE.unpack_from(self.page, 0)[0] != sequence:
+        continue
+
+      self.readstops = readstops
+      return (cpu, memory, diskused, readstops[1][:])
+
+    return None
+
+
+  def close(self):
+    self.page.close()
+
+
+
+def create_shared_file():
+  """
+  <Purpose>
+    Creates a stats page in a new temporary file, so that an unrelated
+    process can map it with open_shared_file().
+
+  <Arguments>
+    None.
+
+  <Exceptions>
+    As with tempfile.mkstemp() and mmap.mmap().
+
+  <Side Effects>
+    Creates a file, which the caller must remove.
+
+  <Returns>
+    A tuple (page, path).
+  """
+  (fd, path) = tempfile.mkstemp(prefix="repystats-")
+  try:
+    os.ftruncate(fd, PAGE_BYTES)
+    page = StatsPage(fd)
+  except EnvironmentError:
+    os.close(fd)
+    os.remove(path)
+    raise
+
+  os.close(fd)
+  return (page, path)
+
+
+
+def open_shared_file(path):
+  """
+  <Purpose>
+    Maps a stats page made by create_shared_file().
+
+  <Arguments>
+    path:
+      The page's file.
+
+  <Exceptions>
+    As with os.open() and mmap.mmap().
+
+  <Side Effects>
+    None.
+
+  <Returns>
+    The page.
+  """
+  fd = os.open(path, os.O_RDWR)
+  try:
+    return StatsPage(fd)
+  finally:
+    os.close(fd)
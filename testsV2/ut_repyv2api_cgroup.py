@@ -0,0 +1,177 @@
+"""
+Verify that --cgroup sets up a cgroup for repy, and that the monitor that
+polls a cgroup publishes its accounting, against a fake cgroup filesystem
+(a directory of plain files, written the way the kernel's would be).
+
+The monitor starts in a cgroup below the root, so it must move itself into
+a leaf cgroup before it enables the controllers for repy's cgroup, and move
+everything back if that fails.
+
+Note: This test overwrites / removes files from the current working dir.
+The chosen file names should be unlikely to clash with anything you
+created, but you have been warned.
+"""
+
+import os
+import time
+import shutil
+
+import harshexit
+
+
+fakeroot_name = "fakecgroupfs_for_cgroup_test"
+
+
+def read_file(*path):
+  return open(os.path.join(*path)).read()
+
+
+def write_file(data, *path):
+  # Readers must never see part of a file
+  fileobj = open(os.path.join(*path) + ".new", "w")
+  fileobj.write(data)
+  fileobj.close()
+  os.rename(os.path.join(*path) + ".new", os.path.join(*path))
+
+
+def make_fake_cgroupfs():
+  shutil.rmtree(fakeroot_name, True)
+  os.makedirs(os.path.join(fakeroot_name, "sandboxes"))
+  write_file("", fakeroot_name, "sandboxes", "cgroup.subtree_control")
+  write_file(str(os.getpid()), fakeroot_name, "sandboxes", "cgroup.procs")
+
+
+def run_monitor(cgrouppath, page, oomkills):
+  """
+  Runs cgroup_resource_monitor in a process of its own, for a fake repy
+  process that changes the cgroup's accounting and exits.   Returns the
+  monitor's status.
+  """
+  monitorpid = os.fork()
+  if monitorpid == 0:
+    # What the monitor writes to stderr would fail the test
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+
+    childpid = os.fork()
+    if childpid == 0:
+      time.sleep(0.2)
+      write_file("usage_usec 2000000\nthrottled_usec 250000\n", cgrouppath, "cpu.stat")
+      write_file("oom_kill " + str(oomkills) + "\n", cgrouppath, "memory.events")
+      time.sleep(1.0)
+      os._exit(0)
+
+    try:
+      nonportable.cgroup_resource_monitor(childpid, page)
+    except SystemExit, e:
+      os._exit(e.code)
+    os._exit(1)
+
+  (pid, status) = os.waitpid(monitorpid, 0)
+  return status
+
+
+harshexit.init_ostype()
+if harshexit.ostype == 'Linux':
+  # nonportable has to be imported before nanny, which imports it
+  import nonportable
+  import nanny
+  import linux_api
+  import repy_constants
+  import statspage
+
+  nanny.start_resource_nanny("restrictions.default")
+  repy_constants.REPY_CURRENT_DIR = fakeroot_name
+
+  # The monitor is in /sandboxes
+  fakeroot = os.path.abspath(fakeroot_name)
+  sandboxes = os.path.join(fakeroot, "sandboxes")
+  linux_api._find_own_cgroup = lambda: (fakeroot, "/sandboxes")
+
+
+  # create_cgroup moves the monitor into a leaf, and repy next to it
+  make_fake_cgroupfs()
+  path = linux_api.create_cgroup("repy-1234", 1234, 0.5, 20000000)
+  if path != os.path.join(sandboxes, "repy-1234"):
+    print "create_cgroup() created", path
+  else:
+    if read_file(sandboxes, "monitor", "cgroup.procs") != str(os.getpid()):
+      print "The monitor wasn't moved into a leaf cgroup."
+    if read_file(path, "cgroup.procs") != "1234":
+      print "The process wasn't moved into the new cgroup."
+    if read_file(sandboxes, "cgroup.subtree_control") != "+cpu +memory":
+      print "The controllers weren't enabled:", read_file(sandboxes, "cgroup.subtree_control")
+    if read_file(path, "cpu.max") != "50000 100000" or \
+        read_file(path, "memory.max") != "20000000" or \
+        read_file(path, "memory.swap.max") != "0":
+      print "The limits are wrong:", read_file(path, "cpu.max"), read_file(path, "memory.max")
+
+  # Small CPU limits stretch the period
+  linux_api.set_cgroup_limits(path, 0.005, 20000000)
+  if read_file(path, "cpu.max") != "1000 200000":
+    print "A small CPU limit was written as", read_file(path, "cpu.max")
+
+
+  # In the root cgroup, the monitor stays where it is
+  make_fake_cgroupfs()
+  linux_api._find_own_cgroup = lambda: (sandboxes, "/")
+  linux_api.create_cgroup("repy-1234", 1234, 0.5, 20000000)
+  if os.path.exists(os.path.join(sandboxes, "monitor")):
+    print "The monitor was moved out of the root cgroup."
+  linux_api._find_own_cgroup = lambda: (fakeroot, "/sandboxes")
+
+
+  # If the controllers can't be enabled, the processes are moved back.
+  # (Unlike the kernel's, the fake cgroup can't be removed, since it has
+  # files in it.)
+  make_fake_cgroupfs()
+  os.remove(os.path.join(sandboxes, "cgroup.subtree_control"))
+  os.mkdir(os.path.join(sandboxes, "cgroup.subtree_control"))
+  try:
+    linux_api.create_cgroup("repy-1234", 1234, 0.5, 20000000)
+  except EnvironmentError:
+    if read_file(sandboxes, "cgroup.procs") != str(os.getpid()):
+      print "The monitor wasn't moved back."
+  else:
+    print "create_cgroup() didn't fail without controllers."
+
+
+  # start_cgroup uses the limits from the resource file
+  make_fake_cgroupfs()
+  nonportable.start_cgroup(4321)
+  if nonportable.cgroup_path != os.path.join(sandboxes, "repy-4321"):
+    print "start_cgroup() didn't set up a cgroup:", nonportable.cgroup_path
+  elif read_file(nonportable.cgroup_path, "memory.max") != str(int(nanny.get_resource_limit("memory"))):
+    print "start_cgroup() set the memory limit to", read_file(nonportable.cgroup_path, "memory.max")
+  cgrouppath = nonportable.cgroup_path
+
+
+  # The monitor publishes the cgroup's accounting and throttling, and exits
+  # with repy
+  write_file("usage_usec 1000000\nthrottled_usec 0\n", cgrouppath, "cpu.stat")
+  write_file("1000000", cgrouppath, "memory.current")
+  write_file("oom_kill 0\n", cgrouppath, "memory.events")
+
+  page = statspage.StatsPage()
+  status = run_monitor(cgrouppath, page, 0)
+  if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+    print "The monitor didn't exit with repy:", status
+
+  result = page.read()
+  if result is None or result[:2] != (2.0, 1000000):
+    print "The monitor published the wrong usage:", result
+  elif result[3] == [] or abs(result[3][-1][1] - 0.25) > 0.0001:
+    print "The monitor didn't publish the throttling:", result[3]
+  page.close()
+
+  # A process the kernel killed for its memory use is reported
+  write_file("usage_usec 1000000\nthrottled_usec 0\n", cgrouppath, "cpu.stat")
+  page = statspage.StatsPage()
+  status = run_monitor(cgrouppath, page, 1)
+  if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+    print "The monitor didn't notice that repy was killed for its memory use."
+  page.close()
+
+
+# Finally, remove any files we might created
+shutil.rmtree(fakeroot_name, True)
@@ -0,0 +1,19 @@
+"""
+Verify that get_interface_ip_addresses(), which lists an interface's
+addresses with getifaddrs(3) on Linux, finds the loopback address, and
+returns nothing for an interface that doesn't exist.
+"""
+
+import harshexit
+
+harshexit.init_ostype()
+if harshexit.ostype == 'Linux':
+  import linux_api
+
+  addresses = linux_api.get_interface_ip_addresses("lo")
+  if addresses != ["127.0.0.1"]:
+    print "The addresses of lo are", addresses, "instead of ['127.0.0.1']."
+
+  addresses = linux_api.get_interface_ip_addresses("nosuchinterface0")
+  if addresses != []:
+    print "A missing interface has the addresses", addresses
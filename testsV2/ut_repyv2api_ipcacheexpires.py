@@ -0,0 +1,55 @@
+"""
+Verify that the list of IPs repy may use (with --ip or --iface) is built
+once, kept until it is repy_constants.IP_CACHE_MAX_AGE seconds old, and
+built again after that.
+
+We prefer the loopback interface, and count how often its addresses are
+looked up while update_ip_cache() is called before and after the list
+expires.
+"""
+
+import time
+
+# nonportable has to be imported before nanny, which emulcomm imports
+import nonportable
+import emulcomm
+import repy_constants
+
+
+repy_constants.IP_CACHE_MAX_AGE = 0.5
+
+emulcomm.user_ip_interface_preferences = True
+emulcomm.allow_nonspecified_ips = False
+emulcomm.user_specified_ip_interface_list = [(False, "lo")]
+
+# Count the lookups
+lookups = []
+get_interface_ip_addresses = nonportable.os_api.get_interface_ip_addresses
+def counting_get_interface_ip_addresses(interfacename):
+  lookups.append(interfacename)
+  return get_interface_ip_addresses(interfacename)
+nonportable.os_api.get_interface_ip_addresses = counting_get_interface_ip_addresses
+
+
+emulcomm.update_ip_cache()
+firstupdatetime = emulcomm.allowediplist_updatetime
+if len(lookups) != 1 or firstupdatetime is None:
+  print "The list wasn't built:", lookups, firstupdatetime
+
+if "127.0.0.1" not in emulcomm.allowediplist:
+  print "The list doesn't have the loopback address:", emulcomm.allowediplist
+
+# A fresh list is kept
+for num in range(10):
+  emulcomm.update_ip_cache()
+if len(lookups) != 1 or emulcomm.allowediplist_updatetime != firstupdatetime:
+  print "A list that hadn't expired was built again:", lookups
+
+# An old one is not.   An address added since shows up in the new list.
+emulcomm.user_specified_ip_interface_list.append((True, "0.0.0.0"))
+time.sleep(0.6)
+emulcomm.update_ip_cache()
+if len(lookups) != 2 or emulcomm.allowediplist_updatetime <= firstupdatetime:
+  print "An expired list wasn't built again:", lookups
+if "0.0.0.0" not in emulcomm.allowediplist:
+  print "The new list doesn't have the added address:", emulcomm.allowediplist
@@ -0,0 +1,135 @@
+"""
+Verify that the shared monitor daemon (monitordaemon.py) keeps monitoring
+sandboxes while others send it bad or partial messages.
+
+We start the daemon, and connect to it as a few fake sandboxes: one sends
+half a message and then nothing, one registers with bad limits, one sends
+something that isn't a message, and one registers properly and then sends
+bad limits.   The daemon must close the sockets of all but the first, and
+still register a RepyV2 program started with --monitor.
+
+Note: This test overwrites / removes files from the current working dir.
+The chosen file names should be unlikely to clash with anything you
+created, but you have been warned.
+"""
+
+import sys
+import os
+import time
+import socket
+import marshal
+import portable_popen
+
+import harshexit
+
+
+socket_name = "monitordaemontestsocket"
+program_name = "program_for_monitordaemon_test.r2py"
+restrictions_name = "restrictions.monitordaemontest"
+
+
+def connect():
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(socket_name)
+  sock.settimeout(10)
+  return sock
+
+
+def message(channel, data):
+  # As written by nonportable.write_message_to_pipe()
+  mesg_dict_str = marshal.dumps({"ch":channel, "d":data})
+  return str(len(mesg_dict_str)) + ":" + mesg_dict_str
+
+
+def registration(limits):
+  return {'pid':os.getpid(), 'runtime':0.0, 'limits':limits,
+      'directory':os.getcwd(), 'statusprefix':None}
+
+
+def expect_closed(sock, description):
+  try:
+    data = sock.recv(4096)
+  except socket.error, e:
+    print "The daemon didn't close the socket of a sandbox that " + description + ":", e
+    return
+  if data != "":
+    print "The daemon sent", repr(data), "to a sandbox that " + description + "."
+
+
+goodlimits = {'cpu':1.0, 'memory':1000000000, 'diskused':1000000000}
+
+
+# The daemon only runs on Linux and Mac
+harshexit.init_ostype()
+if harshexit.ostype in ['Linux', 'Darwin']:
+  daemon = portable_popen.Popen([sys.executable, "monitordaemon.py", socket_name])
+
+  for attempt in range(50):
+    if os.path.exists(socket_name):
+      break
+    time.sleep(0.1)
+
+  # Half a message, and then nothing.   This must not hold up the others.
+  stalled = connect()
+  stalled.sendall(message("register", registration(goodlimits))[:10])
+
+  badlimits = connect()
+  badlimits.sendall(message("register", registration({'cpu':'lots',
+      'memory':1000000000, 'diskused':1000000000})))
+  expect_closed(badlimits, "registered with bad limits")
+
+  garbage = connect()
+  garbage.sendall("this is not a message" * 10)
+  expect_closed(garbage, "sent something that isn't a message")
+
+  # A sandbox (this process) that registers, is sent its stats page, and
+  # then sends bad limits
+  fake = connect()
+  fake.sendall(message("register", registration(goodlimits)))
+  reply = fake.recv(4096)
+  if "statspage" not in reply:
+    print "The daemon didn't send a registered sandbox its stats page:", repr(reply)
+  fake.sendall(message("limits", {'cpu':1.0, 'memory':-1, 'diskused':1000000000}))
+  expect_closed(fake, "sent bad limits")
+
+  # A real sandbox is still monitored
+  program = open(program_name, "w")
+  program.write("""
+log("registered\\n")
+""")
+  program.close()
+
+  # Repy isn't forked, so the libraries it maps count towards its memory
+  # use.   Give it room for them.
+  restrictions = []
+  for line in open("restrictions.default").read().split("\n"):
+    if line.split()[:2] == ["resource", "memory"]:
+      line = "resource memory 100000000"
+    restrictions.append(line)
+
+  restrictionsfile = open(restrictions_name, "w")
+  restrictionsfile.write("\n".join(restrictions))
+  restrictionsfile.close()
+
+  repy_process = portable_popen.Popen([sys.executable, "repy.py",
+      "--monitor", socket_name, restrictions_name, program_name])
+  (output, errors) = repy_process.communicate()
+
+  if output != "registered\n" or "monitor daemon" in errors:
+    print "A sandbox couldn't use the daemon:", output, errors
+
+  if daemon.poll() is not None:
+    print "The daemon exited:", daemon.communicate()
+  else:
+    daemon.kill()
+    daemon.wait()
+
+  stalled.close()
+
+
+# Finally, remove any files we might created
+for filename in [socket_name, program_name, restrictions_name]:
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
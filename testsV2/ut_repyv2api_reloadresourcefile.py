@@ -0,0 +1,102 @@
+"""
+Verify that the Repy sandbox re-reads its resource file when the file given 
+with --reload is created, and that the sandboxed program sees the new limits.
+
+We run a RepyV2 program that polls getresources() for a changed 'events' 
+limit and records what it saw in a file.   While it runs, we lower the 
+limit in a copy of restrictions.default and create the reload file.
+
+Note: This test overwrites / removes files from the current working dir. 
+The chosen file names should be unlikely to clash with anything you 
+created, but you have been warned.
+"""
+
+import sys
+import os
+import portable_popen
+import time
+
+
+program_name = "reload_program_for_repy_reload_test.r2py"
+restrictions_name = "restrictions.reloadtest"
+reload_name = "REPY_RELOAD_TEST"
+result_name = "reload_result_for_repy_reload_test"
+
+for filename in [program_name, restrictions_name, reload_name, result_name]:
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
+
+
+# The program waits up to 20 seconds for the events limit to drop to 7
+program = open(program_name, "w")
+program.write("""
+for attempt in range(100):
+  if getresources()[0]['events'] == 7:
+    result = 'reloaded'
+    break
+  sleep(0.2)
+else:
+  result = 'not reloaded'
+
+resultfile = openfile('""" + result_name + """', True)
+resultfile.writeat(result, 0)
+resultfile.close()
+""")
+program.close()
+
+
+# Start with the default restrictions
+restrictions = open("restrictions.default").read()
+restrictionsfile = open(restrictions_name, "w")
+restrictionsfile.write(restrictions)
+restrictionsfile.close()
+
+repy_process = portable_popen.Popen([sys.executable, "repy.py", 
+    "--reload", reload_name, restrictions_name, program_name])
+
+# Give things time to settle (launching of subprocess, code safety check, etc.)
+time.sleep(5)
+
+
+# Lower the events limit and tell repy to reload
+newrestrictions = []
+for line in restrictions.split("\n"):
+  if line.split()[:2] == ["resource", "events"]:
+    line = "resource events 7"
+  newrestrictions.append(line)
+
+restrictionsfile = open(restrictions_name, "w")
+restrictionsfile.write("\n".join(newrestrictions))
+restrictionsfile.close()
+
+open(reload_name, "w").close()
+
+
+# Wait for the program to record what it saw
+for attempt in range(40):
+  if os.path.exists(result_name):
+    break
+  time.sleep(0.5)
+
+# Let the program finish writing
+time.sleep(1)
+
+if not os.path.exists(result_name):
+  print "The program never finished!"
+else:
+  result = open(result_name).read()
+  if result != "reloaded":
+    print "The program did not see the reloaded limits:", result
+
+if os.path.exists(reload_name):
+  print "repy.py did not remove the reload file."
+
+
+# Finally, remove any files we might created
+for filename in [program_name, restrictions_name, reload_name, result_name]:
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
@@ -0,0 +1,89 @@
+"""
+Verify that the resource file can't be reloaded with a renewable resource
+limited to 0 while a thread waits for that resource to drain, and that the
+waiting thread fails cleanly if such a limit is swapped in anyway.
+
+A thread charges twice the limit of random data, which makes it wait.
+Meanwhile we reload a resource file that limits random data to 0, which
+must be refused, and then swap that limit in directly.
+
+Note: This test overwrites / removes files from the current working dir.
+The chosen file names should be unlikely to clash with anything you
+created, but you have been warned.
+"""
+
+import os
+import time
+import threading
+
+# nonportable has to be imported before nanny, which imports it
+import nonportable
+import nanny
+import resourcemanipulation
+
+
+restrictions_name = "restrictions.reloadzerotest"
+zero_restrictions_name = "restrictions.reloadzerotest0"
+
+
+def write_restrictions(filename, randomlimit):
+  restrictions = []
+  for line in open("restrictions.default").read().split("\n"):
+    if line.split()[:2] == ["resource", "random"]:
+      line = "resource random " + str(randomlimit)
+    restrictions.append(line)
+
+  restrictionsfile = open(filename, "w")
+  restrictionsfile.write("\n".join(restrictions))
+  restrictionsfile.close()
+
+
+def charge_random(results):
+  try:
+    nanny.tattle_quantity("random", 2000)
+  except Exception, e:
+    results.append(e)
+  else:
+    results.append(None)
+
+
+write_restrictions(restrictions_name, 1000)
+write_restrictions(zero_restrictions_name, 0)
+nanny.start_resource_nanny(restrictions_name)
+
+results = []
+waitingthread = threading.Thread(target=charge_random, args=(results,))
+waitingthread.start()
+time.sleep(0.2)
+
+# The reload is refused, and the old limit kept
+try:
+  nanny.reload_resource_nanny(zero_restrictions_name)
+except resourcemanipulation.ResourceParseError:
+  pass
+else:
+  print "A resource file that limits random data to 0 was reloaded."
+
+if nanny.get_resource_limit("random") != 1000:
+  print "The limit changed to", nanny.get_resource_limit("random")
+if results:
+  print "The waiting thread stopped waiting:", results
+
+# Swapped in anyway, the limit stops the waiting thread with an internal
+# error rather than crashing it
+zerolimits = resourcemanipulation.read_resourcedict_from_file(zero_restrictions_name)[0]
+nanny.update_resource_limits(zerolimits)
+
+waitingthread.join(5)
+if waitingthread.isAlive():
+  print "The waiting thread is still waiting."
+elif results[0] is None or type(results[0]).__name__ != "InternalRepyError":
+  print "The waiting thread ended with", repr(results[0])
+
+
+# Finally, remove any files we might created
+for filename in [restrictions_name, zero_restrictions_name]:
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
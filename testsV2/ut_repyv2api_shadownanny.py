@@ -0,0 +1,108 @@
+"""
+Verify that shadow mode records the sleeps and refusals the shadow limits
+would have caused, without enforcing them, and reports them both at exit
+and next to the status files.
+
+We run a RepyV2 program under the default restrictions, with shadow limits
+of 5000 bytes of random data a second and one open file.   The program
+reads 8 KB of random data at once (the real limit allows 10000 bytes a
+second) and opens two files at the same time.   The shadow limits would
+have made the last 4 reads of random data wait, and refused the second
+file.
+
+Note: This test overwrites / removes files from the current working dir.
+The chosen file names should be unlikely to clash with anything you
+created, but you have been warned.
+"""
+
+import sys
+import os
+import portable_popen
+
+
+program_name = "program_for_repy_shadow_test.r2py"
+restrictions_name = "restrictions.shadowtest"
+status_prefix = "shadowteststatus"
+
+
+program = open(program_name, "w")
+program.write("""
+for num in range(8):
+  randombytes()
+
+firstfile = openfile("shadowtestfile1", True)
+secondfile = openfile("shadowtestfile2", True)
+firstfile.close()
+secondfile.close()
+removefile("shadowtestfile1")
+removefile("shadowtestfile2")
+
+# Let the status thread write the shadow report
+sleep(2.5)
+""")
+program.close()
+
+
+restrictions = []
+for line in open("restrictions.default").read().split("\n"):
+  if line.split()[:2] == ["resource", "random"]:
+    line = "resource random 5000"
+  if line.split()[:2] == ["resource", "filesopened"]:
+    line = "resource filesopened 1"
+  restrictions.append(line)
+
+restrictionsfile = open(restrictions_name, "w")
+restrictionsfile.write("\n".join(restrictions))
+restrictionsfile.close()
+
+repy_process = portable_popen.Popen([sys.executable, "repy.py",
+    "--status", status_prefix, "--shadow", restrictions_name,
+    "restrictions.default", program_name])
+(output, errors) = repy_process.communicate()
+
+
+def check_report(report, where):
+  # Maps each resource to its line, split into columns
+  lines = {}
+  for line in report.split("\n"):
+    if line and not line.startswith("#"):
+      lines[line.split()[0]] = line.split()
+
+  if "random" not in lines or "filesopened" not in lines:
+    print "The shadow report " + where + " is missing resources:", report
+    return
+
+  # The fifth read goes 120 bytes over, the others 1024 bytes each
+  (resource, limit, stalls, stalltime, maxstall, refused) = lines["random"]
+  if float(limit) != 5000 or stalls != "4" or refused != "0" or \
+      abs(float(stalltime) - 0.6384) > 0.01 or \
+      abs(float(maxstall) - 0.2048) > 0.01:
+    print "The shadow report " + where + " is wrong for random:", lines["random"]
+
+  (resource, limit, stalls, stalltime, maxstall, refused) = lines["filesopened"]
+  if float(limit) != 1 or stalls != "0" or refused != "1":
+    print "The shadow report " + where + " is wrong for filesopened:", lines["filesopened"]
+
+  # Nothing else would have been limited
+  for resource in lines:
+    if resource not in ["random", "filesopened"] and lines[resource][2:] != \
+        ["0", "0.000000", "0.000000", "0"]:
+      print "The shadow report " + where + " is wrong for " + resource + ":", lines[resource]
+
+
+check_report(errors, "at exit")
+
+if not os.path.exists(status_prefix + ".shadow"):
+  print "No shadow report was written next to the status files."
+else:
+  check_report(open(status_prefix + ".shadow").read(), "next to the status files")
+
+
+# Finally, remove any files we might created
+for filename in os.listdir("."):
+  if filename in [program_name, restrictions_name, "shadowtestfile1",
+      "shadowtestfile2"] or filename.startswith(status_prefix):
+    try:
+      os.remove(filename)
+    except OSError:
+      pass
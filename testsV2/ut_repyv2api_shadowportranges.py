@@ -0,0 +1,71 @@
+"""
+Verify that shadow mode checks ports against the ranges in the shadow
+resource file, and writes the ranges in its report without spaces.
+
+We run a RepyV2 program with the same resource file for the real and the
+shadow limits, allowing connection ports 12000 to 12999.   The program
+listens on a port in the range, which both allow, and one outside it, which
+both refuse.   The shadow report (written to stderr at exit) must count one
+refused port.
+
+Note: This test overwrites / removes files from the current working dir.
+The chosen file names should be unlikely to clash with anything you
+created, but you have been warned.
+"""
+
+import sys
+import os
+import portable_popen
+
+
+program_name = "program_for_repy_shadowport_test.r2py"
+restrictions_name = "restrictions.shadowporttest"
+
+
+program = open(program_name, "w")
+program.write("""
+listener = listenforconnection("127.0.0.1", 12500)
+listener.close()
+
+try:
+  listenforconnection("127.0.0.1", 13000)
+except ResourceForbiddenError:
+  pass
+""")
+program.close()
+
+
+# The default restrictions, with a range of connection ports
+restrictions = []
+for line in open("restrictions.default").read().split("\n"):
+  if line.split()[:2] == ["resource", "connport"]:
+    line = "resource connport 12000-12999"
+  restrictions.append(line)
+
+restrictionsfile = open(restrictions_name, "w")
+restrictionsfile.write("\n".join(restrictions))
+restrictionsfile.close()
+
+repy_process = portable_popen.Popen([sys.executable, "repy.py",
+    "--shadow", restrictions_name, restrictions_name, program_name])
+(output, errors) = repy_process.communicate()
+
+
+connportline = None
+for line in errors.split("\n"):
+  if line.startswith("connport "):
+    connportline = line
+
+if connportline is None:
+  print "There is no shadow report for connport:", output, errors
+elif connportline.split() != ["connport", "12000-12999", "0", "0.000000",
+    "0.000000", "1"]:
+  print "The shadow report for connport is wrong:", connportline
+
+
+# Finally, remove any files we might created
+for filename in [program_name, restrictions_name]:
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
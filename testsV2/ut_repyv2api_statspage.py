@@ -0,0 +1,79 @@
+"""
+Verify that the stats page the resource monitor publishes repy's resource
+use in reads back what was written, and that a reader never sees a
+half-written page while another process writes it.
+
+A forked writer publishes usage with the CPU time equal to the memory, and
+stops with the time equal to the amount, as fast as it can.   The reader
+checks every page it reads for those, and that the values never go back.
+"""
+
+import os
+import sys
+
+import harshexit
+import statspage
+
+
+# What a single process writes, it reads
+page = statspage.StatsPage()
+if page.read() is not None:
+  print "A new page isn't empty:", page.read()
+
+page.write_usage(1.5, 1000)
+page.write_diskused(2000)
+for num in range(statspage.STOP_ENTRIES + 5):
+  page.add_stop(float(num), 0.5)
+
+(cpu, memory, diskused, stoptimes) = page.read()
+if (cpu, memory, diskused) != (1.5, 1000, 2000):
+  print "The page reads back wrong:", (cpu, memory, diskused)
+if len(stoptimes) != statspage.STOP_ENTRIES or stoptimes[0] != (5.0, 0.5) or \
+    stoptimes[-1] != (statspage.STOP_ENTRIES + 4.0, 0.5):
+  print "The stops read back wrong:", stoptimes[0], stoptimes[-1], len(stoptimes)
+page.close()
+
+
+# The page is only shared with forked processes
+harshexit.init_ostype()
+if harshexit.ostype in ['Linux', 'Darwin']:
+  page = statspage.StatsPage()
+  WRITES = 300000
+
+  childpid = os.fork()
+  if childpid == 0:
+    for num in xrange(1, WRITES + 1):
+      page.write_usage(float(num), num)
+      if num % 1000 == 0:
+        page.add_stop(float(num), float(num))
+    os._exit(0)
+
+  reads = 0
+  torn = 0
+  lastmemory = 0
+  while os.waitpid(childpid, os.WNOHANG) == (0, 0):
+    result = page.read()
+    if result is None:
+      continue
+    (cpu, memory, diskused, stoptimes) = result
+    reads += 1
+
+    badstops = False
+    for (stoptime, amount) in stoptimes:
+      if stoptime != amount:
+        badstops = True
+
+    if cpu != memory or memory < lastmemory or badstops:
+      torn += 1
+      if torn == 1:
+        print "Read a half-written page:", cpu, memory, stoptimes[-1:]
+    lastmemory = memory
+
+  if torn:
+    print torn, "of", reads, "reads were of half-written pages."
+
+  result = page.read()
+  if result is None or result[:2] != (float(WRITES), WRITES) or \
+      len(result[3]) != statspage.STOP_ENTRIES:
+    print "The page doesn't have the last write:", result
+  page.close()
@@ -0,0 +1,59 @@
+"""
+Verify that charging several renewable resources at once only records
+stalls for the resources the thread actually waited for.
+
+Sending and receiving are both limited to 1000 bytes a second, and we
+charge 2000 bytes of each at once.   The thread waits a second for the
+first resource, during which the second drains too, so there is one stall
+of about a second and none for the second resource.
+
+Note: This test overwrites / removes files from the current working dir.
+The chosen file names should be unlikely to clash with anything you
+created, but you have been warned.
+"""
+
+import os
+
+# nonportable has to be imported before nanny, which imports it
+import nonportable
+import nanny
+
+
+restrictions_name = "restrictions.tattlequantitiestest"
+
+
+restrictions = []
+for line in open("restrictions.default").read().split("\n"):
+  if line.split()[:2] in [["resource", "netsend"], ["resource", "netrecv"]]:
+    line = " ".join(line.split()[:2]) + " 1000"
+  restrictions.append(line)
+
+restrictionsfile = open(restrictions_name, "w")
+restrictionsfile.write("\n".join(restrictions))
+restrictionsfile.close()
+
+nanny.start_resource_nanny(restrictions_name)
+
+starttime = nonportable.getruntime()
+nanny.tattle_quantities({'netsend':2000, 'netrecv':2000})
+elapsed = nonportable.getruntime() - starttime
+
+if elapsed < 0.9 or elapsed > 1.5:
+  print "Charging both took", elapsed, "seconds instead of about 1."
+
+stalls = []
+histograms = nanny.get_stall_histograms()
+for resource in histograms:
+  for apiname in histograms[resource]:
+    entry = histograms[resource][apiname]
+    stalls.append((resource, entry['count'], entry['total']))
+
+if len(stalls) != 1 or stalls[0][1] != 1 or abs(stalls[0][2] - 1.0) > 0.2:
+  print "The wrong stalls were recorded:", stalls
+
+
+# Finally, remove any files we might created
+try:
+  os.remove(restrictions_name)
+except OSError:
+  pass
@@ -0,0 +1,167 @@
+"""
+Verify that tracereplay.py reads, replays and formats tattle traces, and
+that repy.py --trace writes a trace it can read.
+
+We write a trace by hand in which one thread charges 20 calls of random
+data at once and uses some items, and check what read_trace(),
+replay_trace() and format_results() make of it, also when the trace is cut
+off or has data after the header that isn't a record.   Then we trace a
+RepyV2 program, whose resource monitor is forked after the trace is
+started, and check that the trace has a single header.
+
+Note: This test overwrites / removes files from the current working dir.
+The chosen file names should be unlikely to clash with anything you
+created, but you have been warned.
+"""
+
+import sys
+import os
+import struct
+import portable_popen
+
+import tracereplay
+import nanny
+import resource_constants
+import resourcemanipulation
+
+
+trace_name = "trace_for_tracereplay_test"
+program_name = "program_for_tracereplay_test.r2py"
+
+
+def write_trace(filename, records, extra=""):
+  resourcenames = ','.join(resource_constants.known_resources)
+  tracefile = open(filename, "wb")
+  tracefile.write(nanny.TRACE_MAGIC + struct.pack("<I", len(resourcenames)) + resourcenames)
+  for (thetime, resource, operation, itemkey, quantity) in records:
+    tracefile.write(nanny.TRACE_RECORD.pack(thetime, 0,
+        resource_constants.resource_ids[resource], operation, 0, itemkey,
+        quantity, 0.0))
+  tracefile.write(extra)
+  tracefile.close()
+
+
+def expect_valueerror(description):
+  try:
+    tracereplay.read_trace(trace_name)
+  except ValueError:
+    pass
+  else:
+    print "read_trace() accepted a trace with " + description + "."
+
+
+# 20 KB of random data at time 0, three sockets (one is closed again) and
+# two connection ports
+records = []
+for num in range(20):
+  records.append((0.0, 'random', nanny.TRACE_QUANTITY, 0, 1024.0))
+for socketkey in [1, 2, 3]:
+  records.append((0.5, 'outsockets', nanny.TRACE_ADD_ITEM, socketkey, 0.0))
+records.append((0.6, 'outsockets', nanny.TRACE_REMOVE_ITEM, 1, 0.0))
+for port in [25000, 30000]:
+  records.append((0.7, 'connport', nanny.TRACE_IS_ITEM_ALLOWED, port, 0.0))
+
+write_trace(trace_name, records)
+
+readrecords = tracereplay.read_trace(trace_name)
+if len(readrecords) != len(records):
+  print "read_trace() read", len(readrecords), "records instead of", len(records)
+elif readrecords[0][2] != 'random' or readrecords[0][6] != 1024.0 or \
+    readrecords[-1][2] != 'connport' or readrecords[-1][5] != 30000:
+  print "read_trace() misread the records:", readrecords[0], readrecords[-1]
+
+
+# Replay against 10000 bytes of random data a second, 2 sockets and ports
+# 20000 to 29999
+limits = resourcemanipulation.read_resourcedict_from_file("restrictions.default")[0]
+limits['random'] = 10000
+limits['outsockets'] = 2
+limits['connport'] = [(20000, 29999)]
+
+results = tracereplay.replay_trace(readrecords, limits)
+
+# The first 10000 bytes are free, and the rest drains in 1.048 seconds
+random = results['random']
+if random['charges'] != 20 or random['stalls'] == 0 or \
+    abs(random['stalltime'] - 1.048) > 0.001 or random['tracedstalls'] != 0:
+  print "replay_trace() predicted the wrong waits:", random
+
+outsockets = results['outsockets']
+if outsockets['requests'] != 3 or outsockets['refused'] != 1 or \
+    outsockets['peakitems'] != 2:
+  print "replay_trace() got the sockets wrong:", outsockets
+
+connport = results['connport']
+if connport['requests'] != 2 or connport['refused'] != 1:
+  print "replay_trace() got the ports wrong:", connport
+
+
+# One line per resource, with a value in every column
+for line in tracereplay.format_results(results).splitlines():
+  if line.startswith("#"):
+    continue
+  fields = line.split()
+  if fields[0] in resource_constants.renewable_resources:
+    columns = 9
+  else:
+    columns = 4
+  if len(fields) != columns:
+    print "format_results() wrote a bad line:", line
+  if fields[0] == 'random' and fields[1:3] != ['20', '0']:
+    print "format_results() wrote the wrong counts:", line
+
+
+# A trace cut off in the middle of a record loses only that record
+write_trace(trace_name, records)
+data = open(trace_name, "rb").read()
+open(trace_name, "wb").write(data[:-5])
+if len(tracereplay.read_trace(trace_name)) != len(records) - 1:
+  print "read_trace() didn't drop the cut off record."
+
+open(trace_name, "wb").write(data[:len(data) - len(records) * nanny.TRACE_RECORD.size])
+if tracereplay.read_trace(trace_name) != []:
+  print "read_trace() found records in a trace with only a header."
+
+# Anything else after the header is an error
+write_trace(trace_name, records, data[:nanny.TRACE_RECORD.size + 10])
+expect_valueerror("a second header")
+
+write_trace(trace_name, records, "\xff" * nanny.TRACE_RECORD.size)
+expect_valueerror("a record of an unknown resource")
+
+open(trace_name, "wb").write("not a trace")
+expect_valueerror("no header")
+
+
+# Trace a program.   The resource monitor is forked after the header is
+# written, and must not write it again.
+program = open(program_name, "w")
+program.write("""
+for num in range(5):
+  randombytes()
+""")
+program.close()
+
+os.remove(trace_name)
+repy_process = portable_popen.Popen([sys.executable, "repy.py",
+    "--trace", trace_name, "restrictions.default", program_name])
+repy_process.communicate()
+
+data = open(trace_name, "rb").read()
+if data.count(nanny.TRACE_MAGIC) != 1:
+  print "repy.py wrote", data.count(nanny.TRACE_MAGIC), "trace headers."
+else:
+  randomcharges = 0
+  for record in tracereplay.read_trace(trace_name):
+    if record[2] == 'random' and record[6] == 1024:
+      randomcharges += 1
+  if randomcharges != 5:
+    print "The trace has", randomcharges, "charges of random data instead of 5."
+
+
+# Finally, remove any files we might created
+for filename in [trace_name, program_name]:
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
@@ -0,0 +1,324 @@
+"""
+<Program Name>
+  tracereplay.py
+
+<Purpose>
+  Replays a trace of nanny tattles (written by repy.py --trace) against a
+  resource file, and reports what those limits would have done to the
+  traced workload:
+
+    - for renewable resources, how often and how long threads would have
+      been made to wait, the peak rate the resource was used at (per second
+      of replayed time), and how closely the rate tracks the limit while
+      the resource is throttled (1.0 is exact).
+    - for item resources, the peak number of items in use and how many
+      requests would have been refused.
+
+  The replay uses the nanny's ResourceTable and the same draining as the
+  nanny.   A charge that goes over a resource's capacity waits until the
+  resource drains back to its capacity, and charges that come in meanwhile
+  queue up behind it.   The waits in the trace are taken out of the thread's
+  timeline and the predicted waits are put in, so a trace recorded under
+  one set of limits can be replayed against another.
+
+<Usage>
+  python tracereplay.py tracefile resourcefile
+"""
+
+import sys
+import heapq
+import struct
+
+# nonportable has to be imported before nanny, which imports it
+import nonportable
+import nanny
+import resource_constants
+import resourcemanipulation
+
+
+TRACE_OPERATIONS = [nanny.TRACE_QUANTITY, nanny.TRACE_ADD_ITEM,
+    nanny.TRACE_REMOVE_ITEM, nanny.TRACE_IS_ITEM_ALLOWED]
+
+
+def read_trace(tracefilename):
+  """
+  <Purpose>
+    Reads a trace file written by nanny.start_trace().
+
+  <Arguments>
+    tracefilename:
+      The name of the trace file.
+
+  <Exceptions>
+    ValueError if the file is not a trace, or has data after the header that
+    isn't a record (other than part of one at the end, which is ignored).
+    As with open() and file.read().
+
+  <Returns>
+    A list of (time, thread index, resource name, operation, flags, item key,
+    quantity, stall time) tuples, in the order they were written.
+  """
+  tracefile = open(tracefilename, 'rb')
+  try:
+    data = tracefile.read()
+  finally:
+    tracefile.close()
+
+  if not data.startswith(nanny.TRACE_MAGIC):
+    raise ValueError("'" + tracefilename + "' is not a tattle trace!")
+
+  index = len(nanny.TRACE_MAGIC)
+  (nameslength,) = struct.unpack("<I", data[index:index + 4])
+  index += 4
+  resourcenames = data[index:index + nameslength].split(',')
+  index += nameslength
+
+  recordsize = nanny.TRACE_RECORD.size
+
+  records = []
+  # A trace cut off by a crash may end with part of a record
+  while index + recordsize <= len(data):
+    # A second header means the file was written twice
+    if data.startswith(nanny.TRACE_MAGIC, index):
+      raise ValueError("'" + tracefilename + "' has another trace header at byte " + str(index) + "!")
+
+    (thetime, threadindex, resourceid, operation, flags, itemkey, quantity, stalltime) = \
+        nanny.TRACE_RECORD.unpack(data[index:index + recordsize])
+
+    if resourceid >= len(resourcenames) or operation not in TRACE_OPERATIONS:
+      raise ValueError("'" + tracefilename + "' has a bad record at byte " + str(index) + "!")
+
+    records.append((thetime, threadindex, resourcenames[resourceid],
+        operation, flags, itemkey, quantity, stalltime))
+    index += recordsize
+
+  return records
+
+
+
+def replay_trace(records, resourcesalloweddict):
+  """
+  <Purpose>
+    Replays tattle records against a set of limits.
+
+    Each thread's calls are first moved back by the time the thread spent 
+    waiting in the traced run, which gives the times the calls would have 
+    happened without any throttling.   The calls are then replayed in time 
+    order, and each thread's later calls are moved forward by the waits the
+    replay predicts for it.
+
+  <Arguments>
+    records:
+      The records, as returned by read_trace().
+    resourcesalloweddict:
+      The limits, as returned by resourcemanipulation.read_resourcedict_from_file.
+
+  <Exceptions>
+    None.
+
+  <Returns>
+    A dict mapping each resource name to a dict of results.   Renewable
+    resources have 'charges', 'tracedstalls' and 'tracedstalltime' (the 
+    waits in the trace), the predicted 'stalls', 'stalltime' and 'maxstall',
+    'peakrate' (the most used in one second of replayed time) and 
+    'tracking'.   Tracking is the rate the resource was used at between the
+    first and the last predicted wait, divided by the limit.   It is 1.0 if
+    the resource was used at exactly its limit the whole time, lower if the
+    program left it idle, and None if there was at most one wait.   Item 
+    resources have 'requests', 'refused' and 'peakitems'.
+  """
+  table = nanny.ResourceTable(resourcesalloweddict)
+
+  results = {}
+  for resource in resource_constants.known_resources:
+    if resource in resource_constants.renewable_resources:
+      results[resource] = {'charges':0, 'tracedstalls':0, 'tracedstalltime':0.0,
+          'stalls':0, 'stalltime':0.0, 'maxstall':0.0, 'peakrate':0.0,
+          'tracking':None}
+    else:
+      results[resource] = {'requests':0, 'refused':0, 'peakitems':0}
+
+  # For renewable resources, when each charge finished and how much it was
+  usedlist = {}
+  # and when the first and last charges that had to wait finished
+  throttlespan = {}
+  for resource in resource_constants.renewable_resources:
+    usedlist[resource] = []
+    throttlespan[resource] = None
+
+  # Split the records up by thread, in the order the thread made them, with 
+  # the time the thread waited in the traced run taken out
+  threadrecords = {}
+  tracedwaits = {}
+  for record in records:
+    threadindex = record[1]
+    if threadindex not in threadrecords:
+      threadrecords[threadindex] = []
+      tracedwaits[threadindex] = 0.0
+    threadrecords[threadindex].append((record[0] - tracedwaits[threadindex],) + record[1:])
+    tracedwaits[threadindex] += record[7]
+
+  # Replay the next call of each thread, earliest first.   Each entry is 
+  # (replayed time, thread index, position in the thread's records).
+  predictedwaits = {}
+  pending = []
+  for threadindex in threadrecords:
+    predictedwaits[threadindex] = 0.0
+    heapq.heappush(pending, (threadrecords[threadindex][0][0], threadindex, 0))
+
+  while pending:
+    (thetime, threadindex, position) = heapq.heappop(pending)
+    (untime, threadindex, resource, operation, flags, itemkey, quantity, tracedstall) = \
+        threadrecords[threadindex][position]
+
+    resourceid = resource_constants.resource_ids[resource]
+    result = results[resource]
+
+    if operation == nanny.TRACE_QUANTITY:
+      result['charges'] += 1
+      if flags & nanny.TRACE_BLOCKED:
+        result['tracedstalls'] += 1
+        result['tracedstalltime'] += tracedstall
+
+      # Charges that come in while an earlier one waits are queued behind
+      # it.   (The nanny would ignore time going backwards, but here it
+      # means the charge has to wait its turn.)
+      starttime = max(thetime, table.update_times[resourceid])
+      nanny._update_resource_consumption_table(resourceid, table, starttime)
+
+      table.consumed[resourceid] += quantity
+
+      finishtime = starttime
+      excess = table.consumed[resourceid] - table.capacities[resourceid]
+      if excess > 0 and table.limits[resourceid] > 0:
+        # The charge finishes once the resource has drained to its capacity
+        finishtime = starttime + excess / table.limits[resourceid]
+        table.consumed[resourceid] = table.capacities[resourceid]
+        table.update_times[resourceid] = finishtime
+
+        if throttlespan[resource] is None:
+          throttlespan[resource] = (finishtime, finishtime)
+        else:
+          throttlespan[resource] = (throttlespan[resource][0], finishtime)
+
+      stalltime = finishtime - thetime
+      if stalltime > 0:
+        result['stalls'] += 1
+        result['stalltime'] += stalltime
+        result['maxstall'] = max(result['maxstall'], stalltime)
+        predictedwaits[threadindex] += stalltime
+
+      usedlist[resource].append((finishtime, quantity))
+
+    elif operation == nanny.TRACE_ADD_ITEM:
+      result['requests'] += 1
+      itemsused = table.consumed[resourceid]
+
+      # Items the limits refuse are never in use
+      if itemkey not in itemsused:
+        if len(itemsused) >= table.limits[resourceid]:
+          result['refused'] += 1
+        else:
+          itemsused.add(itemkey)
+          result['peakitems'] = max(result['peakitems'], len(itemsused))
+
+    elif operation == nanny.TRACE_REMOVE_ITEM:
+      table.consumed[resourceid].discard(itemkey)
+
+    elif operation == nanny.TRACE_IS_ITEM_ALLOWED:
+      # Ports are numbers, so their keys are their hashes too
+      result['requests'] += 1
+      if not resourcemanipulation.is_item_in_ranges(table.limits[resourceid], itemkey):
+        result['refused'] += 1
+
+    # Queue up the thread's next call
+    position += 1
+    if position < len(threadrecords[threadindex]):
+      nexttime = threadrecords[threadindex][position][0] + predictedwaits[threadindex]
+      heapq.heappush(pending, (nexttime, threadindex, position))
+
+  for resource in usedlist:
+    if not usedlist[resource]:
+      continue
+
+    usedpersecond = {}
+    for (finishtime, quantity) in usedlist[resource]:
+      second = int(finishtime)
+      usedpersecond[second] = usedpersecond.get(second, 0.0) + quantity
+    results[resource]['peakrate'] = max(usedpersecond.values())
+
+    if throttlespan[resource] is None:
+      continue
+
+    (firsttime, lasttime) = throttlespan[resource]
+    limit = resourcesalloweddict[resource]
+    if lasttime > firsttime and limit > 0:
+      used = 0.0
+      for (finishtime, quantity) in usedlist[resource]:
+        if firsttime < finishtime <= lasttime:
+          used += quantity
+      results[resource]['tracking'] = used / (limit * (lasttime - firsttime))
+
+  return results
+
+
+
+def format_results(results):
+  """
+  <Purpose>
+    Formats the results of replay_trace() as a table, one line per resource.
+
+  <Arguments>
+    results:
+      As returned by replay_trace().
+
+  <Exceptions>
+    None.
+
+  <Returns>
+    The table as a string.
+  """
+  lines = []
+
+  lines.append("# renewable: resource charges tracedstalls tracedstalltime stalls stalltime maxstall peakrate tracking")
+  for resource in resource_constants.known_resources:
+    if resource not in resource_constants.renewable_resources:
+      continue
+    result = results[resource]
+    if result['tracking'] is None:
+      tracking = '-'
+    else:
+      tracking = '%.3f' % result['tracking']
+    lines.append(' '.join([resource, str(result['charges']),
+        str(result['tracedstalls']), '%.6f' % result['tracedstalltime'],
+        str(result['stalls']),
+        '%.6f' % result['stalltime'], '%.6f' % result['maxstall'],
+        '%.1f' % result['peakrate'], tracking]))
+
+  lines.append("# items: resource requests refused peakitems")
+  for resource in resource_constants.known_resources:
+    if resource in resource_constants.renewable_resources or \
+        resource in resource_constants.quantity_resources:
+      continue
+    result = results[resource]
+    lines.append(' '.join([resource, str(result['requests']),
+        str(result['refused']), str(result['peakitems'])]))
+
+  return '\n'.join(lines) + '\n'
+
+
+
+def main():
+  if len(sys.argv) != 3:
+    print "Usage: python tracereplay.py tracefile resourcefile"
+    sys.exit(1)
+
+  records = read_trace(sys.argv[1])
+  resourcesalloweddict, call_list = resourcemanipulation.read_resourcedict_from_file(sys.argv[2])
+
+  sys.stdout.write(format_results(replay_trace(records, resourcesalloweddict)))
+
+
+
+if __name__ == '__main__':
+  main()
@@ -13,14 +13,18 @@
 
 import encoding_header # Subtract len(ENCODING_HEADER) from error line numbers.
 import safe # Used for safety checking
+import nanny # Used for sub-quotas
 from exception_hierarchy import *
 
 # This is to work around safe...
 safe_compile = compile
 
-# Functional constructor for VirtualNamespace
-def createvirtualnamespace(code, name):
-  return VirtualNamespace(code,name)
+# Functional constructor for VirtualNamespace.   The sub-quota is optional, 
+# so it arrives as a variable argument.
+def createvirtualnamespace(code, name, *quota):
+  if len(quota) > 1:
+    raise RepyArgumentError, "createvirtualnamespace takes 2 or 3 arguments!"
+  return VirtualNamespace(code,name,*quota)
 
 # This class is used to represent a namespace
 class VirtualNamespace(object):
@@ -31,7 +35,7 @@ class VirtualNamespace(object):
   """
 
   # Constructor
-  def __init__(self, code, name):
+  def __init__(self, code, name, quota=None):
     """
     <Purpose>
       Initializes the VirtualNamespace class.
@@ -46,11 +50,22 @@ class VirtualNamespace(object):
           being executed, if there is an exception, this name will appear in
           the traceback.
 
+      quota:
+          (Dict, optional) A sub-quota that limits the resources the code 
+          (and any threads it creates) may use while it is evaluated.   This
+          maps resource names to limits, as in a resource file, except that
+          'messport' and 'connport' map to a list of ports.   Anything the
+          code uses is also charged to the code that evaluates it.
+
     <Exceptions>
       A safety check is performed on the code, and a CodeUnsafeError exception will be raised
       if the code fails the safety check. 
 
       If code or name are not string types, a RepyArgumentError exception will be raised.
+
+      If the sub-quota is malformed, or limits 'cpu', 'memory' or 'diskused'
+      (which are measured for the whole process), a RepyArgumentError 
+      exception will be raised.
     """
     # Check for the code
     # Do a type check
@@ -79,6 +94,12 @@ class VirtualNamespace(object):
     # All good, store the compiled byte code
     self.code = safe_compile(code,name,"exec")
 
+    # The nanny's copy of the sub-quota (if any)
+    if quota is None:
+      self.quota = None
+    else:
+      self.quota = nanny.create_resource_quota(quota)
+
 
   # Evaluates the virtual namespace
   def evaluate(self,context):
@@ -114,8 +135,19 @@ class VirtualNamespace(object):
     if not isinstance(context, safe.SafeDict):
       raise RepyArgumentError, "Provided context is not a safe dictionary!"
 
-    # Call safe_run with the underlying dictionary
-    safe.safe_run(self.code, context.__under__)
+    # Without a sub-quota, the code is charged to whatever the caller is
+    # charged to
+    previousquotas = nanny.get_thread_quotas()
+    if self.quota is None or self.quota in previousquotas:
+      safe.safe_run(self.code, context.__under__)
+      return context
+
+    # Call safe_run with the underlying dictionary, charging the sub-quota
+    nanny.set_thread_quotas(previousquotas + (self.quota,))
+    try:
+      safe.safe_run(self.code, context.__under__)
+    finally:
+      nanny.set_thread_quotas(previousquotas)
 
     # Return the dictionary we used
     return context